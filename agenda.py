@@ -2,9 +2,13 @@
 Queries de agenda/consultas para o dashboard - Medicine Dream
 """
 
-import fdb
-from datetime import time as dt_time
-from paciente import CONFIG
+import hashlib
+import threading
+import time
+from datetime import date, time as dt_time
+from paciente import CONFIG, LOTE_IN, em_lotes, placeholders
+from pool import BaseDB
+from referencia import cache_referencia
 
 
 def _time_to_minutes(t):
@@ -22,23 +26,115 @@ SITUACOES = {
 }
 
 
-class AgendaDB:
-    def __init__(self):
-        self.conn = None
-
-    def conectar(self):
-        self.conn = fdb.connect(**CONFIG)
+class _ProfissionaisAgenda:
+    """Conjunto materializado dos profissionais com agendamento.
+
+    A primeira carga (e a recarga a cada `recarga` segundos) le a agenda
+    inteira; depois, no maximo a cada `intervalo` segundos, so os
+    agendamentos com A27COD maior que o ultimo visto. A lista pronta e o
+    ETag ficam guardados ate a proxima atualizacao."""
+
+    SQL = """
+        SELECT a.A27FK31COD_USUARIO, MAX(a.A27COD)
+        FROM M27AGENDA a
+        WHERE a.A27COD > ?
+          AND a.A27FK31COD_USUARIO IS NOT NULL
+        GROUP BY a.A27FK31COD_USUARIO
+    """
+
+    def __init__(self, intervalo=60, recarga=86400):
+        self.intervalo = intervalo
+        self.recarga = recarga
+        self.ids = frozenset()
+        self.max_cod = 0
+        self.lista = []
+        self.etag = None
+        self._atualizado_em = 0
+        self._carregado_em = 0
+        self._lock = threading.Lock()
+
+    def garantir(self, conn, referencia):
+        """Atualiza o conjunto se estiver vencido. So uma thread consulta o
+        banco; as demais seguem com a lista atual."""
+        if self._atualizado_em and time.monotonic() - self._atualizado_em < self.intervalo:
+            return self
+        if not self._lock.acquire(blocking=not self._atualizado_em):
+            return self
+        try:
+            agora = time.monotonic()
+            if self._atualizado_em and agora - self._atualizado_em < self.intervalo:
+                return self
+            completo = agora - self._carregado_em >= self.recarga
+            ids = set() if completo else set(self.ids)
+            max_cod = 0 if completo else self.max_cod
+
+            cursor = conn.cursor()
+            cursor.execute(self.SQL, (max_cod,))
+            for usuario, cod in cursor.fetchall():
+                ids.add(usuario)
+                max_cod = max(max_cod, cod)
+            cursor.close()
+
+            ref = referencia.garantir(conn)
+            lista = []
+            for usuario in ids:
+                nome = ref.profissional(usuario)
+                if nome is not None:
+                    lista.append({'id': usuario, 'nome': nome})
+            lista.sort(key=lambda p: p['nome'])
+            assinatura = repr([(p['id'], p['nome']) for p in lista]).encode('utf-8')
+
+            self.ids = frozenset(ids)
+            self.max_cod = max_cod
+            self.lista = lista
+            self.etag = hashlib.sha1(assinatura).hexdigest()[:16]
+            self._atualizado_em = agora
+            if completo:
+                self._carregado_em = agora
+        finally:
+            self._lock.release()
         return self
 
-    def desconectar(self):
-        if self.conn:
-            self.conn.close()
-
-    def __enter__(self):
-        return self.conectar()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.desconectar()
+# Marcador de mudanca da agenda (ETag do dashboard). No periodo do dia ou da
+# semana, pega inclusoes, mudancas de situacao e o andamento do atendimento
+# (entrou na fila, iniciou, terminou: colunas que deixam de ser NULL).
+SQL_MARCADOR_AGENDA = """
+    SELECT COUNT(*), MAX(a.A27COD), SUM(a.A27FK84COD_SITUACAO),
+           COUNT(a.A27HORA_ENTROU_NA_FILA), COUNT(a.A27HORA_INI_ATENDIMENTO),
+           COUNT(a.A27TEMPO_ATENDIMENTO)
+    FROM M27AGENDA a
+    WHERE {periodo}
+"""
+PERIODO_DIA = "a.A27DATA = COALESCE(?, CURRENT_DATE)"
+PERIODO_SEMANA = """a.A27DATA BETWEEN
+    DATEADD(-EXTRACT(WEEKDAY FROM COALESCE(?, CURRENT_DATE)) + 1 DAY TO COALESCE(?, CURRENT_DATE))
+    AND
+    DATEADD(-EXTRACT(WEEKDAY FROM COALESCE(?, CURRENT_DATE)) + 7 DAY TO COALESCE(?, CURRENT_DATE))"""
+SQL_MARCADOR_AGENDA_GERAL = "SELECT MAX(A27COD) FROM M27AGENDA"
+
+
+class AgendaDB(BaseDB):
+    def __init__(self, pool=None, referencia=None):
+        super().__init__(CONFIG, pool)
+        # Nomes de profissionais, situacoes e procedimentos (referencia.py)
+        self.referencia = referencia if referencia is not None else cache_referencia
+        self._profissionais = _ProfissionaisAgenda()
+
+    def _procedimentos_por_agenda(self, cursor, agendas, ref):
+        """Aliases dos procedimentos de varias agendas: {A27COD: 'ALIAS1, ALIAS2'}.
+        Uma consulta por lote de ate LOTE_IN agendas, em vez de uma subconsulta
+        correlacionada por linha; os aliases vem do cache de referencia."""
+        por_agenda = {}
+        for lote in em_lotes(set(agendas)):
+            cursor.execute(f"""
+                SELECT A28FK27COD_AGENDA, A28FK21COD_PROCEDIMENTO
+                FROM M28PROCEDIMENTO_AGENDA
+                WHERE A28FK27COD_AGENDA IN ({placeholders(lote)})
+            """, lote)
+            for agenda, procedimento in cursor.fetchall():
+                por_agenda.setdefault(agenda, []).append(ref.procedimento_alias(procedimento))
+        return {agenda: ref.lista(aliases) for agenda, aliases in por_agenda.items()}
 
     def agenda_dia(self, data=None, profissional=None):
         """Agenda completa do dia"""
@@ -50,27 +146,17 @@ class AgendaDB:
                 a.A27HORA_INI_AGENDA,
                 p.A6COD AS PACIENTE_ID,
                 pc.A115NOME AS PACIENTE,
-                uc.A115NOME AS PROFISSIONAL,
-                s.A84NOME AS SITUACAO,
+                a.A27FK31COD_USUARIO,
                 a.A27FK84COD_SITUACAO AS SITUACAO_ID,
                 a.A27HORA_ENTROU_NA_FILA,
                 a.A27TEMPO_NA_FILA,
                 a.A27HORA_INI_ATENDIMENTO,
                 a.A27TEMPO_ATENDIMENTO,
                 a.A27OBSERVACAO,
-                (SELECT LIST(DISTINCT pr.A21ALIASES, ', ')
-                 FROM M28PROCEDIMENTO_AGENDA pa
-                 LEFT JOIN M21PROCEDIMENTO pr ON pa.A28FK21COD_PROCEDIMENTO = pr.A21COD
-                 WHERE pa.A28FK27COD_AGENDA = a.A27COD
-                 AND pr.A21ALIASES IS NOT NULL
-                ) AS PROCEDIMENTO,
                 a.A27TEMPO_AGENDA
             FROM M27AGENDA a
             INNER JOIN M6PACIENTE p ON a.A27FK6COD_PACIENTE = p.A6COD
             INNER JOIN I115CLIENTE_FORNENCEDOR pc ON p.A6FKI115COD = pc.A115COD
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
-            LEFT JOIN M84SITUACAO_PROCEDIMENTO s ON a.A27FK84COD_SITUACAO = s.A84COD
             WHERE a.A27DATA = COALESCE(?, CURRENT_DATE)
               AND a.A27FK6COD_PACIENTE IS NOT NULL
         """
@@ -83,24 +169,27 @@ class AgendaDB:
         sql += " ORDER BY a.A27HORA_INI_AGENDA"
 
         cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        ref = self.referencia.garantir(self.conn)
+        procedimentos = self._procedimentos_por_agenda(cursor, [row[0] for row in rows], ref)
 
         resultado = []
-        for row in cursor.fetchall():
+        for row in rows:
             resultado.append({
                 'id': row[0],
                 'hora': row[1],
                 'paciente_id': row[2],
                 'paciente': row[3],
-                'profissional': row[4],
-                'situacao': row[5],
-                'situacao_id': row[6],
-                'hora_fila': row[7],
-                'tempo_fila': _time_to_minutes(row[8]),
-                'hora_atendimento': row[9],
-                'tempo_atendimento': _time_to_minutes(row[10]),
-                'observacao': row[11],
-                'procedimento': row[12],
-                'duracao': _time_to_minutes(row[13])
+                'profissional': ref.profissional(row[4]),
+                'situacao': ref.situacao(row[5]),
+                'situacao_id': row[5],
+                'hora_fila': row[6],
+                'tempo_fila': _time_to_minutes(row[7]),
+                'hora_atendimento': row[8],
+                'tempo_atendimento': _time_to_minutes(row[9]),
+                'observacao': row[10],
+                'procedimento': procedimentos.get(row[0]),
+                'duracao': _time_to_minutes(row[11])
             })
         cursor.close()
         return resultado
@@ -119,15 +208,9 @@ class AgendaDB:
                 a.A27TEMPO_AGENDA,
                 p.A6COD AS PACIENTE_ID,
                 pc.A115NOME AS PACIENTE,
-                uc.A115NOME AS PROFISSIONAL,
-                s.A84NOME AS SITUACAO,
+                a.A27FK31COD_USUARIO,
                 a.A27FK84COD_SITUACAO AS SITUACAO_ID,
-                (SELECT LIST(DISTINCT pr.A21ALIASES, ', ')
-                 FROM M28PROCEDIMENTO_AGENDA pa
-                 LEFT JOIN M21PROCEDIMENTO pr ON pa.A28FK21COD_PROCEDIMENTO = pr.A21COD
-                 WHERE pa.A28FK27COD_AGENDA = a.A27COD
-                 AND pr.A21ALIASES IS NOT NULL
-                ) AS PROCEDIMENTO,
+                a.A27COD,
                 a.A27HORA_ENTROU_NA_FILA,
                 a.A27TEMPO_NA_FILA,
                 a.A27HORA_INI_ATENDIMENTO,
@@ -136,9 +219,6 @@ class AgendaDB:
             FROM M27AGENDA a
             INNER JOIN M6PACIENTE p ON a.A27FK6COD_PACIENTE = p.A6COD
             INNER JOIN I115CLIENTE_FORNENCEDOR pc ON p.A6FKI115COD = pc.A115COD
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
-            LEFT JOIN M84SITUACAO_PROCEDIMENTO s ON a.A27FK84COD_SITUACAO = s.A84COD
             WHERE a.A27DATA BETWEEN
                 DATEADD(-EXTRACT(WEEKDAY FROM COALESCE(?, CURRENT_DATE)) + 1 DAY TO COALESCE(?, CURRENT_DATE))
                 AND
@@ -154,46 +234,53 @@ class AgendaDB:
         sql += " ORDER BY a.A27DATA, a.A27HORA_INI_AGENDA"
 
         cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        ref = self.referencia.garantir(self.conn)
+        procedimentos = self._procedimentos_por_agenda(cursor, [row[7] for row in rows], ref)
 
         resultado = []
-        for row in cursor.fetchall():
+        for row in rows:
             resultado.append({
                 'data': row[0],
                 'hora': row[1],
                 'duracao': _time_to_minutes(row[2]) or 15,
                 'paciente_id': row[3],
                 'paciente': row[4],
-                'profissional': row[5],
-                'situacao': row[6],
-                'situacao_id': row[7],
-                'procedimento': row[8],
-                'hora_fila': row[9],
-                'tempo_fila': _time_to_minutes(row[10]),
-                'hora_atendimento': row[11],
-                'tempo_atendimento': _time_to_minutes(row[12]),
-                'observacao': row[13]
+                'profissional': ref.profissional(row[5]),
+                'situacao': ref.situacao(row[6]),
+                'situacao_id': row[6],
+                'procedimento': procedimentos.get(row[7]),
+                'hora_fila': row[8],
+                'tempo_fila': _time_to_minutes(row[9]),
+                'hora_atendimento': row[10],
+                'tempo_atendimento': _time_to_minutes(row[11]),
+                'observacao': row[12]
             })
         cursor.close()
         return resultado
 
     def profissionais(self):
-        """Lista profissionais distintos que tem agendamentos"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT DISTINCT a.A27FK31COD_USUARIO, uc.A115NOME
-            FROM M27AGENDA a
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
-            WHERE a.A27FK31COD_USUARIO IS NOT NULL
-              AND uc.A115NOME IS NOT NULL
-            ORDER BY uc.A115NOME
-        """)
+        """Lista profissionais distintos que tem agendamentos (lista compartilhada:
+        nao alterar)"""
+        return self._profissionais.garantir(self.conn, self.referencia).lista
 
-        resultado = []
-        for row in cursor.fetchall():
-            resultado.append({'id': row[0], 'nome': row[1]})
+    def profissionais_etag(self):
+        """ETag da lista de profissionais (muda quando a lista muda)"""
+        return self._profissionais.garantir(self.conn, self.referencia).etag
+
+    def marcador(self, periodo=None, data=None):
+        """Marcador de mudanca da agenda: periodo 'dia' ou 'semana' da `data`
+        (default hoje); sem periodo, so MAX(A27COD) e a data de hoje"""
+        cursor = self.conn.cursor()
+        if periodo == 'dia':
+            cursor.execute(SQL_MARCADOR_AGENDA.format(periodo=PERIODO_DIA), (data,))
+        elif periodo == 'semana':
+            cursor.execute(SQL_MARCADOR_AGENDA.format(periodo=PERIODO_SEMANA), [data] * 4)
+        else:
+            cursor.execute(SQL_MARCADOR_AGENDA_GERAL)
+        row = cursor.fetchone()
         cursor.close()
-        return resultado
+        return (tuple(row) if row else None, date.today())
 
     def resumo_dia(self, data=None):
         """Cards resumo do dia - contagens por situacao"""
@@ -260,33 +347,29 @@ class AgendaDB:
                 a.A27HORA_INI_AGENDA,
                 p.A6COD AS PACIENTE_ID,
                 pc.A115NOME AS PACIENTE,
-                uc.A115NOME AS PROFISSIONAL,
-                (SELECT LIST(DISTINCT pr.A21ALIASES, ', ')
-                 FROM M28PROCEDIMENTO_AGENDA pa
-                 LEFT JOIN M21PROCEDIMENTO pr ON pa.A28FK21COD_PROCEDIMENTO = pr.A21COD
-                 WHERE pa.A28FK27COD_AGENDA = a.A27COD
-                 AND pr.A21ALIASES IS NOT NULL
-                ) AS PROCEDIMENTO
+                a.A27FK31COD_USUARIO,
+                a.A27COD
             FROM M27AGENDA a
             INNER JOIN M6PACIENTE p ON a.A27FK6COD_PACIENTE = p.A6COD
             INNER JOIN I115CLIENTE_FORNENCEDOR pc ON p.A6FKI115COD = pc.A115COD
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
             WHERE a.A27DATA >= CURRENT_DATE
               AND a.A27FK84COD_SITUACAO = 1
               AND a.A27FK6COD_PACIENTE IS NOT NULL
             ORDER BY a.A27DATA, a.A27HORA_INI_AGENDA
         """)
+        rows = cursor.fetchall()
+        ref = self.referencia.garantir(self.conn)
+        procedimentos = self._procedimentos_por_agenda(cursor, [row[5] for row in rows], ref)
 
         resultado = []
-        for row in cursor.fetchall():
+        for row in rows:
             resultado.append({
                 'data': row[0],
                 'hora': row[1],
                 'paciente_id': row[2],
                 'paciente': row[3],
-                'profissional': row[4],
-                'procedimento': row[5]
+                'profissional': ref.profissional(row[4]),
+                'procedimento': procedimentos.get(row[5])
             })
         cursor.close()
         return resultado
@@ -323,7 +406,15 @@ class AgendaDB:
 
     def buscar_agenda(self, data_inicio, data_fim, profissional=None, situacao=None, limite=200):
         """Buscar agenda por range de datas com filtros"""
+        return list(self.iterar_agenda(data_inicio, data_fim, profissional, situacao, limite))
+
+    def iterar_agenda(self, data_inicio, data_fim, profissional=None, situacao=None,
+                      limite=200, lote=LOTE_IN):
+        """Como buscar_agenda, mas gera as linhas aos poucos: le `lote` linhas
+        por fetchmany e resolve os procedimentos de cada lote (para streaming)"""
+        ref = self.referencia.garantir(self.conn)
         cursor = self.conn.cursor()
+        cursor_proc = self.conn.cursor()
 
         sql = f"""
             SELECT FIRST {int(limite)}
@@ -331,22 +422,13 @@ class AgendaDB:
                 a.A27HORA_INI_AGENDA,
                 p.A6COD AS PACIENTE_ID,
                 pc.A115NOME AS PACIENTE,
-                uc.A115NOME AS PROFISSIONAL,
-                s.A84NOME AS SITUACAO,
+                a.A27FK31COD_USUARIO,
                 a.A27FK84COD_SITUACAO AS SITUACAO_ID,
                 a.A27OBSERVACAO,
-                (SELECT LIST(DISTINCT pr.A21ALIASES, ', ')
-                 FROM M28PROCEDIMENTO_AGENDA pa
-                 LEFT JOIN M21PROCEDIMENTO pr ON pa.A28FK21COD_PROCEDIMENTO = pr.A21COD
-                 WHERE pa.A28FK27COD_AGENDA = a.A27COD
-                 AND pr.A21ALIASES IS NOT NULL
-                ) AS PROCEDIMENTO
+                a.A27COD
             FROM M27AGENDA a
             INNER JOIN M6PACIENTE p ON a.A27FK6COD_PACIENTE = p.A6COD
             INNER JOIN I115CLIENTE_FORNENCEDOR pc ON p.A6FKI115COD = pc.A115COD
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
-            LEFT JOIN M84SITUACAO_PROCEDIMENTO s ON a.A27FK84COD_SITUACAO = s.A84COD
             WHERE a.A27DATA BETWEEN ? AND ?
               AND a.A27FK6COD_PACIENTE IS NOT NULL
         """
@@ -362,20 +444,26 @@ class AgendaDB:
 
         sql += " ORDER BY a.A27DATA, a.A27HORA_INI_AGENDA"
 
-        cursor.execute(sql, params)
-
-        resultado = []
-        for row in cursor.fetchall():
-            resultado.append({
-                'data': row[0],
-                'hora': row[1],
-                'paciente_id': row[2],
-                'paciente': row[3],
-                'profissional': row[4],
-                'situacao': row[5],
-                'situacao_id': row[6],
-                'observacao': row[7],
-                'procedimento': row[8]
-            })
-        cursor.close()
-        return resultado
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(lote)
+                if not rows:
+                    break
+                # Cursor separado: executar no principal descartaria o resto do resultado
+                procedimentos = self._procedimentos_por_agenda(cursor_proc, [row[7] for row in rows], ref)
+                for row in rows:
+                    yield {
+                        'data': row[0],
+                        'hora': row[1],
+                        'paciente_id': row[2],
+                        'paciente': row[3],
+                        'profissional': ref.profissional(row[4]),
+                        'situacao': ref.situacao(row[5]),
+                        'situacao_id': row[5],
+                        'observacao': row[6],
+                        'procedimento': procedimentos.get(row[7])
+                    }
+        finally:
+            cursor_proc.close()
+            cursor.close()
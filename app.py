@@ -3,56 +3,163 @@ Interface web para consulta de pacientes - Medicine Dream
 Flask app com dark theme SPA
 """
 
-import json
-from decimal import Decimal
-from datetime import datetime, date, time
-from flask import Flask, jsonify, request, render_template_string, Response
-from paciente import MedicineDB, SITUACOES_AGENDA, TIPOS_DOCUMENTO, TIPOS_TELEFONE
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+import fdb
+from flask import Flask, jsonify, request, render_template_string, Response, stream_with_context
+from paciente import MedicineDB, CONFIG, POOL_CONFIG, PAGINACAO, SITUACOES_AGENDA, TIPOS_DOCUMENTO, TIPOS_TELEFONE
 from financeiro import FinanceiroDB
 from agenda import AgendaDB
+from pool import PoolConexoes, PoolEsgotado
+from busca import IndiceNomes
+from agregados import AgregadosMensais, SaldosContas
+from referencia import cache_referencia
+from paginacao import CursorInvalido
+from cache_pdf import CachePDF
+from json_util import codificar, comprimir, escolher_codificacao
 
 app = Flask(__name__)
 
-# Conexao global
-db = MedicineDB()
-db.conectar()
-
-findb = FinanceiroDB()
-findb.conectar()
-
-agdb = AgendaDB()
-agdb.conectar()
-
-
-class MedicineEncoder(json.JSONEncoder):
-    """Encoder customizado para datetime/date/time/bytes do Firebird"""
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.strftime('%d/%m/%Y %H:%M')
-        if isinstance(obj, date):
-            return obj.strftime('%d/%m/%Y')
-        if isinstance(obj, time):
-            return obj.strftime('%H:%M')
-        if isinstance(obj, Decimal):
-            return float(obj)
-        if isinstance(obj, bytes):
-            try:
-                return obj.decode('cp1252')
-            except (UnicodeDecodeError, AttributeError):
-                return obj.decode('latin-1')
-        return super().default(obj)
+# Pool de conexoes compartilhado: cada request (thread) pega uma conexao
+# no primeiro acesso ao banco e a devolve no teardown
+pool = PoolConexoes(CONFIG, **POOL_CONFIG)
+
+# Indice de nomes em memoria para a busca de pacientes (carregado na 1a busca)
+indice_nomes = IndiceNomes()
+
+# Profissionais, situacoes, procedimentos, convenios e contas ficam em memoria
+# (cache_referencia, compartilhado pelas tres classes)
+# PDFs ja vistos sao servidos da pasta cache_pdf/ (cache_pdf.py)
+db = MedicineDB(pool, indice_nomes, cache_referencia, CachePDF())
+findb = FinanceiroDB(pool, agregados=AgregadosMensais(), saldos=SaldosContas(),
+                     referencia=cache_referencia)
+agdb = AgendaDB(pool, cache_referencia)
+
+
+@app.teardown_request
+def liberar_conexoes(exc):
+    """Devolve ao pool as conexoes usadas pelo request. Se o request falhou
+    com erro do Firebird (ex: conexao caiu), a conexao e descartada."""
+    descartar = isinstance(exc, fdb.Error)
+    for banco in (db, findb, agdb):
+        banco.liberar(descartar=descartar)
 
 
 app.json_provider_class = None  # desabilitar provider padrao
 
 
 def json_response(data, status=200):
-    """Retorna JSON com encoder customizado"""
-    return Response(
-        json.dumps(data, cls=MedicineEncoder, ensure_ascii=False),
-        status=status,
-        mimetype='application/json'
-    )
+    """Retorna JSON (json_util) comprimido com gzip/brotli se o cliente aceitar"""
+    corpo, codificacao = comprimir(codificar(data), escolher_codificacao(request.accept_encodings))
+    resposta = Response(corpo, status=status, mimetype='application/json')
+    if codificacao:
+        resposta.headers['Content-Encoding'] = codificacao
+    resposta.vary.add('Accept-Encoding')
+    return resposta
+
+
+# Bytes acumulados antes de enviar cada pedaco de uma resposta em streaming
+TAMANHO_PEDACO_STREAM = 64 * 1024
+
+
+def json_stream(itens):
+    """Resposta em streaming para listas grandes: `itens` e um iteravel (ex:
+    gerador com fetchmany) codificado item a item, sem montar a lista inteira.
+    Padrao: array JSON (mesmo corpo de json_response); ?formato=ndjson: um
+    objeto por linha (application/x-ndjson)."""
+    ndjson = request.args.get('formato') == 'ndjson'
+
+    def gerar():
+        buffer = []
+        tamanho = 0
+        if not ndjson:
+            buffer.append(b'[')
+        primeiro = True
+        for item in itens:
+            texto = codificar(item)
+            if ndjson:
+                texto += b'\n'
+            elif not primeiro:
+                texto = b',' + texto
+            primeiro = False
+            buffer.append(texto)
+            tamanho += len(texto)
+            if tamanho >= TAMANHO_PEDACO_STREAM:
+                yield b''.join(buffer)
+                buffer = []
+                tamanho = 0
+        if not ndjson:
+            buffer.append(b']')
+        if buffer:
+            yield b''.join(buffer)
+
+    # stream_with_context mantem o request (e a conexao do pool) ate o fim do gerador
+    return Response(stream_with_context(gerar()),
+                    mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def resposta_paginada(itens, limite, listagem):
+    """JSON da pagina; se veio cheia, o cursor da proxima vai no header
+    X-Cursor-Proximo (repassar como ?apos=...)"""
+    resposta = json_response(itens)
+    if itens and len(itens) >= limite:
+        resposta.headers['X-Cursor-Proximo'] = PAGINACAO[listagem].cursor(itens[-1])
+    return resposta
+
+
+@app.errorhandler(CursorInvalido)
+def cursor_invalido(erro):
+    return json_response({'erro': str(erro)}, 400)
+
+
+@app.errorhandler(PoolEsgotado)
+def pool_esgotado(erro):
+    # Todas as conexoes ocupadas ate o timeout do pool: e carga, nao defeito
+    resposta = json_response({'erro': 'Servidor ocupado, tente novamente'}, 503)
+    resposta.headers['Retry-After'] = '5'
+    return resposta
+
+
+def resposta_com_etag(etag, gerar):
+    """304 se o cliente ja tem a versao `etag` (If-None-Match); senao chama
+    gerar() e devolve o JSON (ou a Response que ele montar) com o ETag. O
+    navegador revalida a cada uso. Respostas de erro e as marcadas no-store
+    (ex: prontuario parcial) nao levam ETag."""
+    if etag and request.if_none_match.contains_weak(etag):
+        resposta = Response(status=304)
+    else:
+        resposta = gerar()
+        if not isinstance(resposta, Response):
+            resposta = json_response(resposta)
+    if resposta.cache_control.no_store:
+        return resposta
+    if etag and resposta.status_code in (200, 304):
+        # Fraco: o mesmo ETag vale para o corpo com ou sem gzip/brotli
+        resposta.set_etag(etag, weak=True)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+
+# Os marcadores pegam inclusoes, exclusoes e mudancas de situacao, mas nao
+# toda edicao (o texto de uma evolucao, por exemplo): um marcador que pegasse
+# tudo teria que ler as linhas, o que o ETag quer evitar. Por isso o ETag
+# tambem muda a cada JANELA_ETAG segundos - e o maximo que uma edicao dessas
+# fica invisivel para quem ja tem a pagina. O custo e no maximo uma resposta
+# completa por cliente e rota a cada janela (o mesmo que o TTL curto dos
+# caches de resultado). 0 desliga a janela (so os marcadores).
+JANELA_ETAG = 60
+
+
+def etag_de(*marcadores):
+    """ETag da rota atual (caminho + parametros) para os valores dos marcadores"""
+    janela = int(time.time() // JANELA_ETAG) if JANELA_ETAG else 0
+    base = repr((request.path, sorted(request.args.items(multi=True)), janela) + marcadores)
+    return hashlib.sha1(base.encode('utf-8')).hexdigest()[:16]
+
+
+def etag_paciente(id_paciente, *secoes):
+    return etag_de(db.marcadores_paciente(id_paciente, secoes))
 
 
 # ==================== API ====================
@@ -65,14 +172,8 @@ def api_buscar_pacientes():
 
     # Se for numero, buscar por ID
     if q.isdigit():
-        paciente = db.buscar_paciente_por_id(int(q))
-        if paciente:
-            return json_response([{
-                'id': paciente['id'],
-                'nome': paciente['nome'],
-                'data_nascimento': paciente['data_nascimento']
-            }])
-        return json_response([])
+        paciente = db.buscar_paciente_resumo(int(q))
+        return json_response([paciente] if paciente else [])
 
     resultados = db.buscar_paciente_por_nome(q)
     return json_response(resultados)
@@ -85,12 +186,8 @@ def api_pacientes_recentes():
     return json_response(resultados)
 
 
-@app.route('/api/paciente/<int:id_paciente>')
-def api_paciente(id_paciente):
-    paciente = db.buscar_paciente_por_id(id_paciente)
-    if not paciente:
-        return json_response({'erro': 'Paciente nao encontrado'}, 404)
-
+def enriquecer_paciente(paciente):
+    """Nomes legiveis dos documentos (CPF formatado) e tipos de telefone"""
     # Enriquecer documentos com nomes legiveis
     docs_formatados = {}
     for tipo, valor in paciente.get('documentos', {}).items():
@@ -108,79 +205,311 @@ def api_paciente(id_paciente):
     # Enriquecer telefones com nomes de tipo
     for tel in paciente.get('telefones', []):
         tel['tipo_nome'] = TIPOS_TELEFONE.get(str(tel.get('tipo', '')), '') if tel.get('tipo') else ''
+    return paciente
+
 
-    return json_response(paciente)
+def enriquecer_consultas(consultas):
+    """Nome da situacao de cada consulta"""
+    for c in consultas:
+        c['situacao_nome'] = SITUACOES_AGENDA.get(c['situacao'], str(c['situacao']))
+    return consultas
+
+
+@app.route('/api/paciente/<int:id_paciente>')
+def api_paciente(id_paciente):
+    paciente = db.buscar_paciente_por_id(id_paciente)
+    if not paciente:
+        return json_response({'erro': 'Paciente nao encontrado'}, 404)
+    return json_response(enriquecer_paciente(paciente))
 
 
 @app.route('/api/paciente/<int:id_paciente>/consultas')
 def api_consultas(id_paciente):
     limite = request.args.get('limite', 30, type=int)
-    consultas = db.buscar_consultas(id_paciente, limite)
-    # Enriquecer com nome da situacao
-    for c in consultas:
-        c['situacao_nome'] = SITUACOES_AGENDA.get(c['situacao'], str(c['situacao']))
-    return json_response(consultas)
+    return resposta_com_etag(etag_paciente(id_paciente, 'consultas'), lambda: resposta_paginada(
+        enriquecer_consultas(db.buscar_consultas(id_paciente, limite, request.args.get('apos'))),
+        limite, 'consultas'))
 
 
 @app.route('/api/paciente/<int:id_paciente>/evolucoes')
 def api_evolucoes(id_paciente):
     limite = request.args.get('limite', 30, type=int)
-    evolucoes = db.buscar_evolucoes(id_paciente, limite)
-    return json_response(evolucoes)
+    return resposta_com_etag(etag_paciente(id_paciente, 'evolucoes'), lambda: resposta_paginada(
+        db.buscar_evolucoes(id_paciente, limite, request.args.get('apos')), limite, 'evolucoes'))
 
 
 @app.route('/api/paciente/<int:id_paciente>/preconsultas')
 def api_preconsultas(id_paciente):
     limite = request.args.get('limite', 30, type=int)
-    preconsultas = db.buscar_preconsultas(id_paciente, limite)
-    return json_response(preconsultas)
+    return resposta_com_etag(etag_paciente(id_paciente, 'preconsultas'),
+                             lambda: db.buscar_preconsultas(id_paciente, limite))
 
 
 @app.route('/api/paciente/<int:id_paciente>/receitas')
 def api_receitas(id_paciente):
     limite = request.args.get('limite', 30, type=int)
-    receitas = db.buscar_receitas(id_paciente, limite)
-    return json_response(receitas)
+    return resposta_com_etag(etag_paciente(id_paciente, 'receitas'), lambda: resposta_paginada(
+        db.buscar_receitas(id_paciente, limite, request.args.get('apos')), limite, 'receitas'))
 
 
 @app.route('/api/paciente/<int:id_paciente>/documentos')
 def api_documentos(id_paciente):
     limite = request.args.get('limite', 30, type=int)
-    documentos = db.buscar_documentos(id_paciente, limite)
-    return json_response(documentos)
+    return resposta_com_etag(etag_paciente(id_paciente, 'documentos'), lambda: resposta_paginada(
+        db.buscar_documentos(id_paciente, limite, request.args.get('apos')), limite, 'documentos'))
 
 
 @app.route('/api/paciente/<int:id_paciente>/procedimentos')
 def api_procedimentos(id_paciente):
     limite = request.args.get('limite', 100, type=int)
-    procedimentos = db.buscar_procedimentos(id_paciente, limite)
-    return json_response(procedimentos)
+    return resposta_com_etag(etag_paciente(id_paciente, 'procedimentos'), lambda: resposta_paginada(
+        db.buscar_procedimentos(id_paciente, limite, request.args.get('apos')), limite, 'procedimentos'))
 
 
 @app.route('/api/paciente/<int:id_paciente>/financeiro')
 def api_financeiro(id_paciente):
     limite = request.args.get('limite', 50, type=int)
-    lancamentos = db.buscar_lancamentos(id_paciente, limite)
-    return json_response(lancamentos)
+    return resposta_com_etag(etag_paciente(id_paciente, 'financeiro'), lambda: resposta_paginada(
+        db.buscar_lancamentos(id_paciente, limite, request.args.get('apos')), limite, 'financeiro'))
 
 
 @app.route('/api/paciente/<int:id_paciente>/pdfs')
 def api_pdfs(id_paciente):
     limite = request.args.get('limite', 50, type=int)
-    pdfs = db.buscar_pdfs(id_paciente, limite)
-    return json_response(pdfs)
+    apos = request.args.get('apos')
+
+    def gerar():
+        pdfs = db.buscar_pdfs(id_paciente, limite, apos)
+        if not apos:
+            # Os mais recentes sao os que costumam ser abertos em seguida
+            db.pre_carregar_pdfs(pdfs)
+        return resposta_paginada(pdfs, limite, 'pdfs')
+    return resposta_com_etag(etag_paciente(id_paciente, 'pdfs'), gerar)
+
+
+# ==================== PRONTUARIO (todas as abas em um request) ====================
+
+# secao -> (limite padrao, funcao(id_paciente, limite)); as secoes paginadas
+# tem o mesmo nome da listagem em PAGINACAO
+SECOES_PRONTUARIO = {
+    'paciente': (None, lambda id_paciente, limite: db.buscar_paciente_por_id(id_paciente)),
+    'consultas': (30, lambda id_paciente, limite: enriquecer_consultas(db.buscar_consultas(id_paciente, limite))),
+    'evolucoes': (30, lambda id_paciente, limite: db.buscar_evolucoes(id_paciente, limite)),
+    'preconsultas': (30, lambda id_paciente, limite: db.buscar_preconsultas(id_paciente, limite)),
+    'receitas': (30, lambda id_paciente, limite: db.buscar_receitas(id_paciente, limite)),
+    'documentos': (30, lambda id_paciente, limite: db.buscar_documentos(id_paciente, limite)),
+    'procedimentos': (100, lambda id_paciente, limite: db.buscar_procedimentos(id_paciente, limite)),
+    'financeiro': (50, lambda id_paciente, limite: db.buscar_lancamentos(id_paciente, limite)),
+    'pdfs': (50, lambda id_paciente, limite: db.buscar_pdfs(id_paciente, limite)),
+}
+
+# Secoes de prontuarios consultadas ao mesmo tempo (somando todos os requests);
+# cada uma usa uma conexao do pool alem das threads de request: entram na
+# conta de POOL_CONFIG['maximo'] (e o asgi.py as desconta dos limites por rota)
+PRONTUARIO_THREADS = 6
+_executor_prontuario = None
+
+
+def executor_prontuario():
+    # Criado no primeiro uso: com servidor.py, ja dentro do worker (apos o fork)
+    global _executor_prontuario
+    if _executor_prontuario is None:
+        _executor_prontuario = ThreadPoolExecutor(PRONTUARIO_THREADS, thread_name_prefix='prontuario')
+    return _executor_prontuario
+
+
+def _carregar_secao(funcao, id_paciente, limite):
+    """Roda uma secao em thread do executor, com conexao propria do pool"""
+    try:
+        return funcao(id_paciente, limite)
+    except fdb.Error:
+        db.liberar(descartar=True)
+        raise
+    finally:
+        db.liberar()
+
+
+@app.route('/api/paciente/<int:id_paciente>/prontuario')
+def api_prontuario(id_paciente):
+    """Prontuario inteiro (ou ?secoes=consultas,pdfs,...) em uma resposta:
+    as secoes sao consultadas em paralelo. Secoes paginadas cheias trazem o
+    cursor da proxima pagina em `cursores`."""
+    pedidas = request.args.get('secoes')
+    secoes = [s.strip() for s in pedidas.split(',') if s.strip()] if pedidas else list(SECOES_PRONTUARIO)
+    desconhecidas = [s for s in secoes if s not in SECOES_PRONTUARIO]
+    if desconhecidas:
+        return json_response({'erro': f"Secoes desconhecidas: {', '.join(desconhecidas)}"}, 400)
+    limite = request.args.get('limite', type=int)
+
+    # Identificacao nao tem marcador barato, mas e leve: entra no ETag inteira
+    paciente = None
+    if 'paciente' in secoes:
+        paciente = db.buscar_paciente_por_id(id_paciente)
+        if not paciente:
+            return json_response({'erro': 'Paciente nao encontrado'}, 404)
+    etag = etag_de(db.marcadores_paciente(id_paciente, secoes), repr(paciente))
+    return resposta_com_etag(etag, lambda: _montar_prontuario(id_paciente, secoes, limite, paciente))
+
+
+def _montar_prontuario(id_paciente, secoes, limite, paciente):
+    # A thread do request nao segura conexao enquanto espera as secoes
+    db.liberar()
+    executor = executor_prontuario()
+    futuros = {}
+    for secao in dict.fromkeys(secoes):
+        if secao == 'paciente':
+            continue
+        padrao, funcao = SECOES_PRONTUARIO[secao]
+        futuros[secao] = (limite or padrao, executor.submit(_carregar_secao, funcao, id_paciente, limite or padrao))
+
+    resultado = {}
+    if paciente is not None:
+        resultado['paciente'] = enriquecer_paciente(paciente)
+    cursores = {}
+    erros = {}
+    for secao, (limite_secao, futuro) in futuros.items():
+        try:
+            itens = futuro.result()
+        except Exception as e:
+            erros[secao] = str(e)
+            continue
+        if secao == 'pdfs':
+            db.pre_carregar_pdfs(itens)
+        if secao in PAGINACAO and itens and len(itens) >= limite_secao:
+            cursores[secao] = PAGINACAO[secao].cursor(itens[-1])
+        resultado[secao] = itens
+
+    resultado['cursores'] = cursores
+    if not erros:
+        return json_response(resultado)
+    # Resposta parcial (secao -> mensagem em `erros`): sem ETag e fora de
+    # qualquer cache, para o proximo pedido tentar de novo
+    resultado['erros'] = erros
+    resposta = json_response(resultado)
+    resposta.cache_control.no_store = True
+    return resposta
+
+
+@app.route('/api/paciente/<int:id_paciente>/pdfs/zip')
+def api_pdfs_zip(id_paciente):
+    try:
+        partes = db.exportar_pdfs_zip(id_paciente)
+    except Exception as e:
+        return json_response({'erro': str(e)}, 500)
+    if partes is None:
+        return json_response({'erro': 'Paciente sem PDFs'}, 404)
+    resposta = Response(partes, mimetype='application/zip', direct_passthrough=True)
+    resposta.headers['Content-Disposition'] = f'attachment; filename="paciente_{id_paciente}_pdfs.zip"'
+    return resposta
+
+
+# PDFs nunca mudam depois de gravados: o navegador guarda sem revalidar
+CACHE_CONTROL_PDF = 'private, max-age=31536000, immutable'
+
+
+def _faixa_pedida(tamanho):
+    """(inicio, fim, status) conforme o header Range; None se a faixa nao couber"""
+    faixa = request.range
+    if faixa is None:
+        return 0, tamanho, 200
+    limites = faixa.range_for_length(tamanho)
+    if limites is None:
+        return None
+    return limites[0], limites[1], 206
+
+
+def _resposta_pdf(corpo, faixa, tamanho, ao_fechar, etag=None):
+    inicio, fim, status = faixa
+    resposta = Response(corpo, status=status, mimetype='application/pdf',
+                        direct_passthrough=True)
+    resposta.headers['Content-Disposition'] = 'inline'
+    resposta.headers['Accept-Ranges'] = 'bytes'
+    resposta.headers['Content-Length'] = str(fim - inicio)
+    resposta.headers['Cache-Control'] = CACHE_CONTROL_PDF
+    if status == 206:
+        resposta.headers['Content-Range'] = f'bytes {inicio}-{fim - 1}/{tamanho}'
+    if etag:
+        resposta.set_etag(etag)
+    # Se o corpo nao for lido (HEAD, cliente desconectou), libera o que estiver aberto
+    resposta.call_on_close(ao_fechar)
+    return resposta
+
+
+def _faixa_invalida(tamanho):
+    return Response(status=416, headers={'Content-Range': f'bytes */{tamanho}'})
+
+
+def _gravando_no_cache(pedacos, gravacao, tamanho):
+    """Repassa os pedacos ao cliente gravando no cache; so publica se o PDF
+    chegou inteiro. Erro de disco nao interrompe o envio."""
+    try:
+        for dados in pedacos:
+            if gravacao is not None:
+                try:
+                    gravacao.escrever(dados)
+                except OSError:
+                    gravacao.descartar()
+                    gravacao = None
+            yield dados
+        if gravacao is not None and gravacao.tamanho == tamanho:
+            try:
+                gravacao.concluir()
+            except OSError:
+                pass
+    finally:
+        # Cliente desconectou no meio: apaga o temporario
+        if gravacao is not None:
+            gravacao.descartar()
 
 
 @app.route('/api/pdf/<int:blob_id>')
 def api_pdf_blob(blob_id):
+    cache_pdf = db.cache_pdf
+    leitura = cache_pdf.abrir(blob_id) if cache_pdf is not None else None
+    if leitura is not None:
+        if leitura.etag in request.if_none_match:
+            leitura.fechar()
+            resposta = Response(status=304)
+            resposta.set_etag(leitura.etag)
+            resposta.headers['Cache-Control'] = CACHE_CONTROL_PDF
+            return resposta
+        faixa = _faixa_pedida(leitura.tamanho)
+        if faixa is None:
+            leitura.fechar()
+            return _faixa_invalida(leitura.tamanho)
+        return _resposta_pdf(leitura.ler(faixa[0], faixa[1]), faixa, leitura.tamanho,
+                             leitura.fechar, leitura.etag)
+
     try:
-        pdf_bytes = db.buscar_blob_pdf(blob_id)
-        if pdf_bytes:
-            return Response(pdf_bytes, mimetype='application/pdf',
-                            headers={'Content-Disposition': 'inline'})
-        return json_response({'erro': 'PDF nao encontrado'}, 404)
+        pdf = db.abrir_blob_pdf(blob_id)
+    except PoolEsgotado:
+        raise
     except Exception as e:
         return json_response({'erro': str(e)}, 500)
+    if pdf is None or not pdf.tamanho:
+        if pdf is not None:
+            pdf.fechar()
+        return json_response({'erro': 'PDF nao encontrado'}, 404)
+
+    # Range de bytes (o visualizador de PDF do navegador pede pedacos ao navegar)
+    faixa = _faixa_pedida(pdf.tamanho)
+    if faixa is None:
+        pdf.fechar()
+        return _faixa_invalida(pdf.tamanho)
+
+    corpo = pdf.ler(faixa[0], faixa[1])
+    if cache_pdf is None or faixa[2] != 200:
+        return _resposta_pdf(corpo, faixa, pdf.tamanho, pdf.fechar)
+
+    # PDF inteiro vindo do shard: grava no cache enquanto envia
+    gravacao = cache_pdf.gravacao(blob_id)
+
+    def fechar():
+        pdf.fechar()
+        gravacao.descartar()
+
+    return _resposta_pdf(_gravando_no_cache(corpo, gravacao, pdf.tamanho), faixa,
+                         pdf.tamanho, fechar)
 
 
 # ==================== INTERFACE ====================
@@ -602,6 +931,36 @@ body {
     transition: border-color 0.2s;
 }
 
+.pdf-zip {
+    padding: 8px 12px;
+    font-size: 12px;
+    color: var(--accent);
+    text-decoration: none;
+    text-align: center;
+    border: 1px dashed var(--border);
+    border-radius: 6px;
+}
+
+.pdf-zip:hover {
+    border-color: var(--accent);
+}
+
+.load-more {
+    display: block;
+    margin: 16px auto 0;
+    padding: 8px 20px;
+    font-size: 13px;
+    color: var(--accent);
+    background: transparent;
+    border: 1px dashed var(--border);
+    border-radius: 6px;
+    cursor: pointer;
+}
+
+.load-more:hover {
+    border-color: var(--accent);
+}
+
 .pdf-item:hover {
     border-color: var(--accent);
 }
@@ -692,7 +1051,8 @@ body {
 const state = {
     currentPatient: null,
     currentTab: 'identificacao',
-    tabCache: {}
+    tabCache: {},
+    cursors: {}     // aba -> cursor da proxima pagina (X-Cursor-Proximo)
 };
 
 // ==================== UTILS ====================
@@ -702,6 +1062,12 @@ async function fetchJSON(url) {
     return res.json();
 }
 
+// JSON e cursor da proxima pagina (null se a lista acabou)
+async function fetchPage(url) {
+    const res = await fetch(url);
+    return { data: await res.json(), cursor: res.headers.get('X-Cursor-Proximo') };
+}
+
 function esc(str) {
     if (!str) return '';
     const d = document.createElement('div');
@@ -758,17 +1124,25 @@ function renderPatientList(patients) {
 
 async function selectPatient(id) {
     state.tabCache = {};
+    state.cursors = {};
     state.currentTab = 'identificacao';
 
     document.getElementById('mainContent').innerHTML = '<div class="loading">Carregando</div>';
 
-    const paciente = await fetchJSON('/api/paciente/' + id);
-    if (paciente.erro) {
-        document.getElementById('mainContent').innerHTML = '<div class="no-data">' + esc(paciente.erro) + '</div>';
+    // Identificacao e todas as abas em um so request
+    const prontuario = await fetchJSON('/api/paciente/' + id + '/prontuario');
+    if (prontuario.erro) {
+        document.getElementById('mainContent').innerHTML = '<div class="no-data">' + esc(prontuario.erro) + '</div>';
         return;
     }
 
-    state.currentPatient = paciente;
+    state.currentPatient = prontuario.paciente;
+    state.cursors = prontuario.cursores || {};
+    Object.keys(prontuario).forEach(secao => {
+        if (secao !== 'paciente' && secao !== 'cursores' && secao !== 'erros') {
+            state.tabCache[secao] = prontuario[secao];
+        }
+    });
 
     // Atualizar sidebar ativa
     document.querySelectorAll('.patient-item').forEach(el => {
@@ -845,9 +1219,26 @@ async function loadTab(tab) {
     container.innerHTML = '<div class="loading">Carregando</div>';
 
     const url = '/api/paciente/' + p.id + '/' + tab;
-    const data = await fetchJSON(url);
-    state.tabCache[tab] = data;
-    renderTabData(container, tab, data);
+    const page = await fetchPage(url);
+    state.tabCache[tab] = page.data;
+    state.cursors[tab] = page.cursor;
+    renderTabData(container, tab, page.data);
+}
+
+async function loadMore(tab) {
+    const p = state.currentPatient;
+    const cursor = state.cursors[tab];
+    if (!cursor) return;
+    const button = document.querySelector('.load-more');
+    if (button) { button.disabled = true; button.textContent = 'Carregando...'; }
+
+    const page = await fetchPage('/api/paciente/' + p.id + '/' + tab + '?apos=' + encodeURIComponent(cursor));
+    if (!Array.isArray(page.data) || state.currentPatient !== p) return;
+    state.tabCache[tab] = state.tabCache[tab].concat(page.data);
+    state.cursors[tab] = page.cursor;
+    if (state.currentTab === tab) {
+        renderTabData(document.getElementById('tabContent'), tab, state.tabCache[tab]);
+    }
 }
 
 // ==================== TAB RENDERERS ====================
@@ -946,6 +1337,10 @@ function renderTabData(container, tab, data) {
     if (renderers[tab]) {
         renderers[tab](container, data);
     }
+    if (state.cursors[tab]) {
+        container.insertAdjacentHTML('beforeend',
+            '<button class="load-more" data-tab="' + tab + '" onclick="loadMore(this.dataset.tab)">Carregar mais</button>');
+    }
 }
 
 function renderConsultas(container, data) {
@@ -1173,6 +1568,9 @@ function renderPDFs(container, data) {
     let html = '<div class="tab-content"><div class="pdf-container">';
 
     html += '<div class="pdf-list">';
+    if (data.length) {
+        html += '<a class="pdf-zip" href="/api/paciente/' + state.currentPatient.id + '/pdfs/zip">Baixar todos (ZIP)</a>';
+    }
     data.forEach((p, i) => {
         html += '<div class="pdf-item" onclick="viewPDF(' + p.blob_id + ', this)" data-blob="' + p.blob_id + '">';
         html += '<div class="pdf-name">' + esc(p.nome || 'Documento ' + (i + 1)) + '</div>';
@@ -1230,49 +1628,57 @@ def index():
 
 # ==================== FINANCEIRO - API ====================
 
+def etag_financeiro():
+    # Mesmo marcador do cache do dashboard (MAX(A106COD), pendentes e hoje),
+    # consultado no maximo a cada CacheResultados.intervalo_marcador segundos
+    if findb.cache is not None:
+        return etag_de(findb.cache.marcador('marcador_lancamentos', findb.marcador_lancamentos))
+    return etag_de(findb.marcador_lancamentos())
+
+
 @app.route('/api/financeiro/resumo-mensal')
 def api_fin_resumo_mensal():
     meses = request.args.get('meses', 12, type=int)
-    return json_response(findb.resumo_mensal(meses))
+    return resposta_com_etag(etag_financeiro(), lambda: findb.resumo_mensal(meses))
 
 
 @app.route('/api/financeiro/saldo-contas')
 def api_fin_saldo_contas():
-    return json_response(findb.saldo_contas())
+    return resposta_com_etag(etag_financeiro(), findb.saldo_contas)
 
 
 @app.route('/api/financeiro/fluxo-diario')
 def api_fin_fluxo_diario():
     dias = request.args.get('dias', 30, type=int)
-    return json_response(findb.fluxo_diario(dias))
+    return resposta_com_etag(etag_financeiro(), lambda: findb.fluxo_diario(dias))
 
 
 @app.route('/api/financeiro/pendentes')
 def api_fin_pendentes():
-    return json_response(findb.lancamentos_pendentes())
+    return resposta_com_etag(etag_financeiro(), lambda: json_stream(findb.iterar_lancamentos_pendentes()))
 
 
 @app.route('/api/financeiro/recorrentes')
 def api_fin_recorrentes():
-    return json_response(findb.despesas_recorrentes())
+    return resposta_com_etag(etag_de(findb.marcador_ciclicos()), findb.despesas_recorrentes)
 
 
 @app.route('/api/financeiro/lancamentos')
 def api_fin_lancamentos():
     limite = request.args.get('limite', 50, type=int)
-    return json_response(findb.lancamentos_recentes(limite))
+    return resposta_com_etag(etag_financeiro(), lambda: findb.lancamentos_recentes(limite))
 
 
 @app.route('/api/financeiro/top-clientes')
 def api_fin_top_clientes():
     meses = request.args.get('meses', 12, type=int)
-    return json_response(findb.top_clientes(meses))
+    return resposta_com_etag(etag_financeiro(), lambda: findb.top_clientes(meses))
 
 
 @app.route('/api/financeiro/top-despesas')
 def api_fin_top_despesas():
     meses = request.args.get('meses', 12, type=int)
-    return json_response(findb.top_despesas(meses))
+    return resposta_com_etag(etag_financeiro(), lambda: findb.top_despesas(meses))
 
 
 # ==================== FINANCEIRO - PAGINA ====================
@@ -2132,43 +2538,43 @@ def financeiro():
 def api_agenda_dia():
     data = request.args.get('data', None)
     prof = request.args.get('prof', None, type=int)
-    return json_response(agdb.agenda_dia(data, prof))
+    return resposta_com_etag(etag_de(agdb.marcador('dia', data)), lambda: agdb.agenda_dia(data, prof))
 
 
 @app.route('/api/agenda/profissionais')
 def api_agenda_profissionais():
-    return json_response(agdb.profissionais())
+    return resposta_com_etag(agdb.profissionais_etag(), agdb.profissionais)
 
 
 @app.route('/api/agenda/resumo')
 def api_agenda_resumo():
     data = request.args.get('data', None)
-    return json_response(agdb.resumo_dia(data))
+    return resposta_com_etag(etag_de(agdb.marcador('dia', data)), lambda: agdb.resumo_dia(data))
 
 
 @app.route('/api/agenda/estatisticas')
 def api_agenda_estatisticas():
     meses = request.args.get('meses', 6, type=int)
-    return json_response(agdb.estatisticas_mensal(meses))
+    return resposta_com_etag(etag_de(agdb.marcador()), lambda: agdb.estatisticas_mensal(meses))
 
 
 @app.route('/api/agenda/proximos')
 def api_agenda_proximos():
     limite = request.args.get('limite', 20, type=int)
-    return json_response(agdb.proximos_agendados(limite))
+    return resposta_com_etag(etag_de(agdb.marcador()), lambda: agdb.proximos_agendados(limite))
 
 
 @app.route('/api/agenda/tempo-espera')
 def api_agenda_tempo_espera():
     dias = request.args.get('dias', 30, type=int)
-    return json_response(agdb.tempo_espera_medio(dias))
+    return resposta_com_etag(etag_de(agdb.marcador()), lambda: agdb.tempo_espera_medio(dias))
 
 
 @app.route('/api/agenda/semana')
 def api_agenda_semana():
     data = request.args.get('data', None)
     prof = request.args.get('prof', None, type=int)
-    return json_response(agdb.agenda_semana(data, prof))
+    return resposta_com_etag(etag_de(agdb.marcador('semana', data)), lambda: agdb.agenda_semana(data, prof))
 
 
 @app.route('/api/agenda/buscar')
@@ -2180,7 +2586,7 @@ def api_agenda_buscar():
     prof = request.args.get('prof', None, type=int)
     sit = request.args.get('sit', None, type=int)
     limite = request.args.get('limite', 200, type=int)
-    return json_response(agdb.buscar_agenda(inicio, fim, prof, sit, limite))
+    return json_stream(agdb.iterar_agenda(inicio, fim, prof, sit, limite))
 
 
 # ==================== AGENDA - PAGINA ====================
@@ -3493,4 +3899,7 @@ if __name__ == '__main__':
     print("Acesse: http://localhost:5000")
     print("Agenda: http://localhost:5000/agenda")
     print("Financeiro: http://localhost:5000/financeiro")
+    pool.aquecer()
+    with pool.conexao() as conn:
+        cache_referencia.carregar(conn)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,335 @@
+"""
+Ponto de entrada ASGI da interface web - Medicine Dream
+
+Serve as mesmas rotas do app.py (Flask/WSGI) num servidor ASGI:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+O fdb e bloqueante, entao cada request roda inteiro (handler + corpo em
+streaming + teardown) em uma thread de um executor limitado: a conexao do
+pool continua presa a uma thread so, como no Flask. O que fica no event loop
+e a espera: limites de concorrencia por prefixo de rota sao semaforos do
+asyncio, entao centenas de clientes aguardando o dashboard nao viram centenas
+de threads. Quem espera mais que ESPERA_MAXIMA recebe 503. Os limites saem do
+tamanho do pool (POOL_CONFIG), para que um request admitido nao fique
+esperando conexao.
+
+A ponte e propria (e nao a2wsgi/asgiref) para que handler, corpo e teardown
+rodem na mesma thread do executor - a conexao emprestada pelo pool e por
+thread - e para os limites por rota ficarem antes de ocupar uma thread.
+"""
+
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as TempoEsgotado
+
+from app import app as app_wsgi, pool, cache_referencia, PRONTUARIO_THREADS
+from paciente import fechar_pools_blob, POOL_CONFIG, BLOB_POOL_CONFIG
+
+# Parte de cada prefixo de rota (o mais longo que casar vale) nas conexoes do
+# pool principal; None e o padrao para as demais rotas (paginas HTML, etc.)
+PESOS_ROTA = {
+    '/api/financeiro/': 2,
+    '/api/agenda/': 3,
+    '/api/paciente/': 4,
+    '/api/pacientes/': 2,
+    None: 3,
+}
+
+# /api/pdf/ le dos shards de blob (BLOB_POOL_CONFIG), nao do pool principal
+ROTA_PDF = '/api/pdf/'
+
+
+def limites_rota(conexoes, pesos=PESOS_ROTA, pdf=BLOB_POOL_CONFIG['maximo']):
+    """Requests simultaneos por prefixo de rota. Cada request segura no maximo
+    uma conexao do pool principal, entao os limites das rotas de `pesos`
+    somam `conexoes` (repartidas pelos pesos, no minimo 1 cada); /api/pdf/
+    fica no maximo de um pool de shard."""
+    if conexoes < len(pesos):
+        raise ValueError(f'{conexoes} conexoes nao bastam para {len(pesos)} rotas: '
+                         "aumente POOL_CONFIG['maximo']")
+    total = sum(pesos.values())
+    limites = {prefixo: max(1, conexoes * peso // total) for prefixo, peso in pesos.items()}
+    sobra = conexoes - sum(limites.values())
+    for prefixo in sorted(pesos, key=pesos.get, reverse=True)[:max(sobra, 0)]:
+        limites[prefixo] += 1
+    limites[ROTA_PDF] = pdf
+    return limites
+
+
+# Conexoes do pool para as threads de request: o executor do prontuario
+# (app.py) pode segurar PRONTUARIO_THREADS ao mesmo tempo
+CONEXOES_REQUESTS = POOL_CONFIG['maximo'] - PRONTUARIO_THREADS
+
+LIMITES_ROTA = limites_rota(CONEXOES_REQUESTS)
+
+# Threads que executam o Flask (e o fdb): uma por request admitido
+ASGI_THREADS = sum(LIMITES_ROTA.values())
+
+# Segundos aguardando vaga no limite da rota antes de responder 503
+ESPERA_MAXIMA = 30
+
+# Pedacos do corpo em transito entre a thread do request e o event loop
+FILA_CORPO = 8
+
+# Segundos entre verificacoes de desconexao enquanto a thread espera vaga na
+# fila do corpo (cliente lento)
+ESPERA_FILA = 1
+
+
+class _ClienteDesconectado(Exception):
+    """O cliente saiu e ninguem mais consome a fila do corpo"""
+
+
+class AdaptadorASGI:
+    """Executa uma aplicacao WSGI sob ASGI (HTTP e lifespan)"""
+
+    def __init__(self, wsgi, threads=ASGI_THREADS, limites=LIMITES_ROTA):
+        self.wsgi = wsgi
+        self.threads = threads
+        self.limites = limites
+        self._executor = None
+        self._semaforos = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='asgi')
+        return self._executor
+
+    def _semaforo(self, caminho):
+        # Criados no primeiro request, dentro do event loop do servidor
+        if self._semaforos is None:
+            self._semaforos = {prefixo: asyncio.Semaphore(n) for prefixo, n in self.limites.items()}
+        melhor = None
+        for prefixo in self._semaforos:
+            if prefixo and caminho.startswith(prefixo) and (melhor is None or len(prefixo) > len(melhor)):
+                melhor = prefixo
+        return self._semaforos[melhor]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    # ==================== LIFESPAN ====================
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'lifespan.startup':
+                try:
+                    await loop.run_in_executor(self.executor, iniciar)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensagem['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+                    self._executor = None
+                encerrar()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # ==================== HTTP ====================
+
+    async def _http(self, scope, receive, send):
+        corpo = io.BytesIO()
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'http.disconnect':
+                return
+            corpo.write(mensagem.get('body', b''))
+            if not mensagem.get('more_body'):
+                break
+        corpo.seek(0)
+
+        semaforo = self._semaforo(scope['path'])
+        try:
+            await asyncio.wait_for(semaforo.acquire(), ESPERA_MAXIMA)
+        except asyncio.TimeoutError:
+            await _enviar_ocupado(send)
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+            fila = asyncio.Queue(FILA_CORPO)
+            desconectado = threading.Event()
+            vigia = asyncio.ensure_future(_vigiar_desconexao(receive, desconectado))
+            tarefa = loop.run_in_executor(
+                self.executor, self._executar, montar_environ(scope, corpo), fila, loop, desconectado)
+            try:
+                await self._responder(fila, send, desconectado)
+            except BaseException:
+                # A fila deixa de ser drenada: a thread desiste em ESPERA_FILA s
+                desconectado.set()
+                raise
+            finally:
+                vigia.cancel()
+                await tarefa
+        finally:
+            semaforo.release()
+
+    async def _responder(self, fila, send, desconectado):
+        """Repassa ao cliente o que a thread do request coloca na fila"""
+        while True:
+            tipo, valor = await fila.get()
+            if tipo == 'fim':
+                if not desconectado.is_set():
+                    await send({'type': 'http.response.body', 'body': b''})
+                return
+            if desconectado.is_set():
+                continue   # so drena a fila ate a thread perceber e parar
+            try:
+                if tipo == 'inicio':
+                    status, cabecalhos = valor
+                    await send({
+                        'type': 'http.response.start',
+                        'status': int(status.split(' ', 1)[0]),
+                        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                    for k, v in cabecalhos],
+                    })
+                else:
+                    await send({'type': 'http.response.body', 'body': valor, 'more_body': True})
+            except OSError:
+                desconectado.set()
+
+    def _executar(self, environ, fila, loop, desconectado):
+        """Thread do executor: chama o Flask e itera o corpo da resposta"""
+        def colocar(item):
+            # Bloqueia a thread enquanto a fila estiver cheia (cliente lento),
+            # mas desiste se o cliente desconectou e a fila parou de andar
+            futuro = asyncio.run_coroutine_threadsafe(fila.put(item), loop)
+            while True:
+                try:
+                    return futuro.result(ESPERA_FILA)
+                except TempoEsgotado:
+                    if desconectado.is_set():
+                        futuro.cancel()
+                        raise _ClienteDesconectado()
+
+        resposta = {}
+        enviado = []
+
+        def start_response(status, cabecalhos, exc_info=None):
+            if exc_info and enviado:
+                raise exc_info[1].with_traceback(exc_info[2])
+            resposta['inicio'] = (status, cabecalhos)
+            return escrever
+
+        def escrever(dados):
+            if not enviado:
+                colocar(('inicio', resposta['inicio']))
+                enviado.append(True)
+            if dados:
+                colocar(('dados', bytes(dados)))
+
+        try:
+            corpo = self.wsgi(environ, start_response)
+            try:
+                for dados in corpo:
+                    escrever(dados)
+                    if desconectado.is_set():
+                        break
+                if not enviado:
+                    escrever(b'')
+            finally:
+                if hasattr(corpo, 'close'):
+                    corpo.close()
+        except _ClienteDesconectado:
+            return
+        except Exception:
+            self.wsgi.logger.exception("Erro no request %s", environ.get('PATH_INFO'))
+            try:
+                if not enviado:
+                    colocar(('inicio', ('500 INTERNAL SERVER ERROR', [('Content-Type', 'text/plain')])))
+                    colocar(('dados', b'Erro interno'))
+            except _ClienteDesconectado:
+                return
+        try:
+            colocar(('fim', None))
+        except _ClienteDesconectado:
+            pass
+
+
+async def _vigiar_desconexao(receive, desconectado):
+    while True:
+        mensagem = await receive()
+        if mensagem['type'] == 'http.disconnect':
+            desconectado.set()
+            return
+
+
+async def _enviar_ocupado(send):
+    corpo = b'{"erro": "Servidor ocupado, tente novamente"}'
+    await send({
+        'type': 'http.response.start',
+        'status': 503,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(corpo)).encode()),
+                    (b'retry-after', b'5')],
+    })
+    await send({'type': 'http.response.body', 'body': corpo})
+
+
+def montar_environ(scope, corpo):
+    """environ WSGI (PEP 3333) a partir do scope HTTP do ASGI"""
+    servidor = scope.get('server') or ('localhost', 80)
+    cliente = scope.get('client') or ('', 0)
+    caminho = scope.get('raw_path')
+    caminho = caminho.split(b'?', 1)[0].decode('latin-1') if caminho else \
+        scope['path'].encode('utf-8').decode('latin-1')
+    raiz = scope.get('root_path', '')
+    if raiz and caminho.startswith(raiz):
+        caminho = caminho[len(raiz):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': raiz,
+        'PATH_INFO': caminho,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': servidor[0],
+        'SERVER_PORT': str(servidor[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': cliente[0],
+        'REMOTE_PORT': str(cliente[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': corpo,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for nome, valor in scope.get('headers', []):
+        nome = nome.decode('latin-1').upper().replace('-', '_')
+        valor = valor.decode('latin-1')
+        if nome in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[nome] = valor
+            continue
+        chave = f'HTTP_{nome}'
+        if chave in environ:
+            # Cookies repetidos se juntam com '; ' (RFC 6265); os demais com ','
+            separador = '; ' if chave == 'HTTP_COOKIE' else ','
+            valor = f'{environ[chave]}{separador}{valor}'
+        environ[chave] = valor
+    return environ
+
+
+def iniciar():
+    """Abre as conexoes minimas e carrega as tabelas de referencia"""
+    pool.aquecer()
+    with pool.conexao() as conn:
+        cache_referencia.carregar(conn)
+
+
+def encerrar():
+    pool.fechar()
+    fechar_pools_blob()
+
+
+app = AdaptadorASGI(app_wsgi)
@@ -0,0 +1,102 @@
+"""
+Benchmark da busca de pacientes por nome (busca.IndiceNomes) - Medicine Dream
+
+Monta um indice com nomes sinteticos no formato do cadastro (dois prenomes e
+dois sobrenomes, os comuns bem mais frequentes) e mede cada tipo de busca:
+prefixos de 3 letras (a primeira consulta da caixa de busca), nomes
+completos, erros de digitacao, trechos curtos e buscas mistas. Nao usa o
+banco.
+
+    python bench_busca.py [pacientes]
+"""
+
+import random
+import sys
+import time
+
+from busca import IndiceNomes
+
+SILABAS = ('BA', 'BE', 'LI', 'MA', 'RO', 'SA', 'TE', 'VI', 'NA', 'DO',
+           'CA', 'GO', 'LU', 'PE', 'RI', 'SO', 'TA', 'FA', 'JU', 'NE')
+PRENOMES = ('JOÃO', 'JOSÉ', 'MARIA', 'ANA', 'CONCEIÇÃO', 'PEDRO', 'PAULO', 'LUCAS',
+            'FERNANDA', 'JULIANA', 'ANTÔNIO', 'FRANCISCO', 'CARLOS', 'MARCOS', 'THIAGO',
+            'LUIZ', 'FELIPE', 'WAGNER', 'GABRIEL', 'RAFAEL')
+SOBRENOMES = ('SILVA', 'SANTOS', 'OLIVEIRA', 'SOUZA', 'RODRIGUES', 'FERREIRA', 'ALVES',
+              'PEREIRA', 'LIMA', 'GOMES', "D'ÁVILA", 'ARAÚJO', 'CONCEIÇÃO')
+
+CONSULTAS = (
+    # Prefixos de 3 letras: o primeiro pedido depois do debounce
+    ('prefixo', ('ana', 'mar', 'jos', 'fer', 'luc', 'sil', 'san', 'oli')),
+    ('nome', ('joao', 'conceicao', 'maria silva', 'silva ana', 'pedro alves pereira')),
+    ('digitacao', ('jaoo', 'conseissao', 'tiago', 'pereria', 'luis silva')),
+    ('trecho', ('ilva', 'reira', 'avila')),
+    ('curto', ('ma', 'jo d', 'lv', 'a s')),
+    ('misto', ('ma sil', 'ana s', 'jo silva', 'maria s', 'pe l san')),
+)
+
+
+class ConexaoSintetica:
+    """Conexao com o minimo que IndiceNomes._ler usa"""
+
+    def __init__(self, linhas):
+        self.linhas = linhas
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self._pendentes = [l for l in self.linhas if l[0] > params[0]]
+
+    def fetchmany(self, n):
+        lote, self._pendentes = self._pendentes[:n], self._pendentes[n:]
+        return lote
+
+    def close(self):
+        pass
+
+
+def nomes_sinteticos(rnd, quantidade):
+    def inventado():
+        return ''.join(rnd.choice(SILABAS) for _ in range(rnd.randint(2, 4)))
+    prenomes = list(PRENOMES) + [inventado() for _ in range(3000)]
+    sobrenomes = list(SOBRENOMES) + [inventado() + 'S' for _ in range(8000)]
+
+    def escolher(lista, comuns):
+        return rnd.choice(lista[:comuns]) if rnd.random() < 0.3 else rnd.choice(lista)
+    return [
+        (cod, f'{escolher(prenomes, 20)} {escolher(prenomes, 20)} '
+              f'{escolher(sobrenomes, 13)} {escolher(sobrenomes, 13)}', None)
+        for cod in range(1, quantidade + 1)
+    ]
+
+
+def medir(indice, termo, repeticoes=20):
+    melhor = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = indice.buscar(termo)
+        tempo = time.perf_counter() - inicio
+        melhor = tempo if melhor is None else min(melhor, tempo)
+    return melhor * 1000, resultado
+
+
+def main():
+    quantidade = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    linhas = nomes_sinteticos(random.Random(1), quantidade)
+    inicio = time.perf_counter()
+    indice = IndiceNomes().carregar(ConexaoSintetica(linhas))
+    print(f'{quantidade} pacientes, carga em {time.perf_counter() - inicio:.2f} s')
+
+    pior = (0, '')
+    for tipo, termos in CONSULTAS:
+        print(f'\n{tipo}')
+        for termo in termos:
+            ms, resultado = medir(indice, termo)
+            pior = max(pior, (ms, termo))
+            primeiro = resultado[0]['nome'] if resultado else '-'
+            print(f'  {termo:22s} {ms:7.2f} ms  {len(resultado):3d}  {primeiro}')
+    print(f'\npior: {pior[1]!r} em {pior[0]:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Benchmark da codificacao JSON das respostas - Medicine Dream
+
+Compara o encoder antigo do app.py (json.dumps + MedicineEncoder, separadores
+padrao) com json_util.codificar (stdlib compacto e orjson, se instalado) em
+dados no formato de buscar_evolucoes e lancamentos_recentes, e mostra o
+tamanho com e sem compressao. Nao usa o banco.
+
+    python bench_json.py
+"""
+
+import gzip
+import json
+import random
+import timeit
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+
+import json_util
+
+PALAVRAS = ('paciente refere dor lombar ha tres semanas com piora ao esforco, nega febre. '
+            'Ao exame: PA 120x80, ausculta sem alteracoes, abdome flacido e indolor. '
+            'Conduta: analgesico, fisioterapia e retorno em quinze dias. Orientacao sobre '
+            'postura e atividade fisica. Solicitado hemograma, glicemia e raio-x da coluna. '
+            'Historico de hipertensao em uso de losartana. Alergia a dipirona. Evolucao '
+            'favoravel, sem queixas novas. Pressao controlada, manter medicacao.').split()
+
+
+def _texto(rnd, palavras):
+    return ' '.join(rnd.choice(PALAVRAS) for _ in range(palavras))
+
+
+def evolucoes(rnd, n=30):
+    """Como MedicineDB.buscar_evolucoes: textos longos de atendimento"""
+    inicio = datetime(2024, 1, 1)
+    return [{
+        'id_agenda': 100000 + i,
+        'data': (inicio + timedelta(days=i * 7)).date(),
+        'hora': time(8 + i % 10, (i * 15) % 60),
+        'profissional': rnd.choice(('DR. JOAO SILVA', 'DRA. MARIA SOUZA', 'DR. CARLOS LIMA')),
+        'palheta': rnd.randint(1, 5),
+        'texto': _texto(rnd, rnd.randint(150, 600)),
+    } for i in range(n)]
+
+
+def lancamentos(rnd, n=50):
+    """Como FinanceiroDB.lancamentos_recentes (valores Decimal do Firebird)"""
+    return [{
+        'id': 500000 + i,
+        'data': date(2024, 6, 1) + timedelta(days=i % 30),
+        'valor': Decimal(rnd.randint(1000, 500000)) / 100,
+        'texto': _texto(rnd, 6),
+        'tipo': rnd.choice('CDT'),
+        'status': rnd.choice(('Realizado', 'Pendente')),
+        'cliente': rnd.choice(('JOAO SILVA', 'MARIA SOUZA', 'UNIMED')),
+        'conta': rnd.choice(('CAIXA', 'BANCO DO BRASIL', 'ITAU')),
+        'num_documento': str(rnd.randint(1, 99999)),
+        'observacao': _texto(rnd, 10) if rnd.random() < 0.3 else None,
+        'procedimentos': rnd.choice((None, 'CONSULTA', 'CONSULTA, RETORNO')),
+    } for i in range(n)]
+
+
+class EncoderAntigo(json.JSONEncoder):
+    """MedicineEncoder como estava no app.py (referencia)"""
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.strftime('%d/%m/%Y %H:%M')
+        if isinstance(obj, date):
+            return obj.strftime('%d/%m/%Y')
+        if isinstance(obj, time):
+            return obj.strftime('%H:%M')
+        if isinstance(obj, Decimal):
+            return float(obj)
+        if isinstance(obj, bytes):
+            try:
+                return obj.decode('cp1252')
+            except (UnicodeDecodeError, AttributeError):
+                return obj.decode('latin-1')
+        return super().default(obj)
+
+
+def antigo(dados):
+    return json.dumps(dados, cls=EncoderAntigo, ensure_ascii=False).encode('utf-8')
+
+
+_compacto = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=json_util.converter)
+
+
+def stdlib_compacto(dados):
+    return _compacto.encode(dados).encode('utf-8')
+
+
+def medir(funcao, dados, repeticoes):
+    tempo = min(timeit.repeat(lambda: funcao(dados), number=repeticoes, repeat=5))
+    return tempo / repeticoes * 1e6   # microssegundos por chamada
+
+
+def main():
+    rnd = random.Random(42)
+    casos = [
+        ('evolucoes (30)', evolucoes(rnd), 200),
+        ('lancamentos (50)', lancamentos(rnd), 500),
+        ('lancamentos (2000)', lancamentos(rnd, 2000), 20),
+    ]
+    codificadores = [('json + MedicineEncoder (antigo)', antigo),
+                     ('json compacto + converter', stdlib_compacto)]
+    if json_util.orjson is not None:
+        codificadores.append(('orjson + converter', json_util.codificar))
+
+    for nome, dados, repeticoes in casos:
+        referencia = json.loads(antigo(dados))
+        print(f'\n{nome}')
+        base = None
+        for rotulo, funcao in codificadores:
+            corpo = funcao(dados)
+            assert json.loads(corpo) == referencia, rotulo
+            us = medir(funcao, dados, repeticoes)
+            base = base or us
+            print(f'  {rotulo:34s} {us:9.0f} us  {base / us:4.1f}x  {len(corpo):8d} bytes')
+        corpo = json_util.codificar(dados)
+        us = medir(lambda d: gzip.compress(d, compresslevel=json_util.NIVEL_GZIP, mtime=0), corpo, repeticoes)
+        print(f'  {"gzip nivel " + str(json_util.NIVEL_GZIP):34s} {us:9.0f} us        '
+              f'{len(gzip.compress(corpo, json_util.NIVEL_GZIP, mtime=0)):8d} bytes')
+        if json_util.brotli is not None:
+            print(f'  {"brotli nivel " + str(json_util.NIVEL_BROTLI):34s}                  '
+                  f'{len(json_util.brotli.compress(corpo, quality=json_util.NIVEL_BROTLI)):8d} bytes')
+
+
+if __name__ == '__main__':
+    main()
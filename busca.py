@@ -0,0 +1,543 @@
+"""
+Indice em memoria para busca de pacientes por nome - Medicine Dream
+"""
+
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+
+
+def normalizar(texto):
+    """Remove acentos, converte para maiusculas e colapsa espacos.
+    Tudo que nao for letra/digito vira espaco ('D'AVILA' -> 'D AVILA')."""
+    if not texto:
+        return ''
+    if isinstance(texto, bytes):
+        texto = texto.decode('cp1252', errors='replace')
+    decomposto = unicodedata.normalize('NFKD', texto)
+    sem_acento = ''.join(c for c in decomposto if not unicodedata.combining(c))
+    limpo = ''.join(c if c.isalnum() else ' ' for c in sem_acento.upper())
+    return ' '.join(limpo.split())
+
+
+def trigramas(texto):
+    """Trigramas (janelas de 3 caracteres) de um texto ja normalizado"""
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+def bigramas(texto):
+    """Bigramas (janelas de 2 caracteres) de um texto ja normalizado"""
+    return {texto[i:i + 2] for i in range(len(texto) - 1)}
+
+
+# Regras foneticas para nomes em portugues do Brasil, aplicadas em ordem
+# sobre a palavra ja normalizada (maiuscula, sem acento)
+_REGRAS_FONETICAS = [(re.compile(padrao), troca) for padrao, troca in (
+    (r'PH', 'F'),
+    (r'TH', 'T'),
+    (r'SCH', 'X'),
+    (r'[SC]H', 'X'),
+    (r'LH', 'L'),
+    (r'NH', 'N'),
+    (r'[SX]C(?=[EIY])', 'S'),
+    (r'C(?=[EIY]|AO$)', 'S'),   # Ç vira C na normalizacao: CONCEICAO, ASSUNCAO
+    (r'QU(?=[EIY])', 'K'),
+    (r'GU(?=[EIY])', 'G'),
+    (r'G(?=[EIY])', 'J'),
+    (r'[CQ]', 'K'),
+    (r'Z', 'S'),
+    (r'W', 'V'),
+    (r'Y', 'I'),
+    (r'H', ''),
+    (r'M(?=[^AEIOU]|$)', 'N'),
+)]
+# Vogais atonas se confundem na fala: Felipe/Filipe, Paolo/Paulo
+_VOGAIS = str.maketrans('EO', 'IU')
+
+
+def chave_fonetica(palavra):
+    """Chave fonetica de uma palavra normalizada: Luiz/Luis, Thiago/Tiago,
+    Conceicao/Conseissao, Wagner/Vagner, Felipe/Filipe tem a mesma chave"""
+    for regra, troca in _REGRAS_FONETICAS:
+        palavra = regra.sub(troca, palavra)
+    chave = []
+    for c in palavra.translate(_VOGAIS):
+        if not chave or c != chave[-1]:
+            chave.append(c)
+    return ''.join(chave)
+
+
+def distancia_edicao(a, b, maximo=2):
+    """Distancia de Damerau-Levenshtein (optimal string alignment) entre a e b.
+    Para assim que passar de `maximo` e retorna maximo + 1."""
+    if abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+    anterior2 = None
+    anterior = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        atual = [i] + [0] * len(b)
+        menor = i
+        for j in range(1, len(b) + 1):
+            custo = 0 if a[i - 1] == b[j - 1] else 1
+            valor = min(anterior[j] + 1, atual[j - 1] + 1, anterior[j - 1] + custo)
+            if (anterior2 is not None and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                valor = min(valor, anterior2[j - 2] + 1)
+            atual[j] = valor
+            menor = min(menor, valor)
+        if menor > maximo:
+            return maximo + 1
+        anterior2, anterior = anterior, atual
+    return anterior[-1]
+
+
+def _delecoes(palavra):
+    """Variantes da palavra com uma letra removida"""
+    return {palavra[:i] + palavra[i + 1:] for i in range(len(palavra))}
+
+
+# Pesos de cada tipo de casamento entre um termo digitado e uma palavra do nome
+PESO_EXATO = 3.0
+PESO_PREFIXO = 2.0
+PESO_FONETICO = 1.5
+PESO_EDICAO = 1.0
+PESO_SUBSTRING = 0.5
+# Tamanho minimo do termo para casar por fonetica / erro de digitacao
+MIN_FONETICO = 3
+MIN_EDICAO = 4
+# Buscas so com termos menores que isso casam pelo inicio do nome completo e,
+# se faltar resultado, pelos bigramas (um termo de 1-2 letras expandido como
+# os demais casaria com boa parte do vocabulario)
+MIN_TERMO = 3
+
+
+class _Dados:
+    """Estruturas do indice (trocadas de uma vez na recarga completa)"""
+    def __init__(self):
+        self.pacientes = {}     # A6COD -> (nome, data_nascimento, nome_normalizado, palavras)
+        self.palavras = {}      # palavra -> lista de A6COD, na ordem de `nomes`
+        self.trigramas = {}     # trigrama -> lista de palavras que o contem
+        self.bigramas = {}      # bigrama -> lista de palavras que o contem (trechos de 2 letras)
+        self.vocabulario = []   # palavras ordenadas (busca por prefixo com bisect)
+        self.foneticas = {}     # chave fonetica -> lista de palavras
+        self.delecoes = {}      # palavra ou palavra sem 1 letra -> lista de palavras
+        self.nomes = []         # (nome_normalizado, A6COD) ordenados, para busca por inicio do nome
+        self.max_cod = 0
+
+    @staticmethod
+    def _anexar(mapa, chave, valor):
+        lista = mapa.get(chave)
+        if lista is None:
+            mapa[chave] = [valor]
+        else:
+            lista.append(valor)
+
+    def _nova_palavra(self, palavra, ordenar):
+        if ordenar:
+            bisect.insort(self.vocabulario, palavra)
+        else:
+            self.vocabulario.append(palavra)
+        for tri in trigramas(palavra):
+            self._anexar(self.trigramas, tri, palavra)
+        for bi in bigramas(palavra):
+            self._anexar(self.bigramas, bi, palavra)
+        if len(palavra) >= MIN_FONETICO:
+            self._anexar(self.foneticas, chave_fonetica(palavra), palavra)
+        if len(palavra) >= MIN_EDICAO - 1:
+            self._anexar(self.delecoes, palavra, palavra)
+            for variante in _delecoes(palavra):
+                self._anexar(self.delecoes, variante, palavra)
+
+    def indexar(self, row, ordenar=True):
+        cod, nome, nascimento = row
+        if cod in self.pacientes:
+            return
+        norm = normalizar(nome)
+        palavras = tuple(set(norm.split()))
+        self.pacientes[cod] = (nome, nascimento, norm, palavras)
+        if ordenar:
+            bisect.insort(self.nomes, (norm, cod))
+        else:
+            self.nomes.append((norm, cod))
+        self.max_cod = max(self.max_cod, cod)
+        for palavra in palavras:
+            if palavra not in self.palavras:
+                self.palavras[palavra] = []
+                self._nova_palavra(palavra, ordenar)
+            if ordenar:
+                self._inserir(palavra, cod, (norm, cod))
+            else:
+                self.palavras[palavra].append(cod)
+
+    def _inserir(self, palavra, cod, chave):
+        """Poe o paciente na lista da palavra, na ordem de (nome, A6COD). A
+        lista e trocada por uma copia: buscas em andamento seguem na antiga."""
+        lista = list(self.palavras[palavra])
+        inicio, fim = 0, len(lista)
+        while inicio < fim:
+            meio = (inicio + fim) // 2
+            outro = lista[meio]
+            if (self.pacientes[outro][2], outro) < chave:
+                inicio = meio + 1
+            else:
+                fim = meio
+        lista.insert(inicio, cod)
+        self.palavras[palavra] = lista
+
+    def ordenar(self):
+        """Ordena as estruturas depois de indexar(ordenar=False)"""
+        self.vocabulario.sort()
+        self.nomes.sort()
+        posicao = {cod: i for i, (_, cod) in enumerate(self.nomes)}
+        for lista in self.palavras.values():
+            lista.sort(key=posicao.__getitem__)
+
+
+class IndiceNomes:
+    """Indice sobre os nomes normalizados dos pacientes (chave A6COD).
+
+    - garantir(conn) carrega tudo na primeira chamada; depois, a cada
+      `intervalo` segundos, traz so os pacientes com A6COD maior que o ultimo
+      visto, e a cada `recarga` segundos refaz o indice (pega nomes editados).
+      Com servidor.py (gunicorn) a recarga e do processo mestre, nao de
+      cada worker.
+    - buscar(termo) casa cada palavra digitada com as palavras do nome por
+      igualdade, prefixo, chave fonetica, erro de digitacao (1 edicao) ou
+      substring (via trigramas do vocabulario), e devolve os pacientes de
+      maior pontuacao primeiro. Trechos de 1-2 letras (ex: 'LV' em SILVA)
+      sao conferidos no nome dos candidatos ou, se a busca so tiver
+      trechos assim, procurados pelos bigramas do vocabulario."""
+
+    SQL_PACIENTES = """
+        SELECT
+            p.A6COD,
+            cf.A115NOME,
+            pf.A135DATA_NASCIMENTO
+        FROM M6PACIENTE p
+        INNER JOIN I115CLIENTE_FORNENCEDOR cf ON p.A6FKI115COD = cf.A115COD
+        LEFT JOIN I135PESSOA_FISICA pf ON cf.A115COD = pf.A135FK115COD
+        WHERE cf.A115NOME IS NOT NULL
+          AND p.A6COD > ?
+        ORDER BY p.A6COD
+    """
+
+    def __init__(self, intervalo=30, recarga=3600):
+        self.intervalo = intervalo
+        self.recarga = recarga
+        self._dados = _Dados()
+        self._atualizado_em = 0
+        self._carregado_em = 0
+        self._lock = threading.RLock()
+        self._lock_carga = threading.Lock()
+
+    @property
+    def carregado(self):
+        return self._carregado_em > 0
+
+    def __len__(self):
+        return len(self._dados.pacientes)
+
+    # ==================== CARGA ====================
+
+    def _ler(self, conn, a_partir_de):
+        cursor = conn.cursor()
+        cursor.execute(self.SQL_PACIENTES, (a_partir_de,))
+        while True:
+            rows = cursor.fetchmany(5000)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        cursor.close()
+
+    def carregar(self, conn):
+        """Reconstroi o indice inteiro e troca o atual de uma vez"""
+        dados = _Dados()
+        for row in self._ler(conn, 0):
+            dados.indexar(row, ordenar=False)
+        dados.ordenar()
+        agora = time.monotonic()
+        with self._lock:
+            self._dados = dados
+            self._atualizado_em = agora
+            self._carregado_em = agora
+        return self
+
+    def atualizar(self, conn):
+        """Indexa apenas os pacientes novos (A6COD > ultimo visto)"""
+        novos = list(self._ler(conn, self._dados.max_cod))
+        with self._lock:
+            for row in novos:
+                self._dados.indexar(row)
+            self._atualizado_em = time.monotonic()
+        return len(novos)
+
+    def garantir(self, conn):
+        """Carrega ou atualiza o indice se estiver vencido. So uma thread
+        consulta o banco; as demais seguem com o indice atual."""
+        agora = time.monotonic()
+        if self.carregado and agora - self._atualizado_em < self.intervalo:
+            return self
+        if not self.carregado:
+            with self._lock_carga:
+                if not self.carregado:
+                    self.carregar(conn)
+            return self
+        if not self._lock_carga.acquire(blocking=False):
+            return self
+        try:
+            if agora - self._carregado_em >= self.recarga:
+                self.carregar(conn)
+            elif agora - self._atualizado_em >= self.intervalo:
+                self.atualizar(conn)
+        finally:
+            self._lock_carga.release()
+        return self
+
+    # ==================== BUSCA ====================
+
+    @staticmethod
+    def _alternativas(dados, token):
+        """Palavras do vocabulario que casam com o token -> peso do casamento"""
+        alternativas = {}
+
+        def marcar(palavra, peso):
+            if peso > alternativas.get(palavra, 0):
+                alternativas[palavra] = peso
+
+        # Contem o token (trigramas do token presentes na palavra)
+        tris = trigramas(token)
+        if tris:
+            listas = sorted((dados.trigramas.get(tri, ()) for tri in tris), key=len)
+            for palavra in listas[0]:
+                if token in palavra:
+                    marcar(palavra, PESO_SUBSTRING)
+
+        # Igual / prefixo
+        vocabulario = dados.vocabulario
+        i = bisect.bisect_left(vocabulario, token)
+        while i < len(vocabulario) and vocabulario[i].startswith(token):
+            palavra = vocabulario[i]
+            marcar(palavra, PESO_EXATO if palavra == token else PESO_PREFIXO)
+            i += 1
+
+        # Mesma chave fonetica
+        if len(token) >= MIN_FONETICO:
+            for palavra in dados.foneticas.get(chave_fonetica(token), ()):
+                marcar(palavra, PESO_FONETICO)
+
+        # Erro de digitacao: uma insercao, remocao, troca ou transposicao
+        if len(token) >= MIN_EDICAO:
+            vistas = set()
+            for variante in _delecoes(token) | {token}:
+                for palavra in dados.delecoes.get(variante, ()):
+                    if palavra in vistas or palavra in alternativas:
+                        continue
+                    vistas.add(palavra)
+                    if distancia_edicao(token, palavra, 1) <= 1:
+                        marcar(palavra, PESO_EDICAO)
+
+        return alternativas
+
+    def buscar(self, termo, limite=20):
+        """Busca pacientes pelo nome, sem diferenciar acentos/maiusculas e
+        tolerando erros de digitacao. Retorna lista de dicts id/nome/data_nascimento,
+        os melhores primeiro.
+
+        O lock so protege a troca do indice: a pontuacao roda sem ele sobre a
+        referencia obtida (atualizar() apenas acrescenta, troca cada lista de
+        palavras por uma copia ja ordenada, e cada paciente entra em
+        `pacientes` antes de aparecer nessas listas)."""
+        termo = normalizar(termo)
+        if not termo:
+            return []
+        tokens = termo.split()
+
+        with self._lock:
+            dados = self._dados
+
+        if all(len(token) < MIN_TERMO for token in tokens):
+            encontrados = self._inicio_do_nome(dados, termo, limite)
+            if len(encontrados) < limite:
+                vistos = {cod for cod, _, _ in encontrados}
+                encontrados += self._trecho(dados, tokens, limite - len(encontrados), vistos)
+        else:
+            encontrados = self._pontuar(dados, termo, tokens, limite)
+        return [
+            {'id': cod, 'nome': nome, 'data_nascimento': nascimento}
+            for cod, nome, nascimento in encontrados
+        ]
+
+    @staticmethod
+    def _inicio_do_nome(dados, termo, limite):
+        """Pacientes cujo nome comeca com o termo, em ordem alfabetica"""
+        nomes = dados.nomes
+        encontrados = []
+        i = bisect.bisect_left(nomes, (termo,))
+        while i < len(nomes) and len(encontrados) < limite:
+            norm, cod = nomes[i]
+            if not norm.startswith(termo):
+                break
+            nome, nascimento, _, _ = dados.pacientes[cod]
+            encontrados.append((cod, nome, nascimento))
+            i += 1
+        return encontrados
+
+    @staticmethod
+    def _trecho(dados, tokens, limite, vistos):
+        """Nomes com todos os tokens curtos em qualquer posicao. Os candidatos
+        vem do token que cobre menos pacientes: primeiro os nomes com palavra
+        comecando por ele, depois (2 letras) os que o contem no meio da
+        palavra (via bigramas do vocabulario)."""
+        def palavras_do(token):
+            vocabulario = dados.vocabulario
+            palavras = []
+            i = bisect.bisect_left(vocabulario, token)
+            while i < len(vocabulario) and vocabulario[i].startswith(token):
+                palavras.append(vocabulario[i])
+                i += 1
+            if len(token) == 2:
+                palavras += [p for p in dados.bigramas.get(token, ()) if not p.startswith(token)]
+            return palavras
+
+        palavras = min((palavras_do(token) for token in set(tokens)),
+                       key=lambda lista: sum(len(dados.palavras[p]) for p in lista))
+
+        def casa(norm):
+            espacado = ' ' + norm
+            return all(' ' + token in espacado or (len(token) == 2 and token in norm)
+                       for token in tokens)
+
+        encontrados = []
+        for palavra in palavras:
+            for cod in dados.palavras[palavra]:
+                if cod in vistos:
+                    continue
+                vistos.add(cod)
+                nome, nascimento, norm, _ = dados.pacientes[cod]
+                if casa(norm):
+                    encontrados.append((cod, nome, nascimento))
+                    if len(encontrados) >= limite:
+                        return encontrados
+        return encontrados
+
+    @staticmethod
+    def _peso_curto(token, norm, palavras):
+        """Peso de um token de 1-2 letras num nome ja candidato"""
+        if token in palavras:
+            return PESO_EXATO
+        if any(palavra.startswith(token) for palavra in palavras):
+            return PESO_PREFIXO
+        if token in norm:
+            return PESO_SUBSTRING
+        return 0
+
+    @staticmethod
+    def _peso_curto_maximo(dados, token):
+        """Maior peso que o token curto pode ter em algum nome do indice"""
+        if token in dados.palavras:
+            return PESO_EXATO
+        vocabulario = dados.vocabulario
+        i = bisect.bisect_left(vocabulario, token)
+        if i < len(vocabulario) and vocabulario[i].startswith(token):
+            return PESO_PREFIXO
+        return PESO_SUBSTRING
+
+    def _pontuar(self, dados, termo, tokens, limite):
+        # Tokens curtos nao escolhem candidatos (casariam com quase tudo);
+        # so sao conferidos no nome de cada candidato, inclusive no meio
+        curtos = [token for token in tokens if len(token) < MIN_TERMO]
+        tokens = [token for token in tokens if len(token) >= MIN_TERMO]
+        alternativas = [self._alternativas(dados, token) for token in tokens]
+
+        # Pontuacao por paciente a partir do token mais seletivo; os demais
+        # tokens sao conferidos nas palavras de cada candidato
+        def tamanho(alt):
+            return sum(len(dados.palavras[p]) for p in alt)
+        ordem = sorted(range(len(tokens)), key=lambda i: tamanho(alternativas[i]))
+        seletivo = alternativas[ordem[0]]
+        outros = [alternativas[i] for i in ordem[1:]]
+
+        if not seletivo:
+            return []
+        resto = (sum(max(alt.values(), default=0) for alt in outros)
+                 + sum(self._peso_curto_maximo(dados, token) for token in curtos))
+        pacientes = dados.pacientes
+        pontuados = []   # (-pontos, nome normalizado, A6COD, nome, nascimento)
+        vistos = set()
+
+        def pontuar(cod, peso):
+            """Pontos do paciente (None se nao casar com todos os tokens)"""
+            vistos.add(cod)
+            nome, nascimento, norm, palavras = pacientes[cod]
+            pontos = peso
+            for alt in outros:
+                melhor = max([alt.get(p, 0) for p in palavras])
+                if not melhor:
+                    return None
+                pontos += melhor
+            pesos_curtos = [self._peso_curto(token, norm, palavras) for token in curtos]
+            if not all(pesos_curtos):
+                return None
+            pontos += sum(pesos_curtos)
+            if norm == termo:
+                pontos += PESO_EXATO
+            elif norm.startswith(termo):
+                pontos += PESO_PREFIXO
+            pontuados.append((-pontos, norm, cod, nome, nascimento))
+            return pontos
+
+        # Os candidatos vem em grupos de teto (maximo de pontos possivel)
+        # decrescente e, dentro do grupo, em ordem alfabetica - a ordem de
+        # desempate. Quando `limite` pacientes ja tem o teto do grupo, nenhum
+        # candidato que falta pode passar na frente deles e a busca para
+        # (um prefixo de 3 letras nao pontua os milhares de nomes que casam).
+        def bastam(teto, iguais):
+            return sum(1 for p in pontuados if -p[0] > teto or (iguais and -p[0] == teto)) >= limite
+
+        # 1) Nomes que comecam com o termo (bonus de prefixo)
+        teto = max(seletivo.values()) + resto + PESO_PREFIXO
+        acima = 0
+        nomes = dados.nomes
+        i = bisect.bisect_left(nomes, (termo,))
+        while i < len(nomes) and nomes[i][0].startswith(termo):
+            cod = nomes[i][1]
+            palavras = pacientes[cod][3]
+            pontos = pontuar(cod, max([seletivo.get(p, 0) for p in palavras]))
+            if pontos is not None and pontos >= teto:
+                acima += 1
+                if acima >= limite:
+                    break
+            i += 1
+        else:
+            # 2) Palavras do token seletivo, da faixa de peso maior para a menor
+            faixas = {}
+            for palavra, peso in seletivo.items():
+                faixas.setdefault(peso, []).append(palavra)
+
+            def chave(cod):
+                return pacientes[cod][2], cod
+
+            for peso in sorted(faixas, reverse=True):
+                teto = peso + resto
+                if bastam(teto, False):
+                    break
+                acima = sum(1 for p in pontuados if -p[0] > teto)
+                listas = [dados.palavras[palavra] for palavra in faixas[peso]]
+                for cod in heapq.merge(*listas, key=chave) if len(listas) > 1 else listas[0]:
+                    if cod in vistos:
+                        continue
+                    pontos = pontuar(cod, peso)
+                    if pontos is not None and pontos >= teto:
+                        acima += 1
+                        if acima >= limite:
+                            break
+                else:
+                    continue
+                break
+
+        return [(cod, nome, nascimento)
+                for _, _, cod, nome, nascimento in heapq.nsmallest(limite, pontuados)]
@@ -0,0 +1,116 @@
+"""
+Cache de resultados de consultas com TTL e invalidacao por marcador - Medicine Dream
+"""
+
+import functools
+import threading
+import time
+
+
+class CacheResultados:
+    """Cache thread-safe de resultados, chaveado por metodo + argumentos.
+
+    Uma entrada vale enquanto nao passar o TTL e o marcador de mudanca
+    (ex: MAX(A106COD)) continuar igual ao do momento em que foi calculada.
+    O marcador e consultado no maximo uma vez a cada `intervalo_marcador`
+    segundos, e so uma thread recalcula cada chave (as demais esperam e
+    reaproveitam o resultado).
+
+    As chaves incluem os argumentos (ex: ?meses= da URL), entao o cache
+    descarta as entradas vencidas a cada gravacao e guarda no maximo
+    `maximo` chaves, removendo as que vencem primeiro.
+
+    Os valores sao compartilhados entre chamadas: nao altere o que receber."""
+
+    def __init__(self, intervalo_marcador=10, maximo=256):
+        self.intervalo_marcador = intervalo_marcador
+        self.maximo = maximo
+        self._entradas = {}     # chave -> (valor, marcador, expira_em)
+        self._marcadores = {}   # nome -> (valor, consultado_em)
+        self._locks = {}        # chave -> Lock (um calculo por vez por chave)
+        self._lock = threading.Lock()
+
+    def marcador(self, nome, consultar):
+        """Valor atual do marcador `nome`, consultando no maximo a cada intervalo"""
+        agora = time.monotonic()
+        with self._lock:
+            atual = self._marcadores.get(nome)
+        if atual and agora - atual[1] < self.intervalo_marcador:
+            return atual[0]
+        valor = consultar()
+        with self._lock:
+            self._marcadores[nome] = (valor, agora)
+        return valor
+
+    def _valida(self, chave, marcador):
+        entrada = self._entradas.get(chave)
+        if entrada and entrada[2] > time.monotonic() and entrada[1] == marcador:
+            return entrada
+        return None
+
+    def _gravar(self, chave, entrada):
+        """Guarda a entrada e descarta as vencidas (chamar com self._lock)"""
+        agora = time.monotonic()
+        for vencida in [c for c, e in self._entradas.items() if e[2] <= agora]:
+            del self._entradas[vencida]
+        self._entradas[chave] = entrada
+        excesso = len(self._entradas) - self.maximo
+        if excesso > 0:
+            for antiga in sorted(self._entradas, key=lambda c: self._entradas[c][2])[:excesso]:
+                del self._entradas[antiga]
+
+    def obter(self, chave, ttl, calcular, marcador=None):
+        """Retorna o valor em cache ou executa calcular() e guarda por `ttl` segundos"""
+        with self._lock:
+            entrada = self._valida(chave, marcador)
+            if entrada:
+                return entrada[0]
+            lock_chave = self._locks.setdefault(chave, threading.Lock())
+
+        with lock_chave:
+            with self._lock:
+                entrada = self._valida(chave, marcador)
+            if entrada:
+                return entrada[0]
+            try:
+                valor = calcular()
+                with self._lock:
+                    self._gravar(chave, (valor, marcador, time.monotonic() + ttl))
+                return valor
+            finally:
+                # Quem ainda espera no lock acha a entrada pronta; os proximos
+                # pedidos nem chegam a criar outro
+                with self._lock:
+                    if self._locks.get(chave) is lock_chave:
+                        del self._locks[chave]
+
+    def invalidar(self, prefixo=None):
+        """Descarta entradas (todas, ou as do metodo `prefixo`) e marcadores"""
+        with self._lock:
+            if prefixo is None:
+                self._entradas.clear()
+            else:
+                for chave in [c for c in self._entradas if c[0] == prefixo]:
+                    del self._entradas[chave]
+            self._marcadores.clear()
+
+
+def cacheado(ttl, marcador=None):
+    """Decorator para metodos de classes com atributo `cache` (CacheResultados).
+
+    ttl: segundos de validade do resultado.
+    marcador: nome do metodo da mesma classe que retorna o marcador de mudanca;
+    quando ele muda, o resultado e recalculado antes do TTL."""
+    def decorador(metodo):
+        @functools.wraps(metodo)
+        def wrapper(self, *args, **kwargs):
+            cache = getattr(self, 'cache', None)
+            if cache is None:
+                return metodo(self, *args, **kwargs)
+            valor_marcador = None
+            if marcador:
+                valor_marcador = cache.marcador(marcador, getattr(self, marcador))
+            chave = (metodo.__name__, args, tuple(sorted(kwargs.items())))
+            return cache.obter(chave, ttl, lambda: metodo(self, *args, **kwargs), valor_marcador)
+        return wrapper
+    return decorador
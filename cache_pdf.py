@@ -0,0 +1,272 @@
+"""
+Cache em disco dos PDFs dos bancos de blob - Medicine Dream
+
+Um blob de M999BLOBS nunca muda depois de gravado, entao cada PDF lido de
+Medicine_blob{N}.fdb pode ser guardado localmente e servido do disco nas
+proximas visualizacoes. Os arquivos se chamam {blob_id}_{hash}.pdf: o hash
+(SHA-256 do conteudo, 16 hex) vira o ETag.
+
+- Gravacao atomica: arquivo temporario na mesma pasta + os.replace.
+- Leitura por mmap, em pedacos.
+- Indice em memoria (blob_id -> arquivo, tamanho e ultimo uso) e total em
+  bytes, montados lendo a pasta na inicializacao. Arquivos gravados por
+  outros processos entram quando a pasta e relida (num erro de cache, no
+  maximo a cada REINDEXAR segundos).
+- Tamanho maximo: ao passar do limite, apaga os menos usados ate ficar em
+  90% do limite. O ultimo uso tambem vai para o mtime do arquivo, para valer
+  entre processos na proxima releitura.
+"""
+
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+CACHE_PDF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_pdf')
+CACHE_PDF_LIMITE = 2 * 1024 ** 3   # 2 GB
+
+PEDACO_LEITURA = 256 * 1024
+
+# Segundos minimos entre releituras da pasta por causa de um erro de cache
+REINDEXAR = 60
+
+# Idade minima (s) de um .tmp para ser considerado abandonado
+TEMPORARIO_ABANDONADO = 3600
+
+
+class _Entrada:
+    def __init__(self, caminho, etag, tamanho, usado_em=None):
+        self.caminho = caminho
+        self.etag = etag
+        self.tamanho = tamanho
+        self.usado_em = time.time() if usado_em is None else usado_em
+
+
+class LeituraCache:
+    """PDF do cache mapeado em memoria; fechar() ao terminar (ler() fecha sozinho)"""
+
+    def __init__(self, arquivo, mapa, etag):
+        self.arquivo = arquivo
+        self.mapa = mapa
+        self.etag = etag
+        self.tamanho = len(mapa)
+
+    def ler(self, inicio=0, fim=None, pedaco=PEDACO_LEITURA):
+        fim = self.tamanho if fim is None else fim
+        try:
+            for pos in range(inicio, fim, pedaco):
+                yield self.mapa[pos:min(pos + pedaco, fim)]
+        finally:
+            self.fechar()
+
+    def fechar(self):
+        if self.mapa is None:
+            return
+        mapa, self.mapa = self.mapa, None
+        mapa.close()
+        self.arquivo.close()
+
+
+class GravacaoCache:
+    """Arquivo temporario que recebe o PDF enquanto ele e enviado ao cliente.
+    concluir() publica no cache; descartar() apaga (leitura incompleta)."""
+
+    def __init__(self, cache, blob_id):
+        self.cache = cache
+        self.blob_id = blob_id
+        self.hash = hashlib.sha256()
+        self.tamanho = 0
+        self.finalizada = False
+        fd, self.temporario = tempfile.mkstemp(suffix='.tmp', dir=cache.pasta)
+        self.arquivo = os.fdopen(fd, 'wb')
+
+    def escrever(self, dados):
+        self.arquivo.write(dados)
+        self.hash.update(dados)
+        self.tamanho += len(dados)
+
+    def concluir(self):
+        self.arquivo.close()
+        etag = self.hash.hexdigest()[:16]
+        caminho = os.path.join(self.cache.pasta, f'{self.blob_id}_{etag}.pdf')
+        try:
+            os.replace(self.temporario, caminho)
+        except OSError:
+            # Mesmo conteudo ja publicado e aberto por outra leitura (Windows)
+            if not os.path.exists(caminho):
+                raise
+            os.remove(self.temporario)
+        self.finalizada = True
+        self.cache._registrar(self.blob_id, _Entrada(caminho, etag, self.tamanho))
+        return etag
+
+    def descartar(self):
+        if self.finalizada:
+            return
+        self.finalizada = True
+        try:
+            self.arquivo.close()
+            os.remove(self.temporario)
+        except OSError:
+            pass
+
+
+class CachePDF:
+    """Cache de PDFs em disco chaveado por blob_id (A999COD)"""
+
+    def __init__(self, pasta=CACHE_PDF_PATH, limite=CACHE_PDF_LIMITE, reindexar=REINDEXAR):
+        self.pasta = pasta
+        self.limite = limite
+        self.reindexar = reindexar
+        self._entradas = {}   # blob_id -> _Entrada
+        self._total = 0       # soma dos tamanhos em _entradas
+        self._indexado_em = 0
+        self._lock = threading.Lock()
+        self._lock_indice = threading.Lock()
+        os.makedirs(pasta, exist_ok=True)
+        self._apagar_temporarios()
+        self._indexar()
+
+    def _apagar_temporarios(self):
+        """Apaga temporarios abandonados. Cada import cria um CachePDF, entao
+        so vao os parados ha mais de TEMPORARIO_ABANDONADO segundos: os mais
+        novos podem ser gravacoes em andamento de outro processo."""
+        limite = time.time() - TEMPORARIO_ABANDONADO
+        for item in os.scandir(self.pasta):
+            if not item.name.endswith('.tmp'):
+                continue
+            try:
+                if item.stat().st_mtime < limite:
+                    os.remove(item.path)
+            except OSError:
+                pass
+
+    def _indexar(self):
+        """Le a pasta e troca o indice (entradas e total em bytes)"""
+        entradas = {}
+        for item in os.scandir(self.pasta):
+            achado = self._entrada_do_arquivo(item)
+            if achado:
+                entradas[achado[0]] = achado[1]
+        with self._lock:
+            self._entradas = entradas
+            self._total = sum(e.tamanho for e in entradas.values())
+            self._indexado_em = time.monotonic()
+
+    @staticmethod
+    def _entrada_do_arquivo(item):
+        nome = item.name
+        if not nome.endswith('.pdf'):
+            return None
+        blob_id, _, etag = nome[:-4].partition('_')
+        if not blob_id.isdigit() or not etag:
+            return None
+        try:
+            info = item.stat()
+        except OSError:
+            return None
+        return int(blob_id), _Entrada(item.path, etag, info.st_size, info.st_mtime)
+
+    def _registrar(self, blob_id, entrada):
+        with self._lock:
+            anterior = self._entradas.get(blob_id)
+            if anterior is not None:
+                self._total -= anterior.tamanho
+            self._entradas[blob_id] = entrada
+            self._total += entrada.tamanho
+            excedeu = self._total > self.limite
+        if excedeu:
+            self.limitar()
+
+    def _esquecer(self, blob_id, entrada):
+        with self._lock:
+            if self._entradas.get(blob_id) is entrada:
+                del self._entradas[blob_id]
+                self._total -= entrada.tamanho
+
+    def contem(self, blob_id):
+        return blob_id in self._entradas
+
+    def abrir(self, blob_id):
+        """LeituraCache do PDF, ou None se nao estiver no cache"""
+        with self._lock:
+            entrada = self._entradas.get(blob_id)
+        if entrada is None:
+            # Pode ter sido gravado por outro processo (varios workers)
+            if time.monotonic() - self._indexado_em < self.reindexar:
+                return None
+            if not self._lock_indice.acquire(blocking=False):
+                return None
+            try:
+                self._indexar()
+            finally:
+                self._lock_indice.release()
+            with self._lock:
+                entrada = self._entradas.get(blob_id)
+            if entrada is None:
+                return None
+        try:
+            arquivo = open(entrada.caminho, 'rb')
+        except OSError:
+            # Apagado por outro processo: esquecer
+            self._esquecer(blob_id, entrada)
+            return None
+        try:
+            mapa = mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            arquivo.close()
+            return None
+        entrada.usado_em = time.time()
+        try:
+            os.utime(entrada.caminho)   # ultimo uso visivel aos outros processos
+        except OSError:
+            pass
+        return LeituraCache(arquivo, mapa, entrada.etag)
+
+    def gravacao(self, blob_id):
+        """Inicia a gravacao de um PDF no cache (GravacaoCache)"""
+        return GravacaoCache(self, blob_id)
+
+    def gravar(self, blob_id, pedacos):
+        """Grava um PDF inteiro a partir de um iteravel de bytes; retorna o ETag"""
+        gravacao = self.gravacao(blob_id)
+        try:
+            for dados in pedacos:
+                gravacao.escrever(dados)
+        except BaseException:
+            gravacao.descartar()
+            raise
+        return gravacao.concluir()
+
+    def limitar(self):
+        """Apaga os PDFs usados ha mais tempo se o total passar do limite"""
+        with self._lock:
+            if self._total <= self.limite:
+                return 0
+            candidatos = sorted(self._entradas.items(), key=lambda item: item[1].usado_em)
+
+        alvo = self.limite * 0.9
+        removidos = 0
+        for blob_id, entrada in candidatos:
+            if self._total <= alvo:
+                break
+            try:
+                os.remove(entrada.caminho)
+            except FileNotFoundError:
+                pass   # ja apagado por outro processo
+            except OSError:
+                # Em uso (Windows nao apaga arquivo mapeado): fica para a proxima
+                continue
+            self._esquecer(blob_id, entrada)
+            removidos += 1
+        return removidos
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                'arquivos': len(self._entradas),
+                'bytes': self._total,
+                'limite': self.limite,
+            }
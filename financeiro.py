@@ -2,30 +2,70 @@
 Queries financeiras para o dashboard de fluxo de caixa - Medicine Dream
 """
 
-import fdb
-from paciente import CONFIG
+from datetime import date
+from paciente import CONFIG, procedimentos_por_cliente_data
+from pool import BaseDB
+from cache import CacheResultados, cacheado
+from referencia import cache_referencia
+
+# Marcadores de mudanca para o cache do dashboard. MAX(A106COD) percorre o
+# indice da PK; se o gerador da tabela for conhecido, GEN_ID(<gerador>, 0)
+# e ainda mais barato.
+SQL_MARCADOR_LANCAMENTOS = "SELECT MAX(A106COD) FROM I106LANCAMENTO"
+# Quantidade e soma dos pendentes: mudam quando um lancamento e realizado (ou
+# volta a pendente), excluido ou tem o valor editado - o que MAX(A106COD) nao
+# ve. Percorre a tabela, mas roda no maximo a cada intervalo_marcador s.
+SQL_MARCADOR_PENDENTES = """
+    SELECT COUNT(*), SUM(A106VALOR)
+    FROM I106LANCAMENTO
+    WHERE A106REALIZADO = 'N' AND A106ELIMINADO = 'N'
+"""
+SQL_MARCADOR_CICLICOS = "SELECT MAX(A107COD), COUNT(*) FROM I107CICLICOS"
+
+# TTL (segundos) dos resultados em cache por metodo
+TTL_RESUMO_MENSAL = 600
+TTL_SALDO_CONTAS = 120
+TTL_DESPESAS_RECORRENTES = 600
 
 
-class FinanceiroDB:
-    def __init__(self):
-        self.conn = None
+class FinanceiroDB(BaseDB):
+    def __init__(self, pool=None, cache=True, agregados=None, saldos=None, referencia=None):
+        super().__init__(CONFIG, pool)
+        self.cache = CacheResultados() if cache else None
+        # agregados.AgregadosMensais opcional: resumo_mensal le do SQLite local
+        self.agregados = agregados
+        # agregados.SaldosContas opcional: saldo_contas le o razao incremental
+        self.saldos = saldos
+        # Nomes de contas e procedimentos (referencia.py)
+        self.referencia = referencia if referencia is not None else cache_referencia
 
-    def conectar(self):
-        self.conn = fdb.connect(**CONFIG)
-        return self
+    # ==================== MARCADORES DE CACHE ====================
 
-    def desconectar(self):
-        if self.conn:
-            self.conn.close()
+    def _consultar_marcador(self, sql):
+        cursor = self.conn.cursor()
+        cursor.execute(sql)
+        row = cursor.fetchone()
+        cursor.close()
+        return tuple(row) if row else None
 
-    def __enter__(self):
-        return self.conectar()
+    def marcador_lancamentos(self):
+        """Muda quando entra lancamento novo, um pendente e realizado, excluido
+        ou editado, ou vira o dia (janelas usam CURRENT_DATE)"""
+        return (self._consultar_marcador(SQL_MARCADOR_LANCAMENTOS),
+                self._consultar_marcador(SQL_MARCADOR_PENDENTES), date.today())
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.desconectar()
+    def marcador_ciclicos(self):
+        """Muda quando despesas ciclicas sao incluidas ou removidas"""
+        return self._consultar_marcador(SQL_MARCADOR_CICLICOS)
 
+    # ==================== DASHBOARD ====================
+
+    @cacheado(TTL_RESUMO_MENSAL, marcador='marcador_lancamentos')
     def resumo_mensal(self, meses=12):
         """Totais mensais agrupados por C/D/T - ultimos N meses"""
+        if self.agregados is not None:
+            return self.agregados.sincronizar(self.conn).resumo(meses)
+
         cursor = self.conn.cursor()
         cursor.execute("""
             SELECT
@@ -56,8 +96,12 @@ class FinanceiroDB:
         cursor.close()
         return resultado
 
+    @cacheado(TTL_SALDO_CONTAS, marcador='marcador_lancamentos')
     def saldo_contas(self):
         """Saldo atual por conta (creditos - debitos realizados)"""
+        if self.saldos is not None:
+            return self._saldo_contas_razao()
+
         cursor = self.conn.cursor()
         cursor.execute("""
             SELECT
@@ -93,6 +137,27 @@ class FinanceiroDB:
         cursor.close()
         return resultado
 
+    def _saldo_contas_razao(self):
+        """saldo_contas a partir do razao local e do cache de contas"""
+        saldos = self.saldos.sincronizar(self.conn).saldos()
+        ref = self.referencia.garantir(self.conn)
+
+        resultado = []
+        for row in ref.contas():
+            creditos, debitos, _ = saldos.get(row[0], (0.0, 0.0, 0.0))
+            if creditos + debitos <= 0:
+                continue
+            resultado.append({
+                'conta_id': row[0],
+                'nome': row[1],
+                'tipo_conta': row[2],
+                'total_creditos': creditos,
+                'total_debitos': debitos,
+                'saldo': creditos - debitos
+            })
+        resultado.sort(key=lambda c: c['saldo'], reverse=True)
+        return resultado
+
     def fluxo_diario(self, dias=30):
         """Fluxo de caixa diario - ultimos N dias"""
         cursor = self.conn.cursor()
@@ -124,6 +189,12 @@ class FinanceiroDB:
 
     def lancamentos_pendentes(self):
         """Recebiveis e pagaveis pendentes (nao realizados)"""
+        return list(self.iterar_lancamentos_pendentes())
+
+    def iterar_lancamentos_pendentes(self, lote=500):
+        """Como lancamentos_pendentes, mas gera as linhas aos poucos
+        (fetchmany de `lote` linhas), para streaming"""
+        ref = self.referencia.garantir(self.conn)
         cursor = self.conn.cursor()
         cursor.execute("""
             SELECT
@@ -133,29 +204,33 @@ class FinanceiroDB:
                 l.A106TEXTO,
                 l.A106CATIPO,
                 cf.A115NOME,
-                c.A104NOME
+                l.A106FK104COD_CONTA
             FROM I106LANCAMENTO l
             LEFT JOIN I115CLIENTE_FORNENCEDOR cf ON l.A106FK115COD_CLI_FORN = cf.A115COD
-            LEFT JOIN I104CONTAS c ON l.A106FK104COD_CONTA = c.A104COD
             WHERE l.A106REALIZADO = 'N'
               AND l.A106ELIMINADO = 'N'
             ORDER BY l.A106DATA
         """)
 
-        resultado = []
-        for row in cursor.fetchall():
-            resultado.append({
-                'id': row[0],
-                'data': row[1],
-                'valor': float(row[2]) if row[2] else 0,
-                'texto': row[3],
-                'tipo': row[4],
-                'cliente': row[5],
-                'conta': row[6]
-            })
-        cursor.close()
-        return resultado
+        try:
+            while True:
+                rows = cursor.fetchmany(lote)
+                if not rows:
+                    break
+                for row in rows:
+                    yield {
+                        'id': row[0],
+                        'data': row[1],
+                        'valor': float(row[2]) if row[2] else 0,
+                        'texto': row[3],
+                        'tipo': row[4],
+                        'cliente': row[5],
+                        'conta': ref.conta(row[6])
+                    }
+        finally:
+            cursor.close()
 
+    @cacheado(TTL_DESPESAS_RECORRENTES, marcador='marcador_ciclicos')
     def despesas_recorrentes(self):
         """Lista despesas ciclicas/recorrentes"""
         cursor = self.conn.cursor()
@@ -199,29 +274,21 @@ class FinanceiroDB:
                 l.A106CATIPO,
                 l.A106REALIZADO,
                 cf.A115NOME,
-                c.A104NOME,
+                l.A106FK104COD_CONTA,
                 l.A106NUM_DOCUMENTO,
                 l.A106OBSERVACAO,
-                (SELECT LIST(DISTINCT f1.A1NOME, ', ')
-                 FROM M28PROCEDIMENTO_AGENDA pa
-                 INNER JOIN M27AGENDA a ON pa.A28FK27COD_AGENDA = a.A27COD
-                 LEFT JOIN M21PROCEDIMENTO pr ON pa.A28FK21COD_PROCEDIMENTO = pr.A21COD
-                 LEFT JOIN F1PRODUTO f1 ON pr.A21FKF1COD_PRODUTO = f1.A1COD
-                 INNER JOIN M6PACIENTE p ON a.A27FK6COD_PACIENTE = p.A6COD
-                 INNER JOIN I115CLIENTE_FORNENCEDOR pcf ON p.A6FKI115COD = pcf.A115COD
-                 WHERE pcf.A115COD = l.A106FK115COD_CLI_FORN
-                 AND a.A27DATA = l.A106DATA
-                 AND f1.A1NOME IS NOT NULL
-                ) AS PROCEDIMENTOS
+                l.A106FK115COD_CLI_FORN
             FROM I106LANCAMENTO l
             LEFT JOIN I115CLIENTE_FORNENCEDOR cf ON l.A106FK115COD_CLI_FORN = cf.A115COD
-            LEFT JOIN I104CONTAS c ON l.A106FK104COD_CONTA = c.A104COD
             WHERE l.A106ELIMINADO = 'N'
             ORDER BY l.A106DATA DESC, l.A106COD DESC
         """)
+        rows = cursor.fetchall()
+        ref = self.referencia.garantir(self.conn)
+        procedimentos = procedimentos_por_cliente_data(cursor, [(row[10], row[1]) for row in rows], ref)
 
         resultado = []
-        for row in cursor.fetchall():
+        for row in rows:
             resultado.append({
                 'id': row[0],
                 'data': row[1],
@@ -230,10 +297,10 @@ class FinanceiroDB:
                 'tipo': row[4],
                 'status': row[5],
                 'cliente': row[6],
-                'conta': row[7],
+                'conta': ref.conta(row[7]),
                 'num_documento': row[8],
                 'observacao': row[9],
-                'procedimentos': row[10]
+                'procedimentos': procedimentos.get((row[10], row[1]))
             })
         cursor.close()
         return resultado
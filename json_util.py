@@ -0,0 +1,104 @@
+"""
+Codificacao JSON das respostas da interface web - Medicine Dream
+
+- Datas e horas no formato da interface (dd/mm/aaaa hh:mm), Decimal como
+  float e bytes do Firebird (WIN1252) como texto.
+- Conversao por tipo exato (um dicionario, em vez de uma cadeia de
+  isinstance) e separadores compactos.
+- orjson, se instalado, codifica bem mais rapido; senao, json da biblioteca
+  padrao com o mesmo resultado.
+- Compressao gzip ou brotli (se instalado) conforme o Accept-Encoding.
+"""
+
+import gzip
+import json
+from datetime import datetime, date, time
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Corpos menores que isso vao sem compressao (nao compensa)
+COMPRIMIR_MINIMO = 1024
+NIVEL_GZIP = 1
+NIVEL_BROTLI = 4
+
+
+def _texto_firebird(valor):
+    try:
+        return valor.decode('cp1252')
+    except UnicodeDecodeError:
+        return valor.decode('latin-1')
+
+
+# Formatacao com % em vez de strftime (cerca de 2x mais rapida)
+_CONVERSORES = {
+    datetime: lambda v: '%02d/%02d/%04d %02d:%02d' % (v.day, v.month, v.year, v.hour, v.minute),
+    date: lambda v: '%02d/%02d/%04d' % (v.day, v.month, v.year),
+    time: lambda v: '%02d:%02d' % (v.hour, v.minute),
+    Decimal: float,
+    bytes: _texto_firebird,
+}
+
+
+def converter(valor):
+    """Valor JSON para os tipos vindos do Firebird (hook `default`)"""
+    conversor = _CONVERSORES.get(type(valor))
+    if conversor is not None:
+        return conversor(valor)
+    # Subclasses (ex: datetime de outro driver)
+    for tipo, conversor in _CONVERSORES.items():
+        if isinstance(valor, tipo):
+            return conversor(valor)
+    raise TypeError(f'Tipo nao serializavel em JSON: {type(valor).__name__}')
+
+
+class MedicineEncoder(json.JSONEncoder):
+    """Encoder customizado para datetime/date/time/bytes do Firebird"""
+    def default(self, obj):
+        try:
+            return converter(obj)
+        except TypeError:
+            return super().default(obj)
+
+
+if orjson is not None:
+    # PASSTHROUGH_DATETIME: datas passam pelo converter (formato da interface)
+    _OPCOES_ORJSON = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def codificar(dados):
+        """JSON compacto em bytes UTF-8"""
+        return orjson.dumps(dados, default=converter, option=_OPCOES_ORJSON)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=converter)
+
+    def codificar(dados):
+        """JSON compacto em bytes UTF-8"""
+        return _encoder.encode(dados).encode('utf-8')
+
+
+def escolher_codificacao(aceitas):
+    """'br', 'gzip' ou None conforme o Accept-Encoding (werkzeug
+    request.accept_encodings), respeitando q=0 e a preferencia do cliente"""
+    opcoes = []
+    if brotli is not None and aceitas['br']:
+        opcoes.append((aceitas['br'], 1, 'br'))
+    if aceitas['gzip']:
+        opcoes.append((aceitas['gzip'], 0, 'gzip'))
+    return max(opcoes)[2] if opcoes else None
+
+
+def comprimir(corpo, codificacao):
+    """(corpo, codificacao usada); corpos pequenos ficam sem compressao"""
+    if codificacao is None or len(corpo) < COMPRIMIR_MINIMO:
+        return corpo, None
+    if codificacao == 'br':
+        return brotli.compress(corpo, quality=NIVEL_BROTLI), 'br'
+    return gzip.compress(corpo, compresslevel=NIVEL_GZIP, mtime=0), 'gzip'
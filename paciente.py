@@ -2,13 +2,32 @@
 Script para buscar dados completos de pacientes - Medicine Dream
 """
 
+import io
+import logging
 import os
+import queue
+import re
+import sys
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import fdb
 from datetime import datetime, time
 
-# Carregar DLL do Firebird client (64 bits) relativa ao script
+# Carregar o Firebird client relativo ao script: no Windows a DLL 64 bits;
+# nos demais sistemas a libfbclient.so da pasta, se houver - senao o fdb usa
+# a do sistema (pacote libfbclient2 / firebird-client)
 _dir = os.path.dirname(os.path.abspath(__file__))
-fdb.load_api(os.path.join(_dir, 'fbclient.dll'))
+if sys.platform == 'win32':
+    fdb.load_api(os.path.join(_dir, 'fbclient.dll'))
+elif os.path.exists(os.path.join(_dir, 'libfbclient.so')):
+    fdb.load_api(os.path.join(_dir, 'libfbclient.so'))
+
+from pool import BaseDB, PoolConexoes
+from referencia import cache_referencia
+from paginacao import Paginacao, NULO_HORA, NULO_DATA_HORA
+
+log = logging.getLogger(__name__)
 
 CONFIG = {
     'host': 'recepcao-novo',
@@ -19,6 +38,18 @@ CONFIG = {
     'charset': 'WIN1252'
 }
 
+# Pool de conexoes usado pela interface web (ver pool.PoolConexoes)
+# timeout: segundos aguardando conexao livre; ociosa_max/vida_max em segundos
+# maximo: uma por thread de request mais as PRONTUARIO_THREADS (app.py); o
+# asgi.py reparte o que sobra entre os limites por rota
+POOL_CONFIG = {
+    'minimo': 2,
+    'maximo': 20,
+    'timeout': 30,
+    'ociosa_max': 300,
+    'vida_max': 3600,
+}
+
 # PDFs ficam em bancos Firebird separados (shards)
 # Formula: blob_db_num = (blob_id // 5000) + 1
 # Caminho: BLOB_BASE_PATH\Medicine_blob{N}.fdb
@@ -28,6 +59,29 @@ BLOB_CONFIG = {
     'password': 'masterkey',
     'charset': 'WIN1252'
 }
+BLOBS_POR_SHARD = 5000
+
+# Cada shard tem seu pool, criado no primeiro acesso (ver pool_blob)
+BLOB_POOL_CONFIG = {
+    'minimo': 0,
+    'maximo': 4,
+    'timeout': 30,
+    'ociosa_max': 600,
+    'vida_max': 3600,
+}
+
+# Tamanho de cada leitura do A999BLOB no streaming de PDFs
+PEDACO_BLOB = 64 * 1024
+
+# Pre-carga no cache_pdf dos N PDFs mais recentes quando a lista de PDFs do
+# paciente e carregada (0 = desligado). Threads = pre-cargas simultaneas.
+PREFETCH_PDFS = 0
+PREFETCH_THREADS = 2
+
+# Exportacao ZIP dos PDFs do paciente: shards lidos em paralelo e pedacos
+# lidos a frente (por thread) antes de esperar a vez de entrar no ZIP
+EXPORTACAO_THREADS = 3
+EXPORTACAO_FILA = 16
 
 # Mapeamento de tipos de documentos
 TIPOS_DOCUMENTO = {
@@ -61,30 +115,376 @@ SITUACOES_AGENDA = {
 }
 
 
-class MedicineDB:
-    def __init__(self):
-        self.conn = None
+# Chaves da paginacao (parametro `apos`) de cada listagem do prontuario,
+# em ordem decrescente; a ultima chave desempata
+PAGINACAO = {
+    'consultas': Paginacao(
+        'consultas', ('a.A27DATA', 'data'), ('a.A27HORA_INI_AGENDA', 'hora', NULO_HORA),
+        ('a.A27COD', 'id')),
+    'evolucoes': Paginacao(
+        'evolucoes', ('a.A27DATA', 'data'), ('a.A27HORA_INI_AGENDA', 'hora', NULO_HORA),
+        ('a.A27COD', 'id_agenda'), ('t.A51ITEM_PALHETA', 'palheta')),
+    'receitas': Paginacao(
+        'receitas', ('r.A54DATA_HORA', 'data_hora', NULO_DATA_HORA), ('r.A54COD', 'id')),
+    'documentos': Paginacao(
+        'documentos', ('d.A171DATA_HORA', 'data_hora', NULO_DATA_HORA), ('d.A171COD', 'id')),
+    'procedimentos': Paginacao(
+        'procedimentos', ('a.A27DATA', 'data'), ('a.A27HORA_INI_AGENDA', 'hora', NULO_HORA),
+        ('a.A27COD', 'id_agenda'), ('pa.A28COD', 'id')),
+    'financeiro': Paginacao(
+        'financeiro', ('l.A106DATA', 'data'), ('l.A106COD', 'id')),
+    'pdfs': Paginacao(
+        'pdfs', ('d.A250DATA_INSERCAO', 'data', NULO_DATA_HORA), ('d.A250ITEM', 'id')),
+}
+
+# Marcadores de mudanca por paciente (ETag das abas do prontuario): agregados
+# que percorrem so o indice da FK do paciente e mudam quando uma linha entra,
+# sai ou muda de situacao. Tres colunas VARCHAR para caber no UNION ALL.
+MARCADORES_PACIENTE = {
+    'agenda': """
+        SELECT 'agenda', CAST(COUNT(*) AS VARCHAR(40)), CAST(MAX(A27COD) AS VARCHAR(40)),
+               CAST(SUM(A27FK84COD_SITUACAO) AS VARCHAR(40))
+        FROM M27AGENDA WHERE A27FK6COD_PACIENTE = ?""",
+    'evolucoes': """
+        SELECT 'evolucoes', CAST(COUNT(*) AS VARCHAR(40)), CAST(MAX(t.A51COD_AGENDA) AS VARCHAR(40)), NULL
+        FROM M51ATENDIMENTO_AGENDA_TEXTO t
+        INNER JOIN M27AGENDA a ON t.A51COD_AGENDA = a.A27COD
+        WHERE a.A27FK6COD_PACIENTE = ? AND t.A51TEXTO IS NOT NULL""",
+    'preconsultas': """
+        SELECT 'preconsultas', CAST(COUNT(*) AS VARCHAR(40)), CAST(MAX(A74DATA) AS VARCHAR(40)), NULL
+        FROM M74PRECONSULTA WHERE A74FK6COD_PACIENTE = ?""",
+    'receitas': """
+        SELECT 'receitas', CAST(COUNT(*) AS VARCHAR(40)), CAST(MAX(A54COD) AS VARCHAR(40)), NULL
+        FROM M54RECEITA_PRESCRITA WHERE A54FK6COD_PACIENTE = ?""",
+    'documentos': """
+        SELECT 'documentos', CAST(COUNT(*) AS VARCHAR(40)), CAST(MAX(A171COD) AS VARCHAR(40)), NULL
+        FROM M171DOCUMENTOS WHERE A171FK6COD_PACIENTE = ?""",
+    'procedimentos': """
+        SELECT 'procedimentos', CAST(COUNT(*) AS VARCHAR(40)), CAST(SUM(pa.A28VALOR) AS VARCHAR(40)),
+               CAST(SUM(pa.A28QT) AS VARCHAR(40))
+        FROM M28PROCEDIMENTO_AGENDA pa
+        INNER JOIN M27AGENDA a ON pa.A28FK27COD_AGENDA = a.A27COD
+        WHERE a.A27FK6COD_PACIENTE = ?""",
+    'financeiro': """
+        SELECT 'financeiro', CAST(COUNT(*) AS VARCHAR(40)), CAST(MAX(l.A106COD) AS VARCHAR(40)),
+               CAST(COUNT(l.A106DATA_REALIZADO) AS VARCHAR(40))
+        FROM I106LANCAMENTO l
+        INNER JOIN M6PACIENTE p ON l.A106FK115COD_CLI_FORN = p.A6FKI115COD
+        WHERE p.A6COD = ? AND l.A106ELIMINADO = 'N'""",
+    'pdfs': """
+        SELECT 'pdfs', CAST(COUNT(*) AS VARCHAR(40)), CAST(MAX(A250ITEM) AS VARCHAR(40)), NULL
+        FROM M250DOCUMENTOS_OLE WHERE A250FK6COD_PACIENTE = ?""",
+}
+
+# Marcadores que cada aba do prontuario usa
+MARCADORES_SECAO = {
+    'consultas': ('agenda', 'evolucoes'),
+    'evolucoes': ('agenda', 'evolucoes'),
+    'preconsultas': ('preconsultas',),
+    'receitas': ('receitas',),
+    'documentos': ('documentos',),
+    'procedimentos': ('agenda', 'procedimentos'),
+    'financeiro': ('financeiro',),
+    'pdfs': ('pdfs',),
+}
 
-    def conectar(self):
-        """Estabelece conexao com o banco"""
-        self.conn = fdb.connect(**CONFIG)
-        return self
+# Firebird 2.5 aceita no maximo 1500 itens em um IN (...)
+LOTE_IN = 500
 
-    def desconectar(self):
-        """Fecha conexao"""
-        if self.conn:
-            self.conn.close()
 
-    def __enter__(self):
-        return self.conectar()
+def em_lotes(valores, tamanho=LOTE_IN):
+    """Divide `valores` em listas de ate `tamanho` itens (para IN em lote)"""
+    valores = list(valores)
+    for i in range(0, len(valores), tamanho):
+        yield valores[i:i + tamanho]
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.desconectar()
+
+def placeholders(lote):
+    """'?, ?, ?' com um marcador por item do lote"""
+    return ', '.join('?' * len(lote))
+
+
+def procedimentos_por_cliente_data(cursor, pares, ref):
+    """Nomes (F1PRODUTO) dos procedimentos agendados por cliente e data.
+
+    pares: iteravel de (A115COD do cliente, data); ref: CacheReferencia.
+    Retorna {(cliente, data): 'PRODUTO1, PRODUTO2'} so para os pares com
+    procedimento. Uma consulta por lote de clientes, restrita ao intervalo de
+    datas dos pares, em vez de uma subconsulta por lancamento."""
+    pares = {(cli, data) for cli, data in pares if cli is not None and data is not None}
+    if not pares:
+        return {}
+    clientes = {cli for cli, _ in pares}
+    datas = [data for _, data in pares]
+
+    nomes = {}
+    for lote in em_lotes(clientes):
+        cursor.execute(f"""
+            SELECT DISTINCT p.A6FKI115COD, a.A27DATA, pa.A28FK21COD_PROCEDIMENTO
+            FROM M27AGENDA a
+            INNER JOIN M6PACIENTE p ON a.A27FK6COD_PACIENTE = p.A6COD
+            INNER JOIN M28PROCEDIMENTO_AGENDA pa ON pa.A28FK27COD_AGENDA = a.A27COD
+            WHERE p.A6FKI115COD IN ({placeholders(lote)})
+              AND a.A27DATA BETWEEN ? AND ?
+        """, lote + [min(datas), max(datas)])
+        for cli, data, procedimento in cursor.fetchall():
+            if (cli, data) in pares:
+                nomes.setdefault((cli, data), []).append(ref.procedimento_nome(procedimento))
+
+    procedimentos = {}
+    for par, lista in nomes.items():
+        texto = ref.lista(lista)
+        if texto:
+            procedimentos[par] = texto
+    return procedimentos
+
+
+_pools_blob = {}
+_pools_blob_lock = threading.Lock()
+
+
+def shard_do_blob(blob_id):
+    """Numero N do banco Medicine_blob{N}.fdb que guarda o blob"""
+    return (blob_id // BLOBS_POR_SHARD) + 1
+
+
+def pool_blob(blob_db_num):
+    """Pool de conexoes do shard Medicine_blob{N}.fdb (criado sob demanda)"""
+    pool = _pools_blob.get(blob_db_num)
+    if pool is None:
+        with _pools_blob_lock:
+            pool = _pools_blob.get(blob_db_num)
+            if pool is None:
+                config = {
+                    'host': CONFIG['host'],
+                    'port': CONFIG['port'],
+                    'database': os.path.join(BLOB_BASE_PATH, f'Medicine_blob{blob_db_num}.fdb'),
+                    'user': BLOB_CONFIG['user'],
+                    'password': BLOB_CONFIG['password'],
+                    'charset': BLOB_CONFIG['charset']
+                }
+                pool = PoolConexoes(config, **BLOB_POOL_CONFIG)
+                _pools_blob[blob_db_num] = pool
+    return pool
+
+
+class BlobPDF:
+    """A999BLOB aberto para leitura em pedacos (BlobReader do fdb).
+
+    Segura a conexao do pool do shard ate fechar(); ler() fecha sozinho ao
+    terminar, e fechar() pode ser chamado de novo sem efeito."""
+
+    def __init__(self, pool, conn, cursor, blob, tamanho):
+        self.pool = pool
+        self.conn = conn
+        self.cursor = cursor
+        self.blob = blob
+        self.tamanho = tamanho
+
+    def _posicionar(self, inicio):
+        """Vai ate `inicio`; blob segmentado nao aceita seek: le e descarta"""
+        if not inicio:
+            return
+        try:
+            self.blob.seek(inicio)
+            return
+        except Exception:
+            pass
+        restante = inicio
+        while restante > 0:
+            dados = self.blob.read(min(PEDACO_BLOB, restante))
+            if not dados:
+                break
+            restante -= len(dados)
+
+    def ler(self, inicio=0, fim=None, pedaco=PEDACO_BLOB):
+        """Gera os bytes de [inicio, fim) em pedacos de ate `pedaco` bytes"""
+        fim = self.tamanho if fim is None else fim
+        try:
+            self._posicionar(inicio)
+            restante = fim - inicio
+            while restante > 0:
+                dados = self.blob.read(min(pedaco, restante))
+                if not dados:
+                    break
+                restante -= len(dados)
+                yield dados
+        finally:
+            self.fechar()
+
+    def fechar(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        try:
+            self.blob.close()
+            self.cursor.close()
+        except Exception:
+            pass
+        self.pool.devolver(conn)
+
+
+def consultar_blob(cursor, blob_id):
+    """(tamanho, leitor) do A999BLOB sem materializar os bytes, ou None"""
+    cursor.set_stream_blob('A999BLOB')
+    cursor.execute("""
+        SELECT OCTET_LENGTH(A999BLOB), A999BLOB
+        FROM M999BLOBS
+        WHERE A999COD = ?
+    """, (blob_id,))
+    row = cursor.fetchone()
+    if not row or row[1] is None:
+        return None
+    blob = row[1]
+    if not hasattr(blob, 'read'):
+        blob = io.BytesIO(bytes(blob))
+    return row[0], blob
+
+
+class PrefetchPDFs:
+    """Aquece o cache_pdf com os PDFs que o usuario provavelmente vai abrir.
+
+    Os blob_ids sao agrupados por shard: cada tarefa pega uma conexao do
+    pool do shard e grava todos os PDFs dele em sequencia. As threads sao
+    criadas no primeiro uso (depois de um eventual fork) e a fila e limitada:
+    pedidos alem de `maximo_pendentes` sao ignorados."""
+
+    def __init__(self, cache_pdf, quantidade=PREFETCH_PDFS, threads=PREFETCH_THREADS,
+                 maximo_pendentes=100):
+        self.cache_pdf = cache_pdf
+        self.quantidade = quantidade
+        self.threads = threads
+        self.maximo_pendentes = maximo_pendentes
+        self._executor = None
+        self._pendentes = set()
+        self._lock = threading.Lock()
+
+    def agendar(self, blob_ids):
+        """Agenda a pre-carga dos primeiros `quantidade` blob_ids fora do cache"""
+        por_shard = {}
+        with self._lock:
+            for blob_id in blob_ids[:self.quantidade]:
+                if (blob_id is None or blob_id in self._pendentes
+                        or self.cache_pdf.contem(blob_id)
+                        or len(self._pendentes) >= self.maximo_pendentes):
+                    continue
+                self._pendentes.add(blob_id)
+                por_shard.setdefault(shard_do_blob(blob_id), []).append(blob_id)
+            if not por_shard:
+                return 0
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='prefetch_pdf')
+        for shard, ids in por_shard.items():
+            self._executor.submit(self._carregar_shard, shard, ids)
+        return sum(len(ids) for ids in por_shard.values())
+
+    def _carregar_shard(self, shard, blob_ids):
+        try:
+            with pool_blob(shard).conexao() as conn_blob:
+                cursor = conn_blob.cursor()
+                try:
+                    for blob_id in blob_ids:
+                        if self.cache_pdf.contem(blob_id):
+                            continue
+                        achado = consultar_blob(cursor, blob_id)
+                        if achado is None:
+                            continue
+                        blob = achado[1]
+                        try:
+                            self.cache_pdf.gravar(blob_id, iter(lambda: blob.read(PEDACO_BLOB), b''))
+                        finally:
+                            blob.close()
+                finally:
+                    cursor.close()
+        except Exception:
+            # Pre-carga e so otimizacao: o PDF sera lido do banco ao ser aberto
+            log.warning("Prefetch de PDFs do shard %s falhou", shard, exc_info=True)
+        finally:
+            with self._lock:
+                self._pendentes.difference_update(blob_ids)
+
+    def fechar(self):
+        """Espera as pre-cargas em andamento e encerra as threads"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class _SaidaZip:
+    """Destino do zipfile sem seek: acumula os bytes ate serem retirados"""
+
+    def __init__(self):
+        self.partes = []
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def retirar(self):
+        dados = b''.join(self.partes)
+        self.partes = []
+        return dados
+
+
+class _ExportacaoCancelada(Exception):
+    pass
+
+
+_CARACTERES_INVALIDOS = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+
+
+def nome_entrada_zip(pdf, usados):
+    """Nome do PDF dentro do ZIP: sem caracteres invalidos, com .pdf e unico"""
+    nome = pdf['nome']
+    if isinstance(nome, bytes):
+        nome = nome.decode('cp1252', errors='replace')
+    nome = _CARACTERES_INVALIDOS.sub('_', nome or '').strip(' ._')[:120]
+    if not nome:
+        nome = f"documento_{pdf['id']}"
+    if nome.lower().endswith('.pdf'):
+        nome = nome[:-4]
+    if pdf['data']:
+        nome = f"{pdf['data']:%Y-%m-%d} {nome}"
+    candidato = f'{nome}.pdf'
+    n = 2
+    while candidato.lower() in usados:
+        candidato = f'{nome} ({n}).pdf'
+        n += 1
+    usados.add(candidato.lower())
+    return candidato
+
+
+def fechar_pools_blob():
+    """Fecha as conexoes de todos os shards abertos"""
+    with _pools_blob_lock:
+        pools = list(_pools_blob.values())
+        _pools_blob.clear()
+    for pool in pools:
+        pool.fechar()
+
+
+class MedicineDB(BaseDB):
+    def __init__(self, pool=None, indice_nomes=None, referencia=None, cache_pdf=None):
+        super().__init__(CONFIG, pool)
+        # busca.IndiceNomes opcional: busca por nome sem acento, ranqueada e
+        # tolerante a erros de digitacao, sem ir ao Firebird a cada tecla
+        self.indice_nomes = indice_nomes
+        # Nomes de profissionais, procedimentos, convenios e contas (referencia.py)
+        self.referencia = referencia if referencia is not None else cache_referencia
+        # cache_pdf.CachePDF opcional: PDFs ja lidos ficam em disco local
+        self.cache_pdf = cache_pdf
+        self.prefetch = None
+        if cache_pdf is not None and PREFETCH_PDFS > 0:
+            self.prefetch = PrefetchPDFs(cache_pdf, PREFETCH_PDFS, PREFETCH_THREADS)
 
     # ==================== PACIENTE ====================
 
     def buscar_paciente_por_id(self, id_paciente):
-        """Busca paciente pelo ID do paciente (A6COD)"""
+        """Busca paciente pelo ID do paciente (A6COD) com telefones, emails e documentos"""
         cursor = self.conn.cursor()
 
         cursor.execute("""
@@ -105,21 +505,20 @@ class MedicineDB:
                 p.A6GRUPO_SANGUINEO,
                 p.A6FATOR_RH,
                 p.A6DATA_HORA_CADASTRO,
-                conv_cli.A115NOME AS CONVENIO_NOME,
                 p.A6FK5COD_CONVENIO
             FROM M6PACIENTE p
             INNER JOIN I115CLIENTE_FORNENCEDOR cf ON p.A6FKI115COD = cf.A115COD
             LEFT JOIN I135PESSOA_FISICA pf ON cf.A115COD = pf.A135FK115COD
-            LEFT JOIN M5CONVENIO conv ON p.A6FK5COD_CONVENIO = conv.A5COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR conv_cli ON conv.A5FKI115COD = conv_cli.A115COD
             WHERE p.A6COD = ?
         """, (id_paciente,))
 
         row = cursor.fetchone()
         if not row:
+            cursor.close()
             return None
 
         id_cliente = row[1]
+        ref = self.referencia.garantir(self.conn)
 
         paciente = {
             'id': row[0],
@@ -139,72 +538,108 @@ class MedicineDB:
             'matricula': row[12],
             'tipo_sanguineo': f"{row[13]}{row[14]}" if row[13] else None,
             'data_cadastro': row[15],
-            'convenio': row[16],
-            'convenio_id': row[17],
+            'convenio': ref.convenio(row[16]),
+            'convenio_id': row[16],
             'telefones': [],
             'emails': [],
             'documentos': {}
         }
 
-        # Telefones
+        # Telefones, emails e documentos em um unico UNION ALL marcado pela origem:
+        # T=I128TELEFONES, E=I129END_ELETRONICO, N=I130DOC_NUMERICO, S=I131DOC_STRING
         cursor.execute("""
-            SELECT A128NUMERO, A128TIPO, A128COD_AREA, A128CONTATO
+            SELECT 'T', CAST(A128TIPO AS VARCHAR(20)),
+                   CAST(A128NUMERO AS VARCHAR(255)), CAST(A128COD_AREA AS VARCHAR(255)),
+                   CAST(A128CONTATO AS VARCHAR(255)), CAST(NULL AS BIGINT)
             FROM I128TELEFONES
             WHERE A128FK115COD_CLI_FOR = ?
-        """, (id_cliente,))
-
-        for tel in cursor.fetchall():
-            paciente['telefones'].append({
-                'numero': f"({tel[2]}) {tel[0]}" if tel[2] else tel[0],
-                'tipo': tel[1],
-                'contato': tel[3]
-            })
-
-        # Emails
-        cursor.execute("""
-            SELECT A129ENDERECO, A129TIPO, A129CONTATO
+            UNION ALL
+            SELECT 'E', CAST(A129TIPO AS VARCHAR(20)),
+                   CAST(A129ENDERECO AS VARCHAR(255)), NULL,
+                   CAST(A129CONTATO AS VARCHAR(255)), NULL
             FROM I129END_ELETRONICO
             WHERE A129FK115COD_CLI_FOR = ?
-        """, (id_cliente,))
-
-        for email in cursor.fetchall():
-            paciente['emails'].append({
-                'endereco': email[0],
-                'tipo': email[1],
-                'contato': email[2]
-            })
-
-        # Documentos numericos
-        cursor.execute("""
-            SELECT A130TIPO, A130DOCUMENTO
+            UNION ALL
+            SELECT 'N', CAST(A130TIPO AS VARCHAR(20)),
+                   NULL, NULL, NULL, CAST(A130DOCUMENTO AS BIGINT)
             FROM I130DOC_NUMERICO
             WHERE A130FK115COD_CLI_FOR = ?
-        """, (id_cliente,))
-
-        for doc in cursor.fetchall():
-            tipo = doc[0] or 'OUTRO'
-            paciente['documentos'][f'NUM_{tipo}'] = doc[1]
-
-        # Documentos string
-        cursor.execute("""
-            SELECT A131TIPO, A131DOCUMENTO
+            UNION ALL
+            SELECT 'S', CAST(A131TIPO AS VARCHAR(20)),
+                   CAST(A131DOCUMENTO AS VARCHAR(255)), NULL, NULL, NULL
             FROM I131DOC_STRING
             WHERE A131FK115COD_CLI_FOR = ?
-        """, (id_cliente,))
-
-        for doc in cursor.fetchall():
-            tipo = doc[0] or 'OUTRO'
-            paciente['documentos'][f'STR_{tipo}'] = doc[1]
+        """, (id_cliente, id_cliente, id_cliente, id_cliente))
+
+        for origem, tipo, texto, extra, contato, numero in cursor.fetchall():
+            if origem == 'T':
+                paciente['telefones'].append({
+                    'numero': f"({extra}) {texto}" if extra else texto,
+                    'tipo': tipo,
+                    'contato': contato
+                })
+            elif origem == 'E':
+                paciente['emails'].append({
+                    'endereco': texto,
+                    'tipo': tipo,
+                    'contato': contato
+                })
+            elif origem == 'N':
+                paciente['documentos'][f'NUM_{tipo or "OUTRO"}'] = numero
+            else:
+                paciente['documentos'][f'STR_{tipo or "OUTRO"}'] = texto
 
         cursor.close()
         return paciente
 
-    def buscar_paciente_por_nome(self, nome):
-        """Busca pacientes pelo nome (parcial)"""
+    def marcadores_paciente(self, id_paciente, secoes):
+        """Valores dos marcadores de mudanca das abas `secoes` do paciente,
+        em uma unica consulta (UNION ALL). Base do ETag das abas."""
+        grupos = sorted({g for secao in secoes for g in MARCADORES_SECAO.get(secao, ())})
+        if not grupos:
+            return ()
+        cursor = self.conn.cursor()
+        cursor.execute(" UNION ALL ".join(MARCADORES_PACIENTE[g] for g in grupos),
+                       [id_paciente] * len(grupos))
+        valores = tuple(sorted((tuple(row) for row in cursor.fetchall()), key=lambda r: r[0]))
+        cursor.close()
+        return valores
+
+    def buscar_paciente_resumo(self, id_paciente):
+        """Busca apenas id/nome/nascimento do paciente (A6COD) - para resultados de busca"""
         cursor = self.conn.cursor()
 
         cursor.execute("""
-            SELECT FIRST 20
+            SELECT
+                p.A6COD,
+                cf.A115NOME,
+                pf.A135DATA_NASCIMENTO
+            FROM M6PACIENTE p
+            INNER JOIN I115CLIENTE_FORNENCEDOR cf ON p.A6FKI115COD = cf.A115COD
+            LEFT JOIN I135PESSOA_FISICA pf ON cf.A115COD = pf.A135FK115COD
+            WHERE p.A6COD = ?
+        """, (id_paciente,))
+
+        row = cursor.fetchone()
+        cursor.close()
+        if not row:
+            return None
+        return {
+            'id': row[0],
+            'nome': row[1],
+            'data_nascimento': row[2]
+        }
+
+    def buscar_paciente_por_nome(self, nome, limite=20):
+        """Busca pacientes pelo nome (parcial). Com indice_nomes, ignora acentos,
+        tolera erros de digitacao e ordena pelos melhores resultados."""
+        if self.indice_nomes is not None:
+            return self.indice_nomes.garantir(self.conn).buscar(nome, limite)
+
+        cursor = self.conn.cursor()
+
+        cursor.execute(f"""
+            SELECT FIRST {int(limite)}
                 p.A6COD,
                 cf.A115NOME,
                 pf.A135DATA_NASCIMENTO
@@ -257,8 +692,11 @@ class MedicineDB:
 
     # ==================== PRONTUARIO ====================
 
-    def buscar_consultas(self, id_paciente, limite=20):
-        """Busca historico de consultas/agendamentos do paciente"""
+    def buscar_consultas(self, id_paciente, limite=20, apos=None):
+        """Busca historico de consultas/agendamentos do paciente.
+        apos: cursor da pagina anterior (paginacao.Paginacao.cursor)"""
+        pagina = PAGINACAO['consultas']
+        filtro, params = pagina.filtro(apos)
         cursor = self.conn.cursor()
 
         cursor.execute(f"""
@@ -266,54 +704,55 @@ class MedicineDB:
                 a.A27COD,
                 a.A27DATA,
                 a.A27HORA_INI_AGENDA,
-                uc.A115NOME AS PROFISSIONAL,
+                a.A27FK31COD_USUARIO,
                 a.A27FK84COD_SITUACAO,
                 a.A27OBSERVACAO,
                 a.A27ANOTACAO
             FROM M27AGENDA a
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
             WHERE a.A27FK6COD_PACIENTE = ?
-            ORDER BY a.A27DATA DESC, a.A27HORA_INI_AGENDA DESC
-        """, (id_paciente,))
+            {filtro}
+            {pagina.order_by()}
+        """, [id_paciente] + params)
 
+        ref = self.referencia.garantir(self.conn)
         consultas = []
         for row in cursor.fetchall():
-            consulta = {
+            consultas.append({
                 'id': row[0],
                 'data': row[1],
                 'hora': row[2],
-                'profissional': row[3],
+                'profissional': ref.profissional(row[3]),
                 'situacao': row[4],
                 'observacao': row[5],
                 'anotacao': row[6],
                 'textos': []  # Textos de atendimento da consulta
-            }
+            })
 
-            # Buscar textos de atendimento desta consulta (M51)
-            cursor2 = self.conn.cursor()
-            cursor2.execute("""
-                SELECT A51ITEM_PALHETA, A51TEXTO
+        # Textos de atendimento (M51) de todas as consultas em uma unica query
+        por_agenda = {c['id']: c['textos'] for c in consultas}
+        for lote in em_lotes(por_agenda):
+            cursor.execute(f"""
+                SELECT A51COD_AGENDA, A51ITEM_PALHETA, A51TEXTO
                 FROM M51ATENDIMENTO_AGENDA_TEXTO
-                WHERE A51COD_AGENDA = ?
-                ORDER BY A51ITEM_PALHETA
-            """, (row[0],))
-
-            for texto_row in cursor2.fetchall():
-                if texto_row[1]:  # Se tem texto
-                    consulta['textos'].append({
-                        'palheta': texto_row[0],
-                        'texto': texto_row[1]
+                WHERE A51COD_AGENDA IN ({placeholders(lote)})
+                AND A51TEXTO IS NOT NULL
+                ORDER BY A51COD_AGENDA, A51ITEM_PALHETA
+            """, lote)
+
+            for texto_row in cursor.fetchall():
+                if texto_row[2]:  # Se tem texto
+                    por_agenda[texto_row[0]].append({
+                        'palheta': texto_row[1],
+                        'texto': texto_row[2]
                     })
-            cursor2.close()
-
-            consultas.append(consulta)
 
         cursor.close()
         return consultas
 
-    def buscar_evolucoes(self, id_paciente, limite=20):
+    def buscar_evolucoes(self, id_paciente, limite=20, apos=None):
         """Busca evolucoes/textos de atendimento do paciente (M51)"""
+        pagina = PAGINACAO['evolucoes']
+        filtro, params = pagina.filtro(apos)
         cursor = self.conn.cursor()
 
         cursor.execute(f"""
@@ -321,25 +760,25 @@ class MedicineDB:
                 a.A27COD,
                 a.A27DATA,
                 a.A27HORA_INI_AGENDA,
-                uc.A115NOME AS PROFISSIONAL,
+                a.A27FK31COD_USUARIO,
                 t.A51ITEM_PALHETA,
                 t.A51TEXTO
             FROM M51ATENDIMENTO_AGENDA_TEXTO t
             INNER JOIN M27AGENDA a ON t.A51COD_AGENDA = a.A27COD
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
             WHERE a.A27FK6COD_PACIENTE = ?
             AND t.A51TEXTO IS NOT NULL
-            ORDER BY a.A27DATA DESC, a.A27HORA_INI_AGENDA DESC
-        """, (id_paciente,))
+            {filtro}
+            {pagina.order_by()}
+        """, [id_paciente] + params)
 
+        ref = self.referencia.garantir(self.conn)
         evolucoes = []
         for row in cursor.fetchall():
             evolucoes.append({
                 'id_agenda': row[0],
                 'data': row[1],
                 'hora': row[2],
-                'profissional': row[3],
+                'profissional': ref.profissional(row[3]),
                 'palheta': row[4],
                 'texto': row[5]
             })
@@ -347,29 +786,31 @@ class MedicineDB:
         cursor.close()
         return evolucoes
 
-    def buscar_documentos(self, id_paciente, limite=20):
+    def buscar_documentos(self, id_paciente, limite=20, apos=None):
         """Busca documentos do prontuario do paciente"""
+        pagina = PAGINACAO['documentos']
+        filtro, params = pagina.filtro(apos)
         cursor = self.conn.cursor()
 
         cursor.execute(f"""
             SELECT FIRST {limite}
                 d.A171COD,
                 d.A171DATA_HORA,
-                uc.A115NOME AS PROFISSIONAL,
+                d.A171FK31COD_USUARIO,
                 d.A171DOCUMENTO
             FROM M171DOCUMENTOS d
-            LEFT JOIN M31USUARIO u ON d.A171FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
             WHERE d.A171FK6COD_PACIENTE = ?
-            ORDER BY d.A171DATA_HORA DESC
-        """, (id_paciente,))
+            {filtro}
+            {pagina.order_by()}
+        """, [id_paciente] + params)
 
+        ref = self.referencia.garantir(self.conn)
         documentos = []
         for row in cursor.fetchall():
             documentos.append({
                 'id': row[0],
                 'data_hora': row[1],
-                'profissional': row[2],
+                'profissional': ref.profissional(row[2]),
                 'conteudo': row[3]
             })
 
@@ -419,59 +860,62 @@ class MedicineDB:
         cursor.close()
         return preconsultas
 
-    def buscar_receitas(self, id_paciente, limite=20):
+    def buscar_receitas(self, id_paciente, limite=20, apos=None):
         """Busca receitas prescritas do paciente"""
+        pagina = PAGINACAO['receitas']
+        filtro, params = pagina.filtro(apos)
         cursor = self.conn.cursor()
 
         cursor.execute(f"""
             SELECT FIRST {limite}
                 r.A54COD,
                 r.A54DATA_HORA,
-                uc.A115NOME AS PROFISSIONAL,
+                r.A54FK31COD_USUARIO,
                 r.A54OBSERVACAO
             FROM M54RECEITA_PRESCRITA r
-            LEFT JOIN M31USUARIO u ON r.A54FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
             WHERE r.A54FK6COD_PACIENTE = ?
-            ORDER BY r.A54DATA_HORA DESC
-        """, (id_paciente,))
+            {filtro}
+            {pagina.order_by()}
+        """, [id_paciente] + params)
 
+        ref = self.referencia.garantir(self.conn)
         receitas = []
         for row in cursor.fetchall():
-            receita = {
+            receitas.append({
                 'id': row[0],
                 'data_hora': row[1],
-                'profissional': row[2],
+                'profissional': ref.profissional(row[2]),
                 'observacao': row[3],
                 'itens': []
-            }
+            })
 
-            # Buscar itens da receita
-            cursor2 = self.conn.cursor()
-            cursor2.execute("""
-                SELECT A55DESCRICAO_MEDICAMENTO, A55POSOLOGIA, A55QT_PRESCRITO
+        # Itens de todas as receitas, agrupados por A55FK54COD_RECEITA
+        # (um IN por lote de LOTE_IN receitas em vez de uma query por receita)
+        por_receita = {r['id']: r['itens'] for r in receitas}
+        for lote in em_lotes(por_receita):
+            cursor.execute(f"""
+                SELECT A55FK54COD_RECEITA, A55DESCRICAO_MEDICAMENTO, A55POSOLOGIA, A55QT_PRESCRITO
                 FROM M55ITENS_PRESCRITOS
-                WHERE A55FK54COD_RECEITA = ?
-                ORDER BY A55ITEM
-            """, (row[0],))
-
-            for item in cursor2.fetchall():
-                receita['itens'].append({
-                    'medicamento': item[0],
-                    'posologia': item[1],
-                    'quantidade': item[2]
+                WHERE A55FK54COD_RECEITA IN ({placeholders(lote)})
+                ORDER BY A55FK54COD_RECEITA, A55ITEM
+            """, lote)
+
+            for item in cursor.fetchall():
+                por_receita[item[0]].append({
+                    'medicamento': item[1],
+                    'posologia': item[2],
+                    'quantidade': item[3]
                 })
-            cursor2.close()
-
-            receitas.append(receita)
 
         cursor.close()
         return receitas
 
     # ==================== PDFs (M250/M999 BLOBS) ====================
 
-    def buscar_pdfs(self, id_paciente, limite=50):
+    def buscar_pdfs(self, id_paciente, limite=50, apos=None):
         """Busca lista de PDFs do paciente (M250DOCUMENTOS_OLE)"""
+        pagina = PAGINACAO['pdfs']
+        filtro, params = pagina.filtro(apos)
         cursor = self.conn.cursor()
 
         cursor.execute(f"""
@@ -483,8 +927,9 @@ class MedicineDB:
                 d.A250TIPO_DOCUMENTO
             FROM M250DOCUMENTOS_OLE d
             WHERE d.A250FK6COD_PACIENTE = ?
-            ORDER BY d.A250DATA_INSERCAO DESC
-        """, (id_paciente,))
+            {filtro}
+            {pagina.order_by()}
+        """, [id_paciente] + params)
 
         pdfs = []
         for row in cursor.fetchall():
@@ -501,40 +946,44 @@ class MedicineDB:
 
     # ==================== PROCEDIMENTOS (M28/M21/F1) ====================
 
-    def buscar_procedimentos(self, id_paciente, limite=100):
+    def buscar_procedimentos(self, id_paciente, limite=100, apos=None):
         """Busca procedimentos realizados pelo paciente"""
+        pagina = PAGINACAO['procedimentos']
+        filtro, params = pagina.filtro(apos)
         cursor = self.conn.cursor()
 
         cursor.execute(f"""
             SELECT FIRST {limite}
                 a.A27DATA,
                 a.A27HORA_INI_AGENDA,
-                f1.A1NOME AS PROCEDIMENTO,
+                pa.A28FK21COD_PROCEDIMENTO,
                 pa.A28VALOR,
                 pa.A28QT,
-                g.A15NOME AS GRUPO,
-                uc.A115NOME AS PROFISSIONAL
+                pa.A28FK15COD_GRUPO,
+                a.A27FK31COD_USUARIO,
+                a.A27COD,
+                pa.A28COD
             FROM M28PROCEDIMENTO_AGENDA pa
             INNER JOIN M27AGENDA a ON pa.A28FK27COD_AGENDA = a.A27COD
-            LEFT JOIN M21PROCEDIMENTO p ON pa.A28FK21COD_PROCEDIMENTO = p.A21COD
-            LEFT JOIN F1PRODUTO f1 ON p.A21FKF1COD_PRODUTO = f1.A1COD
-            LEFT JOIN M15GRUPO_PROCEDIMENTO g ON pa.A28FK15COD_GRUPO = g.A15COD
-            LEFT JOIN M31USUARIO u ON a.A27FK31COD_USUARIO = u.A31COD
-            LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
             WHERE a.A27FK6COD_PACIENTE = ?
-            ORDER BY a.A27DATA DESC, a.A27HORA_INI_AGENDA DESC
-        """, (id_paciente,))
+            {filtro}
+            {pagina.order_by()}
+        """, [id_paciente] + params)
 
+        ref = self.referencia.garantir(self.conn)
         procedimentos = []
         for row in cursor.fetchall():
             procedimentos.append({
                 'data': row[0],
                 'hora': row[1],
-                'procedimento': row[2],
+                'procedimento': ref.procedimento_nome(row[2]),
                 'valor': float(row[3]) if row[3] else None,
                 'quantidade': row[4],
-                'grupo': row[5],
-                'profissional': row[6]
+                'grupo': ref.grupo(row[5]),
+                'profissional': ref.profissional(row[6]),
+                'id': row[8],
+                'id_agenda': row[7],
+                'id_procedimento': row[2]
             })
 
         cursor.close()
@@ -542,8 +991,10 @@ class MedicineDB:
 
     # ==================== FINANCEIRO (I106 LANCAMENTOS) ====================
 
-    def buscar_lancamentos(self, id_paciente, limite=50):
+    def buscar_lancamentos(self, id_paciente, limite=50, apos=None):
         """Busca lancamentos financeiros do paciente"""
+        pagina = PAGINACAO['financeiro']
+        filtro, params = pagina.filtro(apos)
         cursor = self.conn.cursor()
 
         cursor.execute(f"""
@@ -559,27 +1010,22 @@ class MedicineDB:
                 l.A106VALOR_REALIZADO,
                 l.A106VAL_DESCONTO,
                 l.A106VAL_ACRESCIMO,
-                c.A104NOME,
-                (SELECT LIST(DISTINCT f1.A1NOME, ', ')
-                 FROM M28PROCEDIMENTO_AGENDA pa
-                 INNER JOIN M27AGENDA a ON pa.A28FK27COD_AGENDA = a.A27COD
-                 LEFT JOIN M21PROCEDIMENTO pr ON pa.A28FK21COD_PROCEDIMENTO = pr.A21COD
-                 LEFT JOIN F1PRODUTO f1 ON pr.A21FKF1COD_PRODUTO = f1.A1COD
-                 WHERE a.A27FK6COD_PACIENTE = p.A6COD
-                 AND a.A27DATA = l.A106DATA
-                 AND f1.A1NOME IS NOT NULL
-                ) AS PROCEDIMENTOS
+                l.A106FK104COD_CONTA,
+                l.A106FK115COD_CLI_FORN
             FROM I106LANCAMENTO l
-            LEFT JOIN I104CONTAS c ON l.A106FK104COD_CONTA = c.A104COD
             INNER JOIN I115CLIENTE_FORNENCEDOR cf ON l.A106FK115COD_CLI_FORN = cf.A115COD
             INNER JOIN M6PACIENTE p ON p.A6FKI115COD = cf.A115COD
             WHERE p.A6COD = ?
             AND l.A106ELIMINADO = 'N'
-            ORDER BY l.A106DATA DESC, l.A106COD DESC
-        """, (id_paciente,))
+            {filtro}
+            {pagina.order_by()}
+        """, [id_paciente] + params)
+        rows = cursor.fetchall()
+        ref = self.referencia.garantir(self.conn)
+        procedimentos = procedimentos_por_cliente_data(cursor, [(row[12], row[1]) for row in rows], ref)
 
         lancamentos = []
-        for row in cursor.fetchall():
+        for row in rows:
             lancamentos.append({
                 'id': row[0],
                 'data': row[1],
@@ -592,28 +1038,178 @@ class MedicineDB:
                 'valor_realizado': float(row[8]) if row[8] else None,
                 'desconto': float(row[9]) if row[9] else None,
                 'acrescimo': float(row[10]) if row[10] else None,
-                'conta': row[11],
-                'procedimentos': row[12]
+                'conta': ref.conta(row[11]),
+                'procedimentos': procedimentos.get((row[12], row[1]))
             })
 
         cursor.close()
         return lancamentos
 
-    def buscar_blob_pdf(self, blob_id):
-        """Conecta ao banco blob correto e retorna os bytes do PDF"""
-        blob_db_num = (blob_id // 5000) + 1
-        blob_db_path = os.path.join(BLOB_BASE_PATH, f'Medicine_blob{blob_db_num}.fdb')
-
-        conn_blob = fdb.connect(
-            host=CONFIG['host'],
-            port=CONFIG['port'],
-            database=blob_db_path,
-            user=BLOB_CONFIG['user'],
-            password=BLOB_CONFIG['password'],
-            charset=BLOB_CONFIG['charset']
-        )
-
+    def abrir_blob_pdf(self, blob_id):
+        """Abre o PDF para streaming (BlobPDF) sem carregar o blob inteiro.
+        Retorna None se o blob nao existir. Chamar fechar() (ou consumir ler())."""
+        pool = pool_blob(shard_do_blob(blob_id))
+        conn_blob = pool.obter()
         try:
+            cursor = conn_blob.cursor()
+            # BlobReader em vez de bytes materializados
+            achado = consultar_blob(cursor, blob_id)
+        except Exception:
+            pool.devolver(conn_blob)
+            raise
+
+        if achado is None:
+            cursor.close()
+            pool.devolver(conn_blob)
+            return None
+        tamanho, blob = achado
+        return BlobPDF(pool, conn_blob, cursor, blob, tamanho)
+
+    def pre_carregar_pdfs(self, pdfs):
+        """Agenda a pre-carga no cache dos primeiros PDFs da lista (buscar_pdfs).
+        Sem efeito se PREFETCH_PDFS = 0 ou sem cache_pdf."""
+        if self.prefetch is None:
+            return 0
+        return self.prefetch.agendar([p['blob_id'] for p in pdfs])
+
+    def exportar_pdfs_zip(self, id_paciente):
+        """Todos os PDFs do paciente (M250DOCUMENTOS_OLE) como um ZIP gerado
+        em pedacos de bytes, ou None se ele nao tiver PDFs.
+
+        Os documentos sao agrupados por shard e cada shard e lido por uma
+        thread com uma unica conexao; PDFs ja no cache_pdf nao vao ao banco.
+        As threads consultam e leem o inicio dos blobs em paralelo, mas
+        entram no ZIP uma de cada vez, por uma fila limitada: a memoria usada
+        nao depende do tamanho nem da quantidade de PDFs."""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT d.A250ITEM, d.A250NOME, d.A250DATA_INSERCAO, d.A259FK999COD_BLOB
+            FROM M250DOCUMENTOS_OLE d
+            WHERE d.A250FK6COD_PACIENTE = ?
+              AND d.A259FK999COD_BLOB IS NOT NULL
+            ORDER BY d.A250DATA_INSERCAO, d.A250ITEM
+        """, (id_paciente,))
+        por_shard = {}
+        for row in cursor.fetchall():
+            pdf = {'id': row[0], 'nome': row[1], 'data': row[2], 'blob_id': row[3]}
+            por_shard.setdefault(shard_do_blob(row[3]), []).append(pdf)
+        cursor.close()
+        if not por_shard:
+            return None
+        return self._gerar_zip(por_shard)
+
+    def _gerar_zip(self, por_shard):
+        fila = queue.Queue(EXPORTACAO_FILA)
+        vez = threading.Lock()        # uma thread por vez escreve um PDF na fila
+        cancelado = threading.Event()
+        executor = ThreadPoolExecutor(min(EXPORTACAO_THREADS, len(por_shard)),
+                                      thread_name_prefix='exportar_zip')
+        for shard, pdfs in por_shard.items():
+            executor.submit(self._ler_shard_zip, shard, pdfs, fila, vez, cancelado)
+
+        saida = _SaidaZip()
+        usados = set()
+        restantes = len(por_shard)
+        try:
+            # PDF ja e comprimido: ZIP_STORED. Sem `with`: se a exportacao for
+            # interrompida, o ZIP fica sem o diretorio central (incompleto)
+            zf = zipfile.ZipFile(saida, 'w', zipfile.ZIP_STORED)
+            destino = None
+            while restantes:
+                tipo, valor = fila.get()
+                if tipo == 'pdf':
+                    pdf, tamanho = valor
+                    info = zipfile.ZipInfo(nome_entrada_zip(pdf, usados))
+                    if pdf['data'] and pdf['data'].year >= 1980:
+                        info.date_time = pdf['data'].timetuple()[:6]
+                    info.file_size = tamanho
+                    destino = zf.open(info, 'w')
+                elif tipo == 'dados':
+                    destino.write(valor)
+                elif tipo == 'fim_pdf':
+                    destino.close()
+                    destino = None
+                elif tipo == 'fim_shard':
+                    restantes -= 1
+                else:
+                    raise valor
+                dados = saida.retirar()
+                if dados:
+                    yield dados
+            zf.close()
+            yield saida.retirar()
+        finally:
+            # Cliente desconectou ou erro: as threads desistem na proxima espera
+            cancelado.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _ler_shard_zip(self, shard, pdfs, fila, vez, cancelado):
+        """Thread da exportacao: le os PDFs de um shard e os poe na fila"""
+        def esperar(tentar):
+            while not tentar():
+                if cancelado.is_set():
+                    raise _ExportacaoCancelada()
+
+        def colocar(item):
+            def tentar():
+                try:
+                    fila.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    return False
+            esperar(tentar)
+
+        pool = None
+        conn_blob = cursor = None
+        try:
+            for pdf in pdfs:
+                if cancelado.is_set():
+                    return
+                leitura = self.cache_pdf.abrir(pdf['blob_id']) if self.cache_pdf is not None else None
+                if leitura is not None:
+                    tamanho, pedacos, blob = leitura.tamanho, leitura.ler(), None
+                else:
+                    if conn_blob is None:
+                        pool = pool_blob(shard)
+                        conn_blob = pool.obter()
+                        cursor = conn_blob.cursor()
+                    achado = consultar_blob(cursor, pdf['blob_id'])
+                    if achado is None:
+                        continue
+                    tamanho, blob = achado
+                    pedacos = iter(lambda: blob.read(PEDACO_BLOB), b'')
+                try:
+                    # Primeiro pedaco lido antes de esperar a vez
+                    primeiro = next(pedacos, b'')
+                    esperar(lambda: vez.acquire(timeout=1))
+                    try:
+                        colocar(('pdf', (pdf, tamanho)))
+                        if primeiro:
+                            colocar(('dados', primeiro))
+                        for dados in pedacos:
+                            colocar(('dados', dados))
+                        colocar(('fim_pdf', None))
+                    finally:
+                        vez.release()
+                finally:
+                    if blob is not None:
+                        blob.close()
+                    else:
+                        pedacos.close()
+            colocar(('fim_shard', None))
+        except _ExportacaoCancelada:
+            pass
+        except Exception as e:
+            if not cancelado.is_set():
+                fila.put(('erro', e))
+        finally:
+            if conn_blob is not None:
+                cursor.close()
+                pool.devolver(conn_blob)
+
+    def buscar_blob_pdf(self, blob_id):
+        """Busca os bytes do PDF no banco blob correto (conexao do pool do shard)"""
+        with pool_blob(shard_do_blob(blob_id)).conexao() as conn_blob:
             cursor = conn_blob.cursor()
             cursor.execute("""
                 SELECT A999BLOB
@@ -622,14 +1218,15 @@ class MedicineDB:
             """, (blob_id,))
 
             row = cursor.fetchone()
-            if row and row[0]:
-                blob = row[0]
-                if hasattr(blob, 'read'):
-                    return blob.read()
-                return bytes(blob)
-            return None
-        finally:
-            conn_blob.close()
+            try:
+                if row and row[0]:
+                    blob = row[0]
+                    if hasattr(blob, 'read'):
+                        return blob.read()
+                    return bytes(blob)
+                return None
+            finally:
+                cursor.close()
 
 
 # ==================== FORMATACAO ====================
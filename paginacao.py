@@ -0,0 +1,103 @@
+"""
+Paginacao por chave (keyset) com cursores opacos - Medicine Dream
+
+Em vez de FIRST N + refazer tudo com um N maior, cada pagina devolve um
+cursor com as chaves da ultima linha; a pagina seguinte filtra as linhas
+"depois" dessas chaves na mesma ordenacao decrescente, sem reler as
+anteriores.
+"""
+
+import base64
+import json
+from datetime import date, datetime, time
+
+
+class CursorInvalido(ValueError):
+    """Cursor de paginacao corrompido ou de outra listagem"""
+
+
+# Substitutos de NULL nas chaves anulaveis (literal SQL, valor Python).
+# Sao menores que qualquer valor real: na ordem DESC, NULL fica por ultimo,
+# como o Firebird ja ordena.
+NULO_HORA = ("TIME '00:00:00'", time(0, 0))
+NULO_DATA_HORA = ("TIMESTAMP '1900-01-01 00:00:00'", datetime(1900, 1, 1))
+
+
+def _codificar(valor):
+    if isinstance(valor, datetime):
+        return ['dt', valor.isoformat()]
+    if isinstance(valor, date):
+        return ['d', valor.isoformat()]
+    if isinstance(valor, time):
+        return ['t', valor.isoformat()]
+    return valor
+
+
+def _decodificar(valor):
+    if isinstance(valor, list):
+        tipo, texto = valor
+        if tipo == 'dt':
+            return datetime.fromisoformat(texto)
+        if tipo == 'd':
+            return date.fromisoformat(texto)
+        if tipo == 't':
+            return time.fromisoformat(texto)
+        raise ValueError(tipo)
+    return valor
+
+
+class Paginacao:
+    """Ordenacao decrescente por uma lista de chaves, a ultima unica.
+
+    Cada chave e (expressao SQL, campo no dict do resultado) ou
+    (expressao, campo, nulo) para colunas anulaveis, com nulo = NULO_*."""
+
+    def __init__(self, nome, *chaves):
+        self.nome = nome
+        self.chaves = []
+        for chave in chaves:
+            expressao, campo = chave[0], chave[1]
+            nulo = chave[2] if len(chave) > 2 else None
+            if nulo:
+                expressao = f"COALESCE({expressao}, {nulo[0]})"
+            self.chaves.append((expressao, campo, nulo[1] if nulo else None))
+
+    def order_by(self):
+        """Clausula ORDER BY (todas as chaves DESC)"""
+        return "ORDER BY " + ", ".join(f"{e} DESC" for e, _, _ in self.chaves)
+
+    def cursor(self, linha):
+        """Cursor opaco apontando para depois de `linha` (dict do resultado)"""
+        valores = [linha[campo] for _, campo, _ in self.chaves]
+        texto = json.dumps([self.nome, [_codificar(v) for v in valores]], separators=(',', ':'))
+        return base64.urlsafe_b64encode(texto.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def ler_cursor(self, cursor):
+        """Valores das chaves gravados no cursor (CursorInvalido se nao servir)"""
+        try:
+            texto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            nome, valores = json.loads(texto.decode('utf-8'))
+            valores = [_decodificar(v) for v in valores]
+        except (ValueError, TypeError, UnicodeDecodeError):
+            raise CursorInvalido('Cursor de paginacao invalido')
+        if nome != self.nome or len(valores) != len(self.chaves):
+            raise CursorInvalido(f'Cursor nao pertence a listagem {self.nome}')
+        return [padrao if v is None else v
+                for v, (_, _, padrao) in zip(valores, self.chaves)]
+
+    def filtro(self, apos):
+        """(sql, params) para as linhas depois do cursor `apos`: "AND (...)".
+        Sem cursor, ('', [])."""
+        if not apos:
+            return '', []
+        valores = self.ler_cursor(apos)
+        # (k1 < v1) OR (k1 = v1 AND k2 < v2) OR ... ; k1 <= v1 na frente
+        # deixa o otimizador usar o indice da primeira chave
+        termos = []
+        params = [valores[0]]
+        for i, (expressao, _, _) in enumerate(self.chaves):
+            iguais = [f"{e} = ?" for e, _, _ in self.chaves[:i]]
+            termos.append("(" + " AND ".join(iguais + [f"{expressao} < ?"]) + ")")
+            params.extend(valores[:i + 1])
+        sql = f"AND {self.chaves[0][0]} <= ? AND (" + " OR ".join(termos) + ")"
+        return sql, params
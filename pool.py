@@ -0,0 +1,285 @@
+"""
+Pool de conexoes Firebird thread-safe - Medicine Dream
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import fdb
+
+
+class PoolEsgotado(Exception):
+    """Nenhuma conexao ficou livre dentro do timeout de checkout"""
+
+
+class _ConexaoPool:
+    """Conexao fdb com os instantes de criacao e ultimo uso"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.criada_em = time.monotonic()
+        self.usada_em = self.criada_em
+
+
+class PoolConexoes:
+    """Pool de conexoes fdb com tamanho minimo/maximo, timeout de checkout,
+    health-check no emprestimo, despejo de ociosas e tempo de vida maximo.
+
+    Nenhuma conexao e aberta no construtor; chamar aquecer() para abrir
+    as `minimo` conexoes antecipadamente."""
+
+    SQL_PING = "SELECT 1 FROM RDB$DATABASE"
+
+    def __init__(self, config, minimo=2, maximo=10, timeout=30,
+                 ociosa_max=300, vida_max=3600):
+        self.config = config
+        self.minimo = minimo
+        self.maximo = maximo
+        self.timeout = timeout
+        self.ociosa_max = ociosa_max
+        self.vida_max = vida_max
+        self._livres = []
+        self._emprestadas = {}
+        self._total = 0
+        self._fechado = False
+        self._cond = threading.Condition()
+
+    # ==================== CICLO DE VIDA ====================
+
+    def _abrir(self):
+        return _ConexaoPool(fdb.connect(**self.config))
+
+    def _descartar(self, item):
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+
+    def _expirada(self, item, agora):
+        return self.vida_max and agora - item.criada_em > self.vida_max
+
+    def _saudavel(self, item):
+        """Health-check: reverte transacao pendente e executa um ping"""
+        try:
+            item.conn.rollback()
+            cursor = item.conn.cursor()
+            cursor.execute(self.SQL_PING)
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def aquecer(self):
+        """Abre conexoes ate atingir o minimo"""
+        while True:
+            with self._cond:
+                if self._fechado or self._total >= self.minimo:
+                    return self
+                self._total += 1
+            try:
+                item = self._abrir()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._livres.append(item)
+                self._cond.notify()
+
+    def despejar_ociosas(self):
+        """Fecha conexoes livres ociosas ou expiradas, preservando o minimo"""
+        agora = time.monotonic()
+        removidas = []
+        with self._cond:
+            manter = []
+            # Mais recentes no fim da lista: percorrer das mais novas para as mais velhas
+            for item in reversed(self._livres):
+                ociosa = self.ociosa_max and agora - item.usada_em > self.ociosa_max
+                if self._expirada(item, agora) or (ociosa and self._total - len(removidas) > self.minimo):
+                    removidas.append(item)
+                else:
+                    manter.append(item)
+            manter.reverse()
+            self._livres = manter
+            self._total -= len(removidas)
+            if removidas:
+                self._cond.notify_all()
+        for item in removidas:
+            self._descartar(item)
+        return len(removidas)
+
+    def fechar(self):
+        """Fecha todas as conexoes livres e recusa novos checkouts"""
+        with self._cond:
+            self._fechado = True
+            livres, self._livres = self._livres, []
+            self._total -= len(livres)
+            self._cond.notify_all()
+        for item in livres:
+            self._descartar(item)
+
+    def reiniciar(self):
+        """Zera o pool no processo filho de um fork (servidor com varios
+        workers): as conexoes herdadas pertencem ao pai e sao esquecidas,
+        e o pool volta a aceitar checkouts"""
+        self._livres = []
+        self._emprestadas = {}
+        self._total = 0
+        self._fechado = False
+        self._cond = threading.Condition()
+
+    # ==================== CHECKOUT ====================
+
+    def obter(self, timeout=None):
+        """Empresta uma conexao do pool (bloqueia ate `timeout` segundos)"""
+        timeout = self.timeout if timeout is None else timeout
+        limite = time.monotonic() + timeout
+        self.despejar_ociosas()
+
+        while True:
+            item = None
+            abrir = False
+            with self._cond:
+                while True:
+                    if self._fechado:
+                        raise PoolEsgotado('Pool de conexoes fechado')
+                    if self._livres:
+                        item = self._livres.pop()
+                        break
+                    if self._total < self.maximo:
+                        self._total += 1
+                        abrir = True
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        raise PoolEsgotado(
+                            f'Nenhuma conexao livre apos {timeout}s (maximo={self.maximo})')
+                    self._cond.wait(restante)
+
+            if abrir:
+                try:
+                    item = self._abrir()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+                return self._emprestar(item)
+
+            if not self._expirada(item, time.monotonic()) and self._saudavel(item):
+                return self._emprestar(item)
+
+            # Conexao morta ou velha demais: descartar e tentar de novo
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            self._descartar(item)
+
+    def _emprestar(self, item):
+        with self._cond:
+            self._emprestadas[id(item.conn)] = item
+        return item.conn
+
+    def devolver(self, conn, descartar=False):
+        """Devolve conexao ao pool. descartar=True fecha a conexao (ex: erro de rede)"""
+        with self._cond:
+            item = self._emprestadas.pop(id(conn), None)
+        if item is None:
+            return
+
+        if not descartar:
+            try:
+                # Encerrar a transacao para nao segurar snapshot antigo
+                conn.rollback()
+            except Exception:
+                descartar = True
+
+        agora = time.monotonic()
+        with self._cond:
+            if descartar or self._fechado or self._expirada(item, agora):
+                self._total -= 1
+                self._cond.notify()
+            else:
+                item.usada_em = agora
+                self._livres.append(item)
+                self._cond.notify()
+                return
+        self._descartar(item)
+
+    @contextmanager
+    def conexao(self, timeout=None):
+        """Context manager: with pool.conexao() as conn: ..."""
+        conn = self.obter(timeout)
+        try:
+            yield conn
+        finally:
+            self.devolver(conn)
+
+    def estatisticas(self):
+        """Contadores do pool para diagnostico"""
+        with self._cond:
+            return {
+                'total': self._total,
+                'livres': len(self._livres),
+                'emprestadas': len(self._emprestadas),
+                'minimo': self.minimo,
+                'maximo': self.maximo,
+            }
+
+
+class BaseDB:
+    """Base das classes de acesso (MedicineDB, FinanceiroDB, AgendaDB).
+
+    Sem pool: conectar() abre uma conexao propria, como antes.
+    Com pool: cada thread recebe sua conexao no primeiro uso de self.conn
+    e a devolve em liberar() (chamado ao fim de cada request)."""
+
+    def __init__(self, config, pool=None):
+        self.config = config
+        self.pool = pool
+        self._conn = None
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        if self.pool is None:
+            return self._conn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.pool.obter()
+            self._local.conn = conn
+        return conn
+
+    @conn.setter
+    def conn(self, valor):
+        self._conn = valor
+
+    def liberar(self, descartar=False):
+        """Devolve ao pool a conexao emprestada pela thread atual"""
+        if self.pool is None:
+            return
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            self.pool.devolver(conn, descartar=descartar)
+
+    def conectar(self):
+        """Estabelece conexao com o banco (sem pool)"""
+        if self.pool is None:
+            self._conn = fdb.connect(**self.config)
+        return self
+
+    def desconectar(self):
+        """Fecha conexao (ou devolve ao pool)"""
+        if self.pool is not None:
+            self.liberar()
+        elif self._conn:
+            self._conn.close()
+
+    def __enter__(self):
+        return self.conectar()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.desconectar()
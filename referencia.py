@@ -0,0 +1,163 @@
+"""
+Cache em memoria das tabelas de referencia - Medicine Dream
+
+Profissionais (M31 -> I115), situacoes (M84), procedimentos (M21/F1),
+grupos de procedimento (M15), convenios (M5 -> I115) e contas (I104) sao
+tabelas pequenas que mudam pouco. Em vez de repetir os joins em cada
+consulta, elas ficam em dicionarios compartilhados pelo processo e as
+consultas trazem so os codigos.
+"""
+
+import threading
+import time
+
+
+class _Tabelas:
+    """Um snapshot completo das tabelas de referencia (trocado de uma vez)"""
+    def __init__(self):
+        self.profissionais = {}   # A31COD -> nome
+        self.situacoes = {}       # A84COD -> nome
+        self.procedimentos = {}   # A21COD -> (alias, nome do produto)
+        self.grupos = {}          # A15COD -> nome
+        self.convenios = {}       # A5COD -> nome
+        self.contas = {}          # A104COD -> (nome, tipo)
+
+
+class CacheReferencia:
+    """Dicionarios de referencia carregados do banco e recarregados a cada
+    `intervalo` segundos. Um codigo desconhecido (cadastro novo) antecipa a
+    proxima recarga, respeitando `intervalo_minimo`. Se ele continuar faltando
+    depois dela (registro orfao), fica em `_ausentes` e nao antecipa mais
+    recargas - so as do `intervalo` normal. Com servidor.py (gunicorn) a
+    recarga periodica e do processo mestre, nao de cada worker."""
+
+    SQL_PROFISSIONAIS = """
+        SELECT u.A31COD, uc.A115NOME
+        FROM M31USUARIO u
+        LEFT JOIN I115CLIENTE_FORNENCEDOR uc ON u.A31FKI115COD = uc.A115COD
+    """
+    SQL_SITUACOES = "SELECT A84COD, A84NOME FROM M84SITUACAO_PROCEDIMENTO"
+    SQL_PROCEDIMENTOS = """
+        SELECT pr.A21COD, pr.A21ALIASES, f1.A1NOME
+        FROM M21PROCEDIMENTO pr
+        LEFT JOIN F1PRODUTO f1 ON pr.A21FKF1COD_PRODUTO = f1.A1COD
+    """
+    SQL_GRUPOS = "SELECT A15COD, A15NOME FROM M15GRUPO_PROCEDIMENTO"
+    SQL_CONVENIOS = """
+        SELECT conv.A5COD, conv_cli.A115NOME
+        FROM M5CONVENIO conv
+        LEFT JOIN I115CLIENTE_FORNENCEDOR conv_cli ON conv.A5FKI115COD = conv_cli.A115COD
+    """
+    SQL_CONTAS = "SELECT A104COD, A104NOME, A104TIPO FROM I104CONTAS"
+
+    def __init__(self, intervalo=300, intervalo_minimo=15):
+        self.intervalo = intervalo
+        self.intervalo_minimo = intervalo_minimo
+        self._tabelas = _Tabelas()
+        self._carregado_em = 0
+        self._faltantes = set()   # (tabela, cod) vistos faltando desde a ultima carga
+        self._ausentes = set()    # (tabela, cod) que continuaram faltando apos recarregar
+        self._lock_carga = threading.Lock()
+
+    @property
+    def carregado(self):
+        return self._carregado_em > 0
+
+    # ==================== CARGA ====================
+
+    def carregar(self, conn):
+        """Le todas as tabelas de referencia e troca o snapshot atual"""
+        t = _Tabelas()
+        cursor = conn.cursor()
+        cursor.execute(self.SQL_PROFISSIONAIS)
+        t.profissionais = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute(self.SQL_SITUACOES)
+        t.situacoes = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute(self.SQL_PROCEDIMENTOS)
+        t.procedimentos = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        cursor.execute(self.SQL_GRUPOS)
+        t.grupos = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute(self.SQL_CONVENIOS)
+        t.convenios = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute(self.SQL_CONTAS)
+        t.contas = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        cursor.close()
+
+        faltantes, self._faltantes = self._faltantes, set()
+        self._ausentes = {(tabela, cod) for tabela, cod in self._ausentes | faltantes
+                          if cod not in getattr(t, tabela)}
+        self._tabelas = t
+        self._carregado_em = time.monotonic()
+        return self
+
+    def garantir(self, conn):
+        """Carrega na primeira chamada e recarrega quando vencido. So uma
+        thread consulta o banco; as demais seguem com o snapshot atual."""
+        idade = time.monotonic() - self._carregado_em
+        if self.carregado and idade < self.intervalo and not (
+                self._faltantes and idade >= self.intervalo_minimo):
+            return self
+        if not self._lock_carga.acquire(blocking=not self.carregado):
+            return self
+        try:
+            idade = time.monotonic() - self._carregado_em
+            if not self.carregado or idade >= self.intervalo or (
+                    self._faltantes and idade >= self.intervalo_minimo):
+                self.carregar(conn)
+        finally:
+            self._lock_carga.release()
+        return self
+
+    def _buscar(self, nome_tabela, cod):
+        if cod is None:
+            return None
+        tabela = getattr(self._tabelas, nome_tabela)
+        valor = tabela.get(cod)
+        if valor is None and cod not in tabela and (nome_tabela, cod) not in self._ausentes:
+            self._faltantes.add((nome_tabela, cod))
+        return valor
+
+    # ==================== CONSULTA ====================
+
+    def profissional(self, cod):
+        """Nome do profissional (A31COD)"""
+        return self._buscar('profissionais', cod)
+
+    def situacao(self, cod):
+        """Nome da situacao de agenda (A84COD)"""
+        return self._buscar('situacoes', cod)
+
+    def procedimento_alias(self, cod):
+        """Alias curto do procedimento (A21COD)"""
+        valor = self._buscar('procedimentos', cod)
+        return valor[0] if valor else None
+
+    def procedimento_nome(self, cod):
+        """Nome do produto (F1PRODUTO) do procedimento (A21COD)"""
+        valor = self._buscar('procedimentos', cod)
+        return valor[1] if valor else None
+
+    def grupo(self, cod):
+        """Nome do grupo de procedimento (A15COD)"""
+        return self._buscar('grupos', cod)
+
+    def convenio(self, cod):
+        """Nome do convenio (A5COD)"""
+        return self._buscar('convenios', cod)
+
+    def conta(self, cod):
+        """Nome da conta financeira (A104COD)"""
+        valor = self._buscar('contas', cod)
+        return valor[0] if valor else None
+
+    def contas(self):
+        """Todas as contas: [(A104COD, nome, tipo)]"""
+        return [(cod, nome, tipo) for cod, (nome, tipo) in self._tabelas.contas.items()]
+
+    def lista(self, nomes):
+        """Junta nomes distintos como o LIST(DISTINCT x, ', ') do Firebird"""
+        return ', '.join(sorted({n for n in nomes if n})) or None
+
+
+# Instancia compartilhada pelo processo (MedicineDB, AgendaDB, FinanceiroDB)
+cache_referencia = CacheReferencia()
@@ -0,0 +1,172 @@
+"""
+Servidor de producao da interface web - Medicine Dream
+
+    python servidor.py --workers 4 --threads 8 --bind 0.0.0.0:5000
+
+Linux: gunicorn com varios processos (workers) e threads por processo.
+O app e carregado uma vez no processo mestre (preload): tabelas de
+referencia e indice de nomes sao lidos do banco antes do fork e ficam
+compartilhados entre os workers por copy-on-write (gc.freeze() evita que o
+coletor de lixo toque nessas paginas). As conexoes do mestre sao fechadas
+antes do fork; cada worker abre as suas no primeiro uso.
+
+Recarga sem derrubar requests: kill -HUP <pid do mestre>. O mestre rele
+as tabelas de referencia e o indice de nomes e troca os workers (os novos
+nascem do snapshot novo; os antigos terminam o que estao atendendo em ate
+--graceful-timeout s). O mestre faz isso sozinho a cada --recarga s. Os
+workers nao refazem esses dados por conta propria - cada um teria sua copia
+e o compartilhamento por copy-on-write se perderia: so acrescentam os
+pacientes novos ao indice e releem as referencias quando aparece um codigo
+desconhecido (cadastro novo), o que ate a proxima recarga fica por worker.
+
+Linux: o Firebird client vem de libfbclient.so (ver paciente.py).
+
+Windows: gunicorn nao roda (sem fork); usa waitress, UM processo com
+--threads threads (--workers e ignorado). As esperas do banco rodam em
+paralelo, mas o trabalho em Python fica num nucleo so (GIL). Para mais
+nucleos, varias instancias em portas diferentes atras de um proxy.
+"""
+
+import argparse
+import gc
+import os
+import signal
+import sys
+import threading
+import time
+
+
+def preparar(recarga_central=False):
+    """Carrega o app e os dados compartilhados; retorna o app WSGI.
+    recarga_central: os workers nao refazem o indice nem as referencias
+    periodicamente (o mestre recarrega e troca os workers)."""
+    from app import app, pool, indice_nomes, cache_referencia
+    if recarga_central:
+        indice_nomes.recarga = float('inf')
+        cache_referencia.intervalo = float('inf')
+    with pool.conexao() as conn:
+        cache_referencia.carregar(conn)
+        indice_nomes.carregar(conn)
+    print(f"Referencias e indice de nomes carregados ({len(indice_nomes)} pacientes)")
+    return app
+
+
+def fechar_conexoes():
+    """Fecha as conexoes do processo atual (mestre antes do fork)"""
+    from app import pool
+    from paciente import fechar_pools_blob
+    pool.fechar()
+    fechar_pools_blob()
+
+
+def pos_fork(server, worker):
+    """Hook do gunicorn no worker recem-criado: pool limpo, sem as conexoes do mestre"""
+    from app import pool
+    pool.reiniciar()
+
+
+def agendar_recarga(segundos):
+    """Hook when_ready do gunicorn: o mestre manda HUP a si mesmo a cada
+    `segundos` (recarga central dos dados)"""
+    def quando_pronto(server):
+        def laco():
+            while True:
+                time.sleep(segundos)
+                os.kill(os.getpid(), signal.SIGHUP)
+        threading.Thread(target=laco, name='recarga', daemon=True).start()
+    return quando_pronto
+
+
+def rodar_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class ServidorGunicorn(BaseApplication):
+        def __init__(self, opcoes):
+            self.opcoes = opcoes
+            self.anterior = None   # app da carga anterior (recarga por HUP)
+            super().__init__()
+
+        def load_config(self):
+            for chave, valor in self.opcoes.items():
+                self.cfg.set(chave, valor)
+
+        def load(self):
+            try:
+                app = preparar(recarga_central=True)
+            except Exception as e:
+                if self.anterior is None:
+                    raise
+                # Banco fora na recarga: os workers novos seguem com os dados
+                # anteriores (uma excecao aqui derrubaria o mestre)
+                print(f"Recarga falhou ({e}); mantidos os dados anteriores")
+                app = self.anterior
+            fechar_conexoes()
+            # Tudo o que foi carregado ate aqui vai para a geracao permanente
+            gc.collect()
+            gc.freeze()
+            return app
+
+        def reload(self):
+            # HUP: com preload_app o gunicorn reaproveitaria o app ja carregado
+            # e os novos workers nasceriam do snapshot antigo. Esquecido, ele e
+            # carregado de novo (load) antes de criar os workers.
+            super().reload()
+            from app import pool
+            pool.reiniciar()
+            gc.unfreeze()
+            self.anterior, self.callable = self.callable, None
+
+    opcoes = {
+        'bind': args.bind,
+        'workers': args.workers or (os.cpu_count() or 1) + 1,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10 if args.max_requests else 0,
+        'preload_app': True,
+        'post_fork': pos_fork,
+        'proc_name': 'medicine_dream',
+    }
+    if args.recarga:
+        opcoes['when_ready'] = agendar_recarga(args.recarga)
+    ServidorGunicorn(opcoes).run()
+
+
+def rodar_waitress(args):
+    from waitress import serve
+    if args.workers and args.workers > 1:
+        print(f"--workers {args.workers} ignorado: no Windows o waitress roda em um processo so")
+    app = preparar()
+    print(f"waitress em {args.bind} ({args.threads} threads)")
+    serve(app, listen=args.bind, threads=args.threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor de producao da interface web')
+    parser.add_argument('--bind', default='0.0.0.0:5000', help='endereco:porta (padrao 0.0.0.0:5000)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processos (padrao: CPUs + 1; no Windows sempre 1)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads por processo (padrao 8)')
+    parser.add_argument('--timeout', type=int, default=120,
+                        help='segundos sem resposta antes de reiniciar o worker (padrao 120)')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='segundos para terminar os requests em andamento na recarga (padrao 30)')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='reinicia o worker apos N requests (0 = nunca)')
+    parser.add_argument('--recarga', type=int, default=3600,
+                        help='segundos entre recargas do indice e das referencias no '
+                             'mestre (gunicorn; padrao 3600, 0 = so com kill -HUP)')
+    args = parser.parse_args()
+
+    print("Medicine Dream - Interface Web")
+    if sys.platform == 'win32':
+        rodar_waitress(args)
+    else:
+        rodar_gunicorn(args)
+
+
+if __name__ == '__main__':
+    main()
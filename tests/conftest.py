@@ -0,0 +1,29 @@
+import os
+import sys
+import types
+
+# Os modulos ficam na raiz do repositorio (sem pacote)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import fdb
+except ImportError:
+    # Sem o driver: modulo minimo para importar pool.py, paciente.py e app.py.
+    # Nenhum teste fala com o Firebird; quem precisa de conexao troca
+    # fdb.connect por uma conexao falsa (monkeypatch).
+    fdb = types.ModuleType('fdb')
+
+    class Error(Exception):
+        pass
+
+    class DatabaseError(Error):
+        pass
+
+    def connect(**config):
+        raise DatabaseError('fdb nao instalado')
+
+    fdb.Error = Error
+    fdb.DatabaseError = DatabaseError
+    fdb.connect = connect
+    fdb.load_api = lambda caminho: None
+    sys.modules['fdb'] = fdb
@@ -0,0 +1,230 @@
+from datetime import date, timedelta
+
+import pytest
+
+from agregados import AgregadosMensais, ArmazemSQLite, SaldosContas, _meses_antes
+
+HOJE = date.today()
+
+
+# ==================== FIREBIRD FALSO ====================
+
+class Lancamento:
+    def __init__(self, cod, data, tipo, valor, conta=1, realizado='S', data_realizado=None):
+        self.cod = cod
+        self.data = data
+        self.tipo = tipo
+        self.valor = valor
+        self.conta = conta
+        self.realizado = realizado
+        self.eliminado = 'N'
+        self.data_realizado = data_realizado or (data if realizado == 'S' else None)
+
+
+class FirebirdFalso:
+    """Conexao fdb que responde as consultas de agregados.py sobre uma lista
+    de lancamentos em memoria (reconhece cada consulta por um trecho)"""
+
+    def __init__(self, lancamentos):
+        self.lancamentos = lancamentos
+
+    def cursor(self):
+        return self
+
+    def close(self):
+        pass
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def _validos(self, max_cod):
+        return [l for l in self.lancamentos if l.eliminado == 'N' and l.cod <= max_cod]
+
+    def _realizados(self, max_cod):
+        return [l for l in self._validos(max_cod) if l.realizado == 'S']
+
+    @staticmethod
+    def _agrupar(lancamentos, chave, valores):
+        grupos = {}
+        for l in lancamentos:
+            atual = grupos.get(chave(l))
+            novos = valores(l)
+            grupos[chave(l)] = novos if atual is None else tuple(a + b for a, b in zip(atual, novos))
+        return [(k,) + v for k, v in grupos.items()]
+
+    def execute(self, sql, params=()):
+        if 'SELECT MAX(A106COD)' in sql:
+            self._rows = [(max((l.cod for l in self.lancamentos), default=None),)]
+        elif 'SELECT DISTINCT EXTRACT' in sql:
+            max_cod, desde = params
+            self._rows = list({
+                (l.data.year, l.data.month) for l in self.lancamentos
+                if l.cod > max_cod or (l.data_realizado and l.data_realizado >= desde)})
+        elif 'CAST(l.A106DATA AS DATE) AS DIA' in sql:
+            lancamentos = self._realizados(params[0])
+            if len(params) > 1:
+                lancamentos = [l for l in lancamentos if params[1] <= l.data < params[2]]
+            self._rows = [(dia, tipo, qt, total) for (dia, tipo), qt, total in self._agrupar(
+                lancamentos, lambda l: (l.data, l.tipo), lambda l: (1, l.valor))]
+        elif 'EXTRACT(YEAR FROM l.A106DATA) * 10000' in sql:
+            self._rows = self._agrupar(
+                self._realizados(params[0]), lambda l: l.tipo,
+                lambda l: (1, l.valor, int(l.data.strftime('%Y%m%d'))))
+        elif 'l.A106VALOR * l.A106FK104COD_CONTA' in sql:
+            self._rows = self._agrupar(
+                [l for l in self._realizados(params[0]) if l.conta is not None and l.tipo in 'CDT'],
+                lambda l: l.tipo, lambda l: (1, l.valor, l.valor * l.conta))
+        elif 'GROUP BY l.A106FK104COD_CONTA' in sql:
+            self._rows = self._agrupar(
+                [l for l in self._realizados(params[0]) if l.conta is not None],
+                lambda l: l.conta,
+                lambda l: tuple(l.valor if l.tipo == t else 0 for t in 'CDT')
+                + tuple(1 if l.tipo == t else 0 for t in 'CDT'))
+        elif "l.A106REALIZADO = 'N'" in sql:
+            self._rows = [(l.cod,) for l in self._validos(params[0]) if l.realizado == 'N']
+        elif 'l.A106COD > ?' in sql:
+            anterior, max_cod = params
+            self._rows = [(l.cod, l.conta, l.tipo, l.valor, l.realizado)
+                          for l in self._validos(max_cod) if l.cod > anterior]
+        elif 'l.A106DATA_REALIZADO >= ?' in sql:
+            max_cod, desde = params
+            self._rows = [(l.cod, l.conta, l.tipo, l.valor) for l in self._realizados(max_cod)
+                          if l.data_realizado and l.data_realizado >= desde]
+        else:
+            raise AssertionError(f'Consulta inesperada: {sql}')
+
+
+def lancamentos_iniciais():
+    return [
+        Lancamento(cod, HOJE - timedelta(days=cod * 9), 'CDT'[cod % 3], 10.0 * cod,
+                   conta=cod % 4 + 1, realizado='N' if cod % 5 == 0 else 'S')
+        for cod in range(1, 50)
+    ]
+
+
+def mexer(lancamentos):
+    """Novos lancamentos (realizados e pendentes) e pendentes realizados hoje"""
+    lancamentos.append(Lancamento(100, HOJE, 'C', 1000.0, conta=2))
+    lancamentos.append(Lancamento(101, HOJE - timedelta(days=40), 'D', 7.0, conta=3))
+    lancamentos.append(Lancamento(102, HOJE, 'T', 55.0, conta=1, realizado='N'))
+    for l in lancamentos[4:30:5]:
+        l.realizado = 'S'
+        l.data_realizado = HOJE
+
+
+def editar(lancamentos):
+    """Mudancas que o incremental nao ve"""
+    lancamentos[1].valor = 1.5
+    lancamentos[2].eliminado = 'S'
+    lancamentos[3].data -= timedelta(days=35)
+    lancamentos[6].conta = 4
+
+
+def armazem(classe, tmp_path, nome='agregados.db', conferir=10 ** 9):
+    return classe(str(tmp_path / nome), intervalo=0, conferir=conferir)
+
+
+def completo(classe, tmp_path, banco):
+    """Armazem novo, sincronizado por reconstrucao"""
+    return armazem(classe, tmp_path, 'completo.db').sincronizar(banco)
+
+
+def conteudo(ag):
+    """Saldos ou resumo mensal"""
+    if isinstance(ag, SaldosContas):
+        return ag.saldos()
+    return ag.resumo(24)
+
+
+# ==================== TESTES ====================
+
+def test_meses_antes():
+    assert _meses_antes(date(2026, 3, 31), 1) == date(2026, 2, 28)
+    assert _meses_antes(date(2024, 3, 31), 1) == date(2024, 2, 29)
+    assert _meses_antes(date(2026, 1, 15), 1) == date(2025, 12, 15)
+    assert _meses_antes(date(2026, 10, 17), 12) == date(2025, 10, 17)
+
+
+def test_resumo_igual_a_consulta_direta(tmp_path):
+    lancamentos = lancamentos_iniciais()
+    ag = armazem(AgregadosMensais, tmp_path).sincronizar(FirebirdFalso(lancamentos))
+    inicio = _meses_antes(HOJE, 3)
+    esperado = {}
+    for l in lancamentos:
+        if l.realizado == 'S' and l.data >= inicio:
+            qt, total = esperado.get((l.data.year, l.data.month, l.tipo), (0, 0))
+            esperado[(l.data.year, l.data.month, l.tipo)] = (qt + 1, total + l.valor)
+    assert {(r['ano'], r['mes'], r['tipo']): (r['quantidade'], r['total'])
+            for r in ag.resumo(3)} == {k: (qt, round(total, 2)) for k, (qt, total) in esperado.items()}
+
+
+def test_totais_em_centavos(tmp_path):
+    lancamentos = [Lancamento(cod, HOJE, 'C', 1234.56 if cod == 1 else 0.1) for cod in range(1, 12)]
+    banco = FirebirdFalso(lancamentos)
+    resumo = armazem(AgregadosMensais, tmp_path).sincronizar(banco).resumo(1)
+    assert [r['total'] for r in resumo] == [1235.56]
+    assert armazem(SaldosContas, tmp_path).sincronizar(banco).saldos() == {1: (1235.56, 0, 0)}
+
+
+@pytest.mark.parametrize('classe', [AgregadosMensais, SaldosContas])
+def test_incremental_igual_a_reconstrucao(classe, tmp_path):
+    lancamentos = lancamentos_iniciais()
+    banco = FirebirdFalso(lancamentos)
+    ag = armazem(classe, tmp_path).sincronizar(banco)
+    reconstruido_em = ag.ler_controle('reconstruido_em')
+
+    mexer(lancamentos)
+    ag.sincronizar(banco, forcar=True)
+    ag.sincronizar(banco, forcar=True)   # realizados de hoje nao somam duas vezes
+
+    assert ag.ler_controle('reconstruido_em') == reconstruido_em
+    assert conteudo(ag) == conteudo(completo(classe, tmp_path, banco))
+    assert ag._confere(banco.cursor())
+
+
+@pytest.mark.parametrize('classe', [AgregadosMensais, SaldosContas])
+def test_conferencia_reconstroi_apos_edicao(classe, tmp_path):
+    lancamentos = lancamentos_iniciais()
+    banco = FirebirdFalso(lancamentos)
+    ag = armazem(classe, tmp_path, conferir=0).sincronizar(banco)
+
+    editar(lancamentos)
+    assert not ag._confere(banco.cursor())
+    ag.sincronizar(banco, forcar=True)
+
+    assert ag._confere(banco.cursor())
+    assert conteudo(ag) == conteudo(completo(classe, tmp_path, banco))
+
+
+def test_troca_de_conta_percebida(tmp_path):
+    lancamentos = lancamentos_iniciais()
+    banco = FirebirdFalso(lancamentos)
+    saldos = armazem(SaldosContas, tmp_path).sincronizar(banco)
+    lancamentos[0].conta = 4
+    assert not saldos._confere(banco.cursor())
+
+
+@pytest.mark.parametrize('classe', [AgregadosMensais, SaldosContas])
+def test_incremental_concorrente_aplicado_uma_vez(classe, tmp_path):
+    lancamentos = lancamentos_iniciais()
+    banco = FirebirdFalso(lancamentos)
+    primeiro = armazem(classe, tmp_path).sincronizar(banco)
+    segundo = armazem(classe, tmp_path)
+    mexer(lancamentos)
+
+    # Os dois processos leem o controle antes de qualquer um gravar
+    versao = primeiro.ler_controle('versao')
+    max_cod = int(primeiro.ler_controle('max_cod'))
+    sincronizado_em = date.fromisoformat(primeiro.ler_controle('sincronizado_em'))
+    assert primeiro._incremental(banco.cursor(), max_cod, sincronizado_em, versao)
+    assert not segundo._incremental(banco.cursor(), max_cod, sincronizado_em, versao)
+
+    assert conteudo(segundo) == conteudo(completo(classe, tmp_path, banco))
+
+
+def test_armazem_base_e_abstrato(tmp_path):
+    with pytest.raises(TypeError):
+        ArmazemSQLite(str(tmp_path / 'base.db'))
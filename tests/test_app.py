@@ -0,0 +1,273 @@
+import io
+import zipfile
+from datetime import datetime
+
+import pytest
+
+import fdb
+
+import app as modulo_app
+import paciente
+import pool
+from cache_pdf import CachePDF
+from pool import PoolConexoes
+
+db = modulo_app.db
+
+# blob_id -> conteudo do A999BLOB nos shards falsos
+BLOBS = {
+    7: b'%PDF-1.4 ' + bytes(range(256)) * 40,
+    9: b'%PDF-1.4 nove',
+    paciente.BLOBS_POR_SHARD + 3: b'%PDF-1.4 outro shard ' * 5000,
+}
+
+# paciente -> linhas de M250DOCUMENTOS_OLE (item, nome, data, blob_id)
+DOCUMENTOS = {
+    1: [
+        (10, 'Exame.pdf', datetime(2024, 5, 2, 10, 30), 7),
+        (11, 'Exame.pdf', datetime(2024, 5, 2, 11, 0), 9),
+        (12, None, None, paciente.BLOBS_POR_SHARD + 3),
+    ],
+}
+
+
+class CursorFalso:
+    """Cursor fdb que responde as consultas de PDF por trechos do SQL"""
+
+    def __init__(self):
+        self._rows = []
+
+    def set_stream_blob(self, coluna):
+        pass
+
+    def execute(self, sql, params=()):
+        if 'FROM M999BLOBS' in sql:
+            conteudo = BLOBS.get(params[0])
+            self._rows = [(len(conteudo), io.BytesIO(conteudo))] if conteudo else []
+        elif 'FROM M250DOCUMENTOS_OLE' in sql:
+            self._rows = list(DOCUMENTOS.get(params[0], []))
+        else:
+            self._rows = [(1,)]
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class ConexaoFalsa:
+    def cursor(self):
+        return CursorFalso()
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def cliente(monkeypatch, tmp_path):
+    monkeypatch.setattr(pool.fdb, 'connect', lambda **config: ConexaoFalsa())
+    monkeypatch.setattr(paciente, '_pools_blob', {})
+    monkeypatch.setattr(db, 'pool', PoolConexoes({}, minimo=0))
+    monkeypatch.setattr(db, 'cache_pdf', CachePDF(str(tmp_path)))
+    monkeypatch.setattr(db, 'prefetch', None)
+    return modulo_app.app.test_client()
+
+
+def pdf_no_cache(cliente, blob_id=7):
+    """Le o PDF inteiro pela rota (o corpo lido ate o fim vai para o cache)"""
+    resposta = cliente.get(f'/api/pdf/{blob_id}')
+    assert resposta.data == BLOBS[blob_id]
+    resposta.close()
+    assert db.cache_pdf.contem(blob_id)
+
+
+# ==================== PDF (RANGE) ====================
+
+def test_pdf_inteiro(cliente):
+    r = cliente.get('/api/pdf/7')
+    assert r.status_code == 200
+    assert r.data == BLOBS[7]
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert r.headers['Content-Length'] == str(len(BLOBS[7]))
+    assert r.mimetype == 'application/pdf'
+
+
+@pytest.mark.parametrize('do_cache', [False, True])
+def test_pdf_faixa(cliente, do_cache):
+    if do_cache:
+        pdf_no_cache(cliente)
+    r = cliente.get('/api/pdf/7', headers={'Range': 'bytes=100-199'})
+    assert r.status_code == 206
+    assert r.data == BLOBS[7][100:200]
+    assert r.headers['Content-Range'] == f'bytes 100-199/{len(BLOBS[7])}'
+    assert r.headers['Content-Length'] == '100'
+
+
+def test_pdf_faixa_final(cliente):
+    r = cliente.get('/api/pdf/7', headers={'Range': 'bytes=-10'})
+    assert r.status_code == 206
+    assert r.data == BLOBS[7][-10:]
+
+
+@pytest.mark.parametrize('do_cache', [False, True])
+def test_pdf_faixa_fora_do_arquivo(cliente, do_cache):
+    if do_cache:
+        pdf_no_cache(cliente)
+    tamanho = len(BLOBS[7])
+    r = cliente.get('/api/pdf/7', headers={'Range': f'bytes={tamanho}-{tamanho + 10}'})
+    assert r.status_code == 416
+    assert r.headers['Content-Range'] == f'bytes */{tamanho}'
+
+
+def test_pdf_faixa_nao_vai_para_o_cache(cliente):
+    cliente.get('/api/pdf/7', headers={'Range': 'bytes=0-9'}).close()
+    assert not db.cache_pdf.contem(7)
+
+
+def test_pdf_do_cache_com_etag(cliente):
+    pdf_no_cache(cliente)
+    r = cliente.get('/api/pdf/7')
+    etag = r.headers['ETag']
+    assert r.status_code == 200 and r.data == BLOBS[7]
+    r = cliente.get('/api/pdf/7', headers={'If-None-Match': etag})
+    assert r.status_code == 304 and r.data == b''
+
+
+def test_pdf_inexistente(cliente):
+    assert cliente.get('/api/pdf/8').status_code == 404
+
+
+def test_pdf_com_shard_ocupado(cliente):
+    ocupado = PoolConexoes({}, minimo=0, maximo=0, timeout=0)
+    paciente._pools_blob[paciente.shard_do_blob(7)] = ocupado
+    r = cliente.get('/api/pdf/7')
+    assert r.status_code == 503
+    assert r.headers['Retry-After'] == '5'
+
+
+# ==================== POOL ESGOTADO ====================
+
+def test_pool_esgotado_e_503(cliente, monkeypatch):
+    monkeypatch.setattr(db, 'pool', PoolConexoes({}, minimo=0, maximo=0, timeout=0))
+    r = cliente.get('/api/paciente/1/prontuario?secoes=paciente')
+    assert r.status_code == 503
+    assert r.headers['Retry-After'] == '5'
+    assert r.get_json() == {'erro': 'Servidor ocupado, tente novamente'}
+
+
+# ==================== ZIP ====================
+
+def test_zip_com_os_pdfs_do_paciente(cliente):
+    pdf_no_cache(cliente)   # um vem do cache, os outros dos shards
+    r = cliente.get('/api/paciente/1/pdfs/zip')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/zip'
+    assert r.headers['Content-Disposition'] == 'attachment; filename="paciente_1_pdfs.zip"'
+    arquivo = zipfile.ZipFile(io.BytesIO(r.data))
+    assert arquivo.testzip() is None
+    assert sorted(arquivo.namelist()) == [
+        '2024-05-02 Exame (2).pdf', '2024-05-02 Exame.pdf', 'documento_12.pdf']
+    assert {arquivo.read(nome) for nome in arquivo.namelist()} == {
+        BLOBS[7], BLOBS[9], BLOBS[paciente.BLOBS_POR_SHARD + 3]}
+    assert all(i.compress_type == zipfile.ZIP_STORED for i in arquivo.infolist())
+
+
+def test_zip_sem_pdfs(cliente):
+    assert cliente.get('/api/paciente/2/pdfs/zip').status_code == 404
+
+
+# ==================== PRONTUARIO ====================
+
+CONSULTAS = [{'id': 3, 'data': datetime(2024, 5, 2), 'situacao': 1}]
+
+
+@pytest.fixture
+def prontuario(monkeypatch, cliente):
+    """Secoes do prontuario sem banco: consultas respondem, evolucoes falham"""
+    monkeypatch.setattr(db, 'marcadores_paciente', lambda id_paciente, secoes: (1,))
+    monkeypatch.setattr(db, 'buscar_consultas', lambda id_paciente, limite, apos=None: list(CONSULTAS))
+
+    def evolucoes(id_paciente, limite, apos=None):
+        raise fdb.DatabaseError('conexao perdida')
+    monkeypatch.setattr(db, 'buscar_evolucoes', evolucoes)
+    return cliente
+
+
+def test_prontuario_parcial(prontuario):
+    r = prontuario.get('/api/paciente/1/prontuario?secoes=consultas,evolucoes')
+    assert r.status_code == 200
+    dados = r.get_json()
+    assert [c['id'] for c in dados['consultas']] == [3]
+    assert 'evolucoes' not in dados
+    assert dados['erros'] == {'evolucoes': 'conexao perdida'}
+    assert 'no-store' in r.headers['Cache-Control']
+    assert 'ETag' not in r.headers
+
+
+def test_prontuario_completo_tem_etag(prontuario):
+    r = prontuario.get('/api/paciente/1/prontuario?secoes=consultas')
+    assert r.status_code == 200
+    assert 'erros' not in r.get_json()
+    assert r.headers['ETag'] and 'no-store' not in r.headers['Cache-Control']
+
+
+def test_prontuario_secao_desconhecida(prontuario):
+    assert prontuario.get('/api/paciente/1/prontuario?secoes=consultas,xyz').status_code == 400
+
+
+# ==================== ETAG ====================
+
+@pytest.fixture
+def consultas(monkeypatch, cliente):
+    """Aba de consultas com marcador controlado pelo teste"""
+    marcador = {'valor': (1, 10)}
+    monkeypatch.setattr(modulo_app, 'JANELA_ETAG', 0)
+    monkeypatch.setattr(db, 'marcadores_paciente', lambda id_paciente, secoes: marcador['valor'])
+    monkeypatch.setattr(db, 'buscar_consultas', lambda id_paciente, limite, apos=None: list(CONSULTAS))
+    return cliente, marcador
+
+
+def test_etag_fraco_e_304(consultas):
+    cliente, _ = consultas
+    r = cliente.get('/api/paciente/1/consultas', headers={'Accept-Encoding': 'gzip'})
+    etag = r.headers['ETag']
+    assert r.status_code == 200 and etag.startswith('W/"')
+    assert r.headers['Cache-Control'] == 'no-cache'
+
+    r = cliente.get('/api/paciente/1/consultas', headers={'If-None-Match': etag})
+    assert r.status_code == 304 and r.data == b''
+    assert r.headers['ETag'] == etag
+
+    # Comparacao fraca: o cliente pode mandar sem o W/
+    r = cliente.get('/api/paciente/1/consultas', headers={'If-None-Match': etag[2:]})
+    assert r.status_code == 304
+
+
+def test_etag_muda_com_o_marcador(consultas):
+    cliente, marcador = consultas
+    etag = cliente.get('/api/paciente/1/consultas').headers['ETag']
+    marcador['valor'] = (2, 11)
+    r = cliente.get('/api/paciente/1/consultas', headers={'If-None-Match': etag})
+    assert r.status_code == 200 and r.headers['ETag'] != etag
+
+
+def test_etag_depende_dos_parametros(consultas):
+    cliente, _ = consultas
+    etag = cliente.get('/api/paciente/1/consultas').headers['ETag']
+    r = cliente.get('/api/paciente/1/consultas?limite=5', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+
+
+def test_prontuario_revalidado(prontuario, monkeypatch):
+    monkeypatch.setattr(modulo_app, 'JANELA_ETAG', 0)
+    etag = prontuario.get('/api/paciente/1/prontuario?secoes=consultas').headers['ETag']
+    r = prontuario.get('/api/paciente/1/prontuario?secoes=consultas', headers={'If-None-Match': etag})
+    assert r.status_code == 304
@@ -0,0 +1,24 @@
+import pytest
+
+import asgi
+
+
+def test_limites_somam_as_conexoes_do_pool():
+    rotas_banco = {p: n for p, n in asgi.LIMITES_ROTA.items() if p != asgi.ROTA_PDF}
+    assert sum(rotas_banco.values()) + asgi.PRONTUARIO_THREADS <= asgi.POOL_CONFIG['maximo']
+    assert asgi.LIMITES_ROTA[asgi.ROTA_PDF] <= asgi.BLOB_POOL_CONFIG['maximo']
+    assert asgi.ASGI_THREADS == sum(asgi.LIMITES_ROTA.values())
+
+
+@pytest.mark.parametrize('conexoes', [5, 7, 14, 23])
+def test_limites_repartem_pelos_pesos(conexoes):
+    limites = asgi.limites_rota(conexoes, pdf=2)
+    assert limites.pop(asgi.ROTA_PDF) == 2
+    assert sum(limites.values()) == conexoes
+    assert all(n >= 1 for n in limites.values())
+    assert limites['/api/paciente/'] == max(limites.values())
+
+
+def test_pool_pequeno_demais():
+    with pytest.raises(ValueError):
+        asgi.limites_rota(len(asgi.PESOS_ROTA) - 1)
@@ -0,0 +1,160 @@
+from datetime import date
+
+import pytest
+
+from busca import IndiceNomes, normalizar, chave_fonetica, distancia_edicao
+
+
+class ConexaoFalsa:
+    """Conexao fdb minima: devolve as linhas com A6COD > parametro"""
+
+    def __init__(self, linhas):
+        self.linhas = linhas
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self._pendentes = [l for l in self.linhas if l[0] > params[0]]
+
+    def fetchmany(self, n):
+        lote, self._pendentes = self._pendentes[:n], self._pendentes[n:]
+        return lote
+
+    def close(self):
+        pass
+
+
+PACIENTES = [
+    (1, 'MARIA DA SILVA', date(1980, 1, 1)),
+    (2, 'MARIANA SOUZA', None),
+    (3, 'JOSÉ DA CONCEIÇÃO', date(1975, 5, 20)),
+    (4, 'THIAGO PEREIRA', None),
+    (5, 'ANA MARIA LIMA', None),
+    (6, 'PEDRO ALVES', None),
+    (7, "JOAO D'AVILA", None),
+    (8, 'CARLA SILVANO', None),
+]
+
+
+@pytest.fixture
+def indice():
+    return IndiceNomes().carregar(ConexaoFalsa(PACIENTES))
+
+
+def ids(resultado):
+    return [r['id'] for r in resultado]
+
+
+def test_normalizar():
+    assert normalizar('  José  da Conceição ') == 'JOSE DA CONCEICAO'
+    assert normalizar("D'Ávila") == 'D AVILA'
+    assert normalizar(b'Jo\xe3o') == 'JOAO'
+    assert normalizar(None) == ''
+
+
+@pytest.mark.parametrize('a, b', [
+    ('CONCEICAO', 'CONSEISSAO'), ('THIAGO', 'TIAGO'), ('LUIZ', 'LUIS'),
+    ('WAGNER', 'VAGNER'), ('FELIPE', 'FILIPE'), ('PHELIPE', 'FELIPE'),
+])
+def test_chave_fonetica_equivalentes(a, b):
+    assert chave_fonetica(a) == chave_fonetica(b)
+
+
+def test_chave_fonetica_diferentes():
+    assert chave_fonetica('SILVA') != chave_fonetica('SOUZA')
+
+
+@pytest.mark.parametrize('a, b, distancia', [
+    ('ANA', 'ANA', 0),
+    ('SILVA', 'SILVIA', 1),    # insercao
+    ('MARIA', 'MARA', 1),      # delecao
+    ('PEDRO', 'PEDRU', 1),     # troca
+    ('MARIA', 'MAIRA', 1),     # transposicao conta 1
+    ('SILVA', 'SOUZA', 3),     # passou do maximo: maximo + 1
+    ('ANA', 'ANASTACIO', 3),   # tamanhos muito diferentes
+])
+def test_distancia_edicao(a, b, distancia):
+    assert distancia_edicao(a, b) == distancia
+
+
+def test_distancia_edicao_maximo():
+    assert distancia_edicao('ABCDEF', 'ABXXEF', maximo=1) == 2
+    assert distancia_edicao('ABCDEF', 'ABXXEF', maximo=3) == 2
+
+
+def test_exato_antes_de_prefixo(indice):
+    assert ids(indice.buscar('silva')) == [1, 8]
+
+
+def test_inicio_do_nome_pesa(indice):
+    # MARIA DA SILVA e igual ao termo no comeco do nome; MARIANA comeca com
+    # o termo; ANA MARIA so tem a palavra
+    assert ids(indice.buscar('maria')) == [1, 2, 5]
+
+
+def test_todas_as_palavras_contam(indice):
+    assert ids(indice.buscar('maria silva'))[0] == 1
+
+
+def test_sem_acento(indice):
+    assert ids(indice.buscar('jose conceicao')) == [3]
+
+
+def test_fonetica(indice):
+    assert ids(indice.buscar('tiago')) == [4]
+    assert ids(indice.buscar('conseissao')) == [3]
+
+
+def test_erro_de_digitacao(indice):
+    assert ids(indice.buscar('pereria')) == [4]
+
+
+def test_substring(indice):
+    assert ids(indice.buscar('reira')) == [4]
+
+
+def test_trecho_curto(indice):
+    assert set(ids(indice.buscar('lv'))) == {1, 6, 8}
+
+
+def test_inicio_do_nome(indice):
+    # Nomes que comecam com o termo primeiro, depois trechos no meio
+    assert ids(indice.buscar('ma')) == [1, 2, 5]
+    assert ids(indice.buscar('jo d')) == [7, 3]
+
+
+def test_resultado(indice):
+    assert indice.buscar('conceicao') == [
+        {'id': 3, 'nome': 'JOSÉ DA CONCEIÇÃO', 'data_nascimento': date(1975, 5, 20)}]
+    assert indice.buscar('') == []
+    assert indice.buscar('xyzw') == []
+
+
+def test_limite(indice):
+    assert len(indice.buscar('a', limite=2)) == 2
+
+
+def test_atualizar_traz_so_os_novos(indice):
+    conn = ConexaoFalsa(PACIENTES + [(9, 'MARIA NOVA', None)])
+    assert indice.atualizar(conn) == 1
+    assert len(indice) == 9
+    assert 9 in ids(indice.buscar('maria nova'))
+
+
+def test_empate_em_ordem_alfabetica():
+    linhas = [(cod, nome, None) for cod, nome in
+              enumerate(['MARCOS %s' % s for s in ('ZANON', 'BRITO', 'MOTA', 'ALVES')], 1)]
+    indice = IndiceNomes().carregar(ConexaoFalsa(linhas))
+    assert ids(indice.buscar('mar', limite=2)) == [4, 2]
+    indice.atualizar(ConexaoFalsa(linhas + [(5, 'MARCOS ABREU', None)]))
+    assert ids(indice.buscar('mar', limite=2)) == [5, 4]
+    assert ids(indice.buscar('marcos', limite=2)) == [5, 4]
+
+
+def test_prefixo_curto_com_muitos_candidatos():
+    linhas = [(cod, 'MAR%03d SILVA' % cod, None) for cod in range(1, 301)]
+    linhas.append((301, 'MAR', None))
+    indice = IndiceNomes().carregar(ConexaoFalsa(linhas))
+    resultado = ids(indice.buscar('mar', limite=5))
+    assert resultado == [301, 1, 2, 3, 4]
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from cache import CacheResultados
+
+
+def test_reaproveita_ate_o_ttl():
+    cache = CacheResultados()
+    chamadas = []
+    calcular = lambda: chamadas.append(1) or len(chamadas)
+    assert cache.obter('a', 60, calcular) == 1
+    assert cache.obter('a', 60, calcular) == 1
+    assert cache.obter('a', 0, calcular) == 1
+    cache.obter('b', 0, calcular)
+    assert cache.obter('b', 60, calcular) == 3
+
+
+def test_marcador_diferente_recalcula():
+    cache = CacheResultados()
+    assert cache.obter('a', 60, lambda: 1, marcador=10) == 1
+    assert cache.obter('a', 60, lambda: 2, marcador=11) == 2
+
+
+def test_descarta_vencidas_e_locks():
+    cache = CacheResultados()
+    for meses in range(50):
+        cache.obter(('resumo', (meses,), ()), 0, lambda: meses)
+    cache.obter('ultima', 60, lambda: 0)
+    assert list(cache._entradas) == ['ultima']
+    assert cache._locks == {}
+
+
+def test_limite_de_chaves():
+    cache = CacheResultados(maximo=3)
+    for i in range(5):
+        cache.obter(i, 60 + i, lambda: i)
+    assert sorted(cache._entradas) == [2, 3, 4]
+
+
+def test_erro_no_calculo_libera_o_lock():
+    cache = CacheResultados()
+
+    def falhar():
+        raise ValueError('banco fora')
+    try:
+        cache.obter('a', 60, falhar)
+    except ValueError:
+        pass
+    assert cache._locks == {}
+    assert cache.obter('a', 60, lambda: 1) == 1
+
+
+def test_uma_thread_calcula_por_chave():
+    cache = CacheResultados()
+    chamadas = []
+    liberar = threading.Event()
+
+    def calcular():
+        chamadas.append(1)
+        liberar.wait(5)
+        return 'valor'
+    resultados = []
+    threads = [threading.Thread(target=lambda: resultados.append(cache.obter('a', 60, calcular)))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    liberar.set()
+    for t in threads:
+        t.join()
+    assert chamadas == [1]
+    assert resultados == ['valor'] * 5
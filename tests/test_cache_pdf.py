@@ -0,0 +1,139 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from cache_pdf import CachePDF, TEMPORARIO_ABANDONADO
+
+
+def pdf(n, tamanho=300):
+    return bytes([n]) * tamanho
+
+
+def arquivos(pasta):
+    return sorted(os.listdir(pasta))
+
+
+def etag_no_cache(cache, blob_id):
+    leitura = cache.abrir(blob_id)
+    leitura.fechar()
+    return leitura.etag
+
+
+def test_gravar_e_abrir(tmp_path):
+    cache = CachePDF(str(tmp_path))
+    conteudo = b'%PDF-1.4 ' + os.urandom(1000)
+    etag = cache.gravar(7, [conteudo[:100], conteudo[100:]])
+    assert etag == hashlib.sha256(conteudo).hexdigest()[:16]
+    assert arquivos(tmp_path) == [f'7_{etag}.pdf']
+    leitura = cache.abrir(7)
+    assert leitura.etag == etag and leitura.tamanho == len(conteudo)
+    assert b''.join(leitura.ler(pedaco=64)) == conteudo
+    assert cache.abrir(8) is None
+
+
+def test_leitura_de_intervalo(tmp_path):
+    cache = CachePDF(str(tmp_path))
+    cache.gravar(1, [bytes(range(256))])
+    assert b''.join(cache.abrir(1).ler(10, 20, pedaco=3)) == bytes(range(10, 20))
+
+
+def test_falha_na_gravacao_nao_deixa_arquivo(tmp_path):
+    cache = CachePDF(str(tmp_path))
+
+    def pedacos():
+        yield b'inicio'
+        raise IOError('blob interrompido')
+
+    with pytest.raises(IOError):
+        cache.gravar(1, pedacos())
+    assert arquivos(tmp_path) == []
+    assert not cache.contem(1)
+
+
+def test_descartar_apaga_temporario(tmp_path):
+    cache = CachePDF(str(tmp_path))
+    gravacao = cache.gravacao(1)
+    gravacao.escrever(b'metade')
+    assert [n for n in arquivos(tmp_path) if n.endswith('.tmp')]
+    gravacao.descartar()
+    gravacao.descartar()
+    assert arquivos(tmp_path) == []
+    assert cache.abrir(1) is None
+
+
+def test_temporario_nao_aparece_antes_de_concluir(tmp_path):
+    cache = CachePDF(str(tmp_path))
+    gravacao = cache.gravacao(1)
+    gravacao.escrever(pdf(1))
+    assert not [n for n in arquivos(tmp_path) if n.endswith('.pdf')]
+    gravacao.concluir()
+    assert [n for n in arquivos(tmp_path) if n.endswith('.pdf')]
+
+
+def test_inicializacao_le_a_pasta_e_apaga_temporarios(tmp_path):
+    cache = CachePDF(str(tmp_path))
+    etag = cache.gravar(3, [pdf(3)])
+    (tmp_path / 'abandonado.tmp').write_bytes(b'x')
+    antigo = time.time() - TEMPORARIO_ABANDONADO - 60
+    os.utime(tmp_path / 'abandonado.tmp', (antigo, antigo))
+    (tmp_path / 'outro.txt').write_bytes(b'x')
+    novo = CachePDF(str(tmp_path))
+    assert not (tmp_path / 'abandonado.tmp').exists()
+    assert etag_no_cache(novo, 3) == etag
+    assert novo.estatisticas() == {'arquivos': 1, 'bytes': 300, 'limite': novo.limite}
+
+
+def test_inicializacao_preserva_gravacao_em_andamento(tmp_path):
+    (tmp_path / 'gravando.tmp').write_bytes(b'x')
+    CachePDF(str(tmp_path))
+    assert (tmp_path / 'gravando.tmp').exists()
+
+
+def test_limite_apaga_os_menos_usados(tmp_path):
+    cache = CachePDF(str(tmp_path), limite=1000)
+    for blob_id in (1, 2, 3):
+        cache.gravar(blob_id, [pdf(blob_id)])
+        cache._entradas[blob_id].usado_em = blob_id
+    cache.abrir(1).fechar()   # 1 passa a ser o mais recente
+    cache.gravar(4, [pdf(4)])   # 1200 bytes: apaga ate 900 (90%)
+    assert not cache.contem(2)
+    assert all(cache.contem(b) for b in (1, 3, 4))
+    assert cache.estatisticas()['bytes'] == 900
+    no_disco = sum(os.path.getsize(tmp_path / n) for n in arquivos(tmp_path))
+    assert no_disco == 900
+
+
+def test_limite_varios_de_uma_vez(tmp_path):
+    cache = CachePDF(str(tmp_path), limite=1000)
+    for blob_id in (1, 2, 3):
+        cache.gravar(blob_id, [pdf(blob_id)])
+        cache._entradas[blob_id].usado_em = blob_id
+    cache.gravar(4, [pdf(4, 600)])   # 1500 bytes: sai 1 e 2
+    assert sorted(cache._entradas) == [3, 4]
+    assert cache.estatisticas()['bytes'] == 900
+
+
+def test_regravar_nao_duplica_total(tmp_path):
+    cache = CachePDF(str(tmp_path))
+    cache.gravar(1, [pdf(1)])
+    cache.gravar(1, [pdf(1)])
+    assert cache.estatisticas()['bytes'] == 300
+
+
+def test_arquivo_apagado_por_outro_processo(tmp_path):
+    cache = CachePDF(str(tmp_path))
+    cache.gravar(1, [pdf(1)])
+    for nome in arquivos(tmp_path):
+        os.remove(tmp_path / nome)
+    assert cache.abrir(1) is None
+    assert cache.estatisticas()['bytes'] == 0
+
+
+def test_arquivo_de_outro_processo_entra_na_releitura(tmp_path):
+    cache = CachePDF(str(tmp_path), reindexar=0)
+    outro = CachePDF(str(tmp_path))
+    etag = outro.gravar(5, [pdf(5)])
+    assert etag_no_cache(cache, 5) == etag
+    assert b''.join(cache.abrir(5).ler()) == pdf(5)
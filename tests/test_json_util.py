@@ -0,0 +1,81 @@
+import gzip
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+import pytest
+
+import json_util
+from json_util import codificar, comprimir, converter, escolher_codificacao, MedicineEncoder
+
+
+class Aceitas(dict):
+    """Como request.accept_encodings do werkzeug: qualidade 0 se ausente"""
+
+    def __getitem__(self, chave):
+        return self.get(chave, 0)
+
+
+def test_tipos_do_firebird():
+    dados = {
+        'data': date(2024, 3, 5),
+        'data_hora': datetime(2024, 3, 5, 9, 7, 59),
+        'hora': time(8, 4),
+        'valor': Decimal('12.50'),
+        'nome': b'Jo\xe3o',
+        'lista': [1, None, 'ç'],
+    }
+    assert json.loads(codificar(dados)) == {
+        'data': '05/03/2024',
+        'data_hora': '05/03/2024 09:07',
+        'hora': '08:04',
+        'valor': 12.5,
+        'nome': 'João',
+        'lista': [1, None, 'ç'],
+    }
+
+
+def test_compacto_e_utf8():
+    corpo = codificar({'a': [1, 2], 'b': 'ã'})
+    assert isinstance(corpo, bytes)
+    assert corpo == '{"a":[1,2],"b":"ã"}'.encode('utf-8')
+
+
+def test_mesmo_resultado_do_encoder():
+    dados = {'d': date(2020, 1, 2), 'v': Decimal('1.5'), 'h': time(23, 59)}
+    assert json.loads(codificar(dados)) == json.loads(json.dumps(dados, cls=MedicineEncoder))
+
+
+def test_subclasse_de_data():
+    class Data(date):
+        pass
+    assert converter(Data(2021, 12, 31)) == '31/12/2021'
+
+
+def test_tipo_desconhecido():
+    with pytest.raises(TypeError):
+        converter(object())
+
+
+def test_escolher_codificacao():
+    assert escolher_codificacao(Aceitas()) is None
+    assert escolher_codificacao(Aceitas(gzip=1)) == 'gzip'
+    assert escolher_codificacao(Aceitas(gzip=0)) is None
+
+
+def test_escolher_codificacao_brotli(monkeypatch):
+    monkeypatch.setattr(json_util, 'brotli', object())
+    assert escolher_codificacao(Aceitas(br=1, gzip=1)) == 'br'
+    assert escolher_codificacao(Aceitas(br=0.5, gzip=1)) == 'gzip'
+    monkeypatch.setattr(json_util, 'brotli', None)
+    assert escolher_codificacao(Aceitas(br=1)) is None
+
+
+def test_comprimir():
+    pequeno = b'x' * (json_util.COMPRIMIR_MINIMO - 1)
+    assert comprimir(pequeno, 'gzip') == (pequeno, None)
+    grande = b'x' * json_util.COMPRIMIR_MINIMO
+    assert comprimir(grande, None) == (grande, None)
+    corpo, codificacao = comprimir(grande, 'gzip')
+    assert codificacao == 'gzip' and gzip.decompress(corpo) == grande
+    assert comprimir(grande, 'gzip')[0] == corpo   # mtime=0: ETag estavel
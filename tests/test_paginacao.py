@@ -0,0 +1,78 @@
+from datetime import date, datetime, time
+
+import pytest
+
+from paginacao import Paginacao, CursorInvalido, NULO_HORA, NULO_DATA_HORA
+
+
+def paginacao():
+    return Paginacao(
+        'consultas',
+        ('c.A20DATA', 'data'),
+        ('c.A20HORA', 'hora', NULO_HORA),
+        ('c.A20COD', 'id'),
+    )
+
+
+def test_cursor_ida_e_volta():
+    pag = paginacao()
+    linha = {'data': date(2024, 3, 15), 'hora': time(14, 30), 'id': 987, 'outro': 'x'}
+    assert pag.ler_cursor(pag.cursor(linha)) == [date(2024, 3, 15), time(14, 30), 987]
+
+
+def test_cursor_com_data_hora():
+    pag = Paginacao('documentos', ('d.A50DATA_HORA', 'data', NULO_DATA_HORA), ('d.A50COD', 'id'))
+    valor = datetime(2023, 12, 31, 23, 59, 1)
+    assert pag.ler_cursor(pag.cursor({'data': valor, 'id': 1})) == [valor, 1]
+
+
+def test_cursor_sem_padding_e_seguro_em_url():
+    cursor = paginacao().cursor({'data': date(2024, 1, 1), 'hora': None, 'id': 1})
+    assert '=' not in cursor and '+' not in cursor and '/' not in cursor
+
+
+def test_nulo_vira_valor_substituto():
+    pag = paginacao()
+    cursor = pag.cursor({'data': date(2024, 3, 15), 'hora': None, 'id': 5})
+    assert pag.ler_cursor(cursor) == [date(2024, 3, 15), NULO_HORA[1], 5]
+
+
+def test_order_by_usa_substituto_do_nulo():
+    assert paginacao().order_by() == (
+        "ORDER BY c.A20DATA DESC, COALESCE(c.A20HORA, TIME '00:00:00') DESC, c.A20COD DESC")
+
+
+def test_substitutos_menores_que_valores_reais():
+    assert NULO_HORA[1] <= time(0, 0)
+    assert NULO_DATA_HORA[1] < datetime(2000, 1, 1)
+
+
+def test_filtro():
+    pag = paginacao()
+    cursor = pag.cursor({'data': date(2024, 3, 15), 'hora': None, 'id': 5})
+    sql, params = pag.filtro(cursor)
+    hora = "COALESCE(c.A20HORA, TIME '00:00:00')"
+    assert sql == (
+        "AND c.A20DATA <= ? AND ((c.A20DATA < ?)"
+        f" OR (c.A20DATA = ? AND {hora} < ?)"
+        f" OR (c.A20DATA = ? AND {hora} = ? AND c.A20COD < ?))")
+    d, h = date(2024, 3, 15), time(0, 0)
+    assert params == [d, d, d, h, d, h, 5]
+    assert sql.count('?') == len(params)
+
+
+def test_filtro_sem_cursor():
+    assert paginacao().filtro(None) == ('', [])
+
+
+def test_cursor_de_outra_listagem():
+    outra = Paginacao('receitas', ('r.A54DATA', 'data'), ('r.A54COD', 'id'), ('r.A54X', 'x'))
+    cursor = outra.cursor({'data': date(2024, 1, 1), 'id': 1, 'x': 2})
+    with pytest.raises(CursorInvalido):
+        paginacao().ler_cursor(cursor)
+
+
+@pytest.mark.parametrize('cursor', ['!!!', 'bm9wZQ', 'WyJjb25zdWx0YXMiXQ'])
+def test_cursor_invalido(cursor):
+    with pytest.raises(CursorInvalido):
+        paginacao().ler_cursor(cursor)
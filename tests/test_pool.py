@@ -0,0 +1,128 @@
+import threading
+
+import pytest
+
+import pool as modulo_pool
+from pool import PoolConexoes, PoolEsgotado, BaseDB
+
+
+class ConexaoFalsa:
+    def __init__(self):
+        self.aberta = True
+        self.viva = True
+        self.rollbacks = 0
+
+    def rollback(self):
+        if not self.viva:
+            raise OSError('conexao perdida')
+        self.rollbacks += 1
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        assert sql == PoolConexoes.SQL_PING
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        self.aberta = False
+
+
+@pytest.fixture
+def abertas(monkeypatch):
+    conexoes = []
+
+    def connect(**config):
+        conn = ConexaoFalsa()
+        conexoes.append(conn)
+        return conn
+    monkeypatch.setattr(modulo_pool.fdb, 'connect', connect)
+    return conexoes
+
+
+def test_aquecer_abre_o_minimo(abertas):
+    p = PoolConexoes({}, minimo=2).aquecer()
+    assert len(abertas) == 2
+    assert p.estatisticas()['livres'] == 2
+
+
+def test_devolvida_e_reaproveitada(abertas):
+    p = PoolConexoes({}, minimo=0)
+    with p.conexao() as conn:
+        pass
+    assert conn.rollbacks == 1   # transacao encerrada na devolucao
+    with p.conexao() as outra:
+        assert outra is conn
+    assert len(abertas) == 1
+
+
+def test_maximo_e_timeout(abertas):
+    p = PoolConexoes({}, minimo=0, maximo=2)
+    p.obter()
+    p.obter()
+    with pytest.raises(PoolEsgotado):
+        p.obter(timeout=0.05)
+    assert p.estatisticas()['total'] == 2
+
+
+def test_espera_devolucao(abertas):
+    p = PoolConexoes({}, minimo=0, maximo=1)
+    conn = p.obter()
+    threading.Timer(0.05, p.devolver, (conn,)).start()
+    assert p.obter(timeout=5) is conn
+
+
+def test_descartar(abertas):
+    p = PoolConexoes({}, minimo=0)
+    conn = p.obter()
+    p.devolver(conn, descartar=True)
+    assert not conn.aberta
+    assert p.estatisticas()['total'] == 0
+    assert p.obter() is not conn
+
+
+def test_conexao_morta_e_trocada(abertas):
+    p = PoolConexoes({}, minimo=0)
+    conn = p.obter()
+    p.devolver(conn)
+    conn.viva = False
+    nova = p.obter()
+    assert nova is not conn and not conn.aberta
+    assert p.estatisticas()['total'] == 1
+
+
+def test_despejar_ociosas_preserva_minimo(abertas):
+    p = PoolConexoes({}, minimo=1, ociosa_max=0.01)
+    a, b = p.obter(), p.obter()
+    p.devolver(a)
+    p.devolver(b)
+    for item in p._livres:
+        item.usada_em -= 1
+    assert p.despejar_ociosas() == 1
+    assert p.estatisticas()['total'] == 1
+
+
+def test_fechar_e_reiniciar(abertas):
+    p = PoolConexoes({}, minimo=1).aquecer()
+    p.fechar()
+    assert not abertas[0].aberta
+    with pytest.raises(PoolEsgotado):
+        p.obter()
+    p.reiniciar()
+    assert p.estatisticas()['total'] == 0
+    assert p.obter() is abertas[-1]
+
+
+def test_basedb_uma_conexao_por_thread(abertas):
+    p = PoolConexoes({}, minimo=0)
+    db = BaseDB({}, p)
+    assert db.conn is db.conn
+    outras = []
+    t = threading.Thread(target=lambda: (outras.append(db.conn), db.liberar()))
+    t.start()
+    t.join()
+    assert outras[0] is not db.conn
+    db.liberar(descartar=True)
+    assert p.estatisticas() == {'total': 1, 'livres': 1, 'emprestadas': 0, 'minimo': 0, 'maximo': 10}